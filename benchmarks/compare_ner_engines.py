@@ -0,0 +1,48 @@
+"""
+Compares the two NER engines of NERLocation ('transformer' and 'gazetteer') on a
+folder of JSON articles: throughput of each one, and agreement of the gazetteer
+engine with the Transformer model (precision/recall/F1, exact and overlapping spans).
+
+Usage:
+    python benchmarks/compare_ner_engines.py path/to/folder_with_jsons [--max-sentences 5000] [--output report.json]
+"""
+
+import argparse
+import json
+
+import torch
+
+from seqia.article_load import load_articles_from_folder
+from seqia.ner_loc import NERLocation
+from seqia.sentence_split import SentenceSplitter
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and agreement of the NER engines for locations')
+    parser.add_argument('path', help='Folder with JSON articles')
+    parser.add_argument('--max-sentences', type=int, default=5000)
+    parser.add_argument('--output', default='', help='Optional JSON file to write the report to')
+    args = parser.parse_args()
+
+    articles = load_articles_from_folder(args.path)
+
+    splitter = SentenceSplitter()
+    sentences = []
+    for article in articles:
+        sents, _, _ = splitter(article)
+        sentences.extend(sents)
+        if len(sentences) >= args.max_sentences:
+            break
+    sentences = sentences[:args.max_sentences]
+
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    ner_location = NERLocation(device)
+
+    report = ner_location.compare_ner_engines(sentences)
+
+    print(json.dumps(report, indent=2))
+    if args.output != '':
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
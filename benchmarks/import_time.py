@@ -0,0 +1,84 @@
+"""
+Import-time benchmark: how long importing seqia (and the modules used by the CLI,
+the server and the output tools) takes, how much memory it uses, and which heavy
+libraries it pulls in. Every import runs in a fresh interpreter, "--repeat" times.
+
+Heavy libraries (torch, transformers, spaCy, GeoPandas...) must only be imported
+when the component that needs them is built, so that worker processes and tools
+that only load articles or write results start fast. The script exits with an error
+if any of them is imported by the modules below, or if an import takes longer than
+"--max-seconds", so it can be used as a regression check:
+
+    python benchmarks/import_time.py [--repeat 5] [--max-seconds 1.0] [--output import_time.json]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+#Modules that are timed, each in its own interpreter
+MODULES = ['seqia', 'seqia.cli', 'seqia.article_load', 'seqia.result_writers', 'seqia.sharded_runner', 'seqia.server', 'seqia.aggregate_cube']
+
+#Libraries that must not be imported by the modules above
+HEAVY_MODULES = ['torch', 'transformers', 'tensorflow', 'datasets', 'spacy', 'geopandas', 'pandas', 'shapely', 'pyarrow']
+
+#Run in the child interpreter: imports the module, and prints a JSON report of the import
+CHILD_CODE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'modules': len(sys.modules), 'heavy_modules': [name for name in {heavy} if name in sys.modules]}}))
+'''
+
+def time_import(module, repeat):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-c', CHILD_CODE.format(module=module, heavy=repr(HEAVY_MODULES))],
+                                capture_output=True, text=True)
+        if output.returncode != 0:
+            raise RuntimeError("Could not import " + module + ":\n" + output.stderr)
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    times = sorted([run['seconds'] for run in runs])
+    return {
+        'seconds_min': times[0],
+        'seconds_median': times[len(times) // 2],
+        'max_rss_mb': max([run['max_rss_mb'] for run in runs]),
+        'modules': runs[-1]['modules'],
+        'heavy_modules': runs[-1]['heavy_modules']
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time and memory of seqia, in fresh interpreters')
+    parser.add_argument('--modules', nargs='+', default=MODULES, help='Modules to import (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='Imports of each module (default: %(default)s)')
+    parser.add_argument('--max-seconds', type=float, default=1.0, help='Maximum median import time of each module (default: %(default)s)')
+    parser.add_argument('--output', default=None, help='JSON file for the results')
+    args = parser.parse_args()
+
+    results = dict()
+    failures = []
+    print('{:<24} {:>10} {:>10} {:>8}  {}'.format('Module', 'Median (s)', 'RSS (MB)', 'Modules', 'Heavy modules'))
+    for module in args.modules:
+        report = time_import(module, args.repeat)
+        results[module] = report
+        print('{:<24} {:>10.3f} {:>10.1f} {:>8}  {}'.format(module, report['seconds_median'], report['max_rss_mb'], report['modules'],
+                                                           ', '.join(report['heavy_modules']) or '-'))
+        if len(report['heavy_modules']) > 0:
+            failures.append(module + " imports " + ', '.join(report['heavy_modules']))
+        if report['seconds_median'] > args.max_seconds:
+            failures.append(module + " takes {:.3f}s to import (maximum: {}s)".format(report['seconds_median'], args.max_seconds))
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    for failure in failures:
+        print("FAILED:", failure)
+    sys.exit(1 if len(failures) > 0 else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Load test for the inference server (seqia serve): sends the articles of a folder,
+one per request, from a number of concurrent clients, and reports throughput and
+latency percentiles as seen by the clients, along with the server's own metrics
+(batch sizes, queue depth...).
+
+Usage:
+    seqia serve --port 8080 &
+    python benchmarks/load_test_server.py path/to/folder_with_jsons [--url http://127.0.0.1:8080] [--concurrency 32] [--requests 1000] [--output report.json]
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+from seqia.article_load import load_articles_from_folder
+
+def request(connection, method, path, body=None):
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    return response.status, json.loads(response.read().decode('utf-8'))
+
+def wait_until_ready(host, port, timeout):
+    #The server only answers /health with 200 once its models are loaded
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=10)
+            status, _ = request(connection, 'GET', '/health')
+            connection.close()
+            if status == 200:
+                return
+        except OSError:
+            pass
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Server at " + host + ":" + str(port) + " is not ready after " + str(timeout) + " s")
+        time.sleep(0.5)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test for the seqia inference server')
+    parser.add_argument('path', help='Folder with JSON articles (sent in a loop)')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--concurrency', type=int, default=32, help='Number of concurrent clients (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=1000, help='Total number of requests (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds to wait for the server to be ready, and for each request')
+    parser.add_argument('--output', default='', help='Optional JSON file to write the report to')
+    args = parser.parse_args()
+
+    url = urllib.parse.urlparse(args.url)
+    host, port = url.hostname, url.port or 80
+
+    payloads = [json.dumps(article, ensure_ascii=False).encode('utf-8') for article in load_articles_from_folder(args.path)]
+    if len(payloads) == 0:
+        raise ValueError("No articles found in " + args.path)
+
+    wait_until_ready(host, port, args.timeout)
+
+    #Clients take the next request from a shared counter, over their own keep-alive connection
+    counter = itertools.count()
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def client():
+        connection = http.client.HTTPConnection(host, port, timeout=args.timeout)
+        while True:
+            with lock:
+                i = next(counter)
+            if i >= args.requests:
+                break
+            start = time.perf_counter()
+            try:
+                status, response = request(connection, 'POST', '/infer', payloads[i % len(payloads)])
+            except (OSError, http.client.HTTPException) as e:
+                errors.append(str(e))
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=args.timeout)
+                continue
+            if status != 200:
+                errors.append(str(status) + ': ' + str(response.get('error')))
+            else:
+                latencies.append(time.perf_counter() - start)
+        connection.close()
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(args.concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    connection = http.client.HTTPConnection(host, port, timeout=args.timeout)
+    _, server_metrics = request(connection, 'GET', '/metrics')
+    connection.close()
+
+    latencies_ms = np.array(latencies) * 1000
+    report = {
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'errors': len(errors),
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'latency_ms': {('p' + str(p)): float(np.percentile(latencies_ms, p)) if len(latencies) > 0 else None for p in [50, 90, 95, 99]},
+        'server': server_metrics
+    }
+
+    print("Requests: %d (%d errors), concurrency: %d" % (args.requests, len(errors), args.concurrency))
+    print("Throughput: %.1f requests/s" % report['requests_per_second'])
+    print("Client latency (ms): " + ', '.join(['%s %.1f' % (name, value) for name, value in report['latency_ms'].items() if value is not None]))
+    print("Server latency (ms): " + ', '.join(['%s %.1f' % (name, value) for name, value in server_metrics['latency_ms'].items() if value is not None]))
+    print("Batches: %d (mean size %.1f), max queue depth: %d" % (server_metrics['batches'], server_metrics['mean_batch_size'], server_metrics['max_queue_depth']))
+    print("Batch sizes: " + ', '.join([size + ': ' + str(count) for size, count in server_metrics['batch_sizes'].items()]))
+    for error in errors[:5]:
+        print("Error:", error)
+
+    if args.output != '':
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
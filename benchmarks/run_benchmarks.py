@@ -0,0 +1,307 @@
+"""
+Benchmark suite: per-stage micro-benchmarks and an end-to-end run, over a synthetic
+corpus (see synthetic_corpus.py), with tiny random models (see tiny_models.py), so
+that it runs offline. Results are written as JSON, and can be compared with those of
+a previous run (e.g. before and after a change):
+
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+
+Stages:
+    loading             loading JSON articles from a folder (seqia.article_load)
+    cleaning            text cleaning (seqia.text_cleaning.clean_text)
+    keyword             keyword-based classification
+    sentence_split_*    sentence splitting of the articles about drought, in each mode
+    ner_aggregation     NERLocation.loc_tokens_aggregation, over synthetic NER model outputs
+    geolocation         NERLocation.geolocation_IGN, over the toponyms of the previous stage
+                        (skipped if the gazetteers are not available)
+    output_jsonl        writing results as JSON Lines (as "seqia run" does)
+    output_impacts_tsv  DroughtClassifier.write_impacts_to_csv_file
+    end_to_end          every step of DroughtClassifier.inference, with tiny random models
+
+Every micro-benchmark is run "--repeat" times; the minimum and median times are reported.
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from synthetic_corpus import generate_corpus, write_corpus
+
+def time_function(function, repeat=3):
+    #Times of each call of "function", and the output of the last one
+    times = []
+    output = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = function()
+        times.append(time.perf_counter() - start)
+    return times, output
+
+def timing_report(times, items, unit):
+    times_sorted = sorted(times)
+    return {
+        'seconds_min': times_sorted[0],
+        'seconds_median': times_sorted[len(times_sorted) // 2],
+        'seconds': times,
+        'items': items,
+        'unit': unit,
+        'items_per_second': items / times_sorted[0] if times_sorted[0] > 0 else None
+    }
+
+def synthetic_ner_output(sentences):
+    #Output of the NER pipeline ("entity", "start", "end", "word"... for each token) for the capitalized words of each
+    #sentence except the first one, tagged as locations with BIOES tags (multi-word names when consecutive)
+    outputs = []
+    for sentence in sentences:
+        words = [match for match in re.finditer(r'\w+', sentence)][1:]
+        entities = []
+        k = 0
+        while k < len(words):
+            if not words[k].group()[0].isupper():
+                k += 1
+                continue
+            end = k
+            while end + 1 < len(words) and words[end + 1].group()[0].isupper():
+                end += 1
+            for m in range(k, end + 1):
+                if k == end:
+                    tag = 'S-LOC'
+                else:
+                    tag = 'B-LOC' if m == k else ('E-LOC' if m == end else 'I-LOC')
+                word = words[m]
+                entities.append({'entity': tag, 'score': 0.99, 'index': m + 1, 'word': ('Ġ' if m > k else '') + word.group(),
+                                 'start': word.start(), 'end': word.end()})
+            k = end + 1
+        outputs.append(entities)
+    return outputs
+
+def run_stage_benchmarks(articles, folder, args, results):
+    from seqia.article_load import load_articles_from_folder
+    from seqia.text_cleaning import clean_text
+    from seqia.keywords import KeywordClassifier
+    from seqia.sentence_split import SentenceSplitter
+    from seqia.ner_loc import NERLocation
+    from seqia.sharded_runner import to_json_value
+    from seqia import DroughtClassifier
+
+    num_articles = len(articles)
+
+    times, loaded = time_function(lambda: load_articles_from_folder(folder), args.repeat)
+    results['loading'] = timing_report(times, num_articles, 'articles')
+
+    raw_texts = [article['headline'] + '\n' + article['body'] for article in articles]
+    times, _ = time_function(lambda: [clean_text(text) for text in raw_texts], args.repeat)
+    results['cleaning'] = timing_report(times, num_articles, 'articles')
+
+    keyword = KeywordClassifier()
+    times, keyword_results = time_function(lambda: keyword(loaded), args.repeat)
+    results['keyword'] = timing_report(times, num_articles, 'articles')
+
+    positives = [article for i, article in enumerate(loaded) if keyword_results[i] == 1]
+
+    split_output = None
+    for mode in args.split_modes:
+        try:
+            splitter = SentenceSplitter(mode=mode)
+        except OSError as e:
+            #'full' and 'lazy' modes need the es_core_news_sm spaCy model
+            results['sentence_split_' + mode] = {'skipped': str(e)}
+            continue
+        times, output = time_function(lambda: list(splitter.pipe(positives)), args.repeat)
+        results['sentence_split_' + mode] = timing_report(times, len(positives), 'articles')
+        if split_output is None or mode == 'fast':
+            split_output = output
+
+    if split_output is None:
+        return
+
+    sentences = [sentence for sents, _, _ in split_output for sentence in sents]
+    spans = [span for _, _, sents_spans in split_output for span in sents_spans]
+
+    ner_location = NERLocation('cpu')
+    ner_output = synthetic_ner_output(sentences)
+    times, (toponyms, toponyms_metadata) = time_function(lambda: ner_location.loc_tokens_aggregation(ner_output, sentences), args.repeat)
+    results['ner_aggregation'] = timing_report(times, len(sentences), 'sentences')
+    results['ner_aggregation']['toponyms'] = sum([len(sentence_toponyms) for sentence_toponyms in toponyms])
+
+    geolocated_metadata = toponyms_metadata
+    try:
+        start = time.perf_counter()
+        ner_location.load_geolocation_data()
+        results['geolocation_setup'] = {'seconds': time.perf_counter() - start}
+    except Exception as e:
+        results['geolocation'] = {'skipped': 'Gazetteers could not be loaded: ' + type(e).__name__ + ': ' + str(e)}
+    else:
+        #Geolocation fills in the metadata of each toponym: every run starts from a fresh copy
+        copies = [copy.deepcopy(toponyms_metadata) for _ in range(args.repeat)]
+        times, geolocated_metadata = time_function(lambda: ner_location.geolocation_IGN(toponyms, copies.pop(), None, spans), args.repeat)
+        results['geolocation'] = timing_report(times, results['ner_aggregation']['toponyms'], 'toponyms')
+
+    #Results in the usual format, with the toponyms found above
+    predictions = []
+    k = 0
+    for article, (sents, _, _) in zip(positives, split_output):
+        locations = [(toponyms[k + j], geolocated_metadata[k + j]) for j in range(len(sents))]
+        k += len(sents)
+        predictions.append({'drought': True, 'impacts': ['Agricultura'] if 'cosecha' in article['body'] else [], 'locations': locations,
+                            'filename': article['filename'], 'sentences_idx': dict(enumerate(sents))})
+
+    output_folder = tempfile.mkdtemp(prefix='seqia-benchmark-output-')
+
+    def write_jsonl():
+        with open(os.path.join(output_folder, 'results.jsonl'), 'w', encoding='utf-8') as f:
+            for prediction in predictions:
+                f.write(json.dumps(prediction, ensure_ascii=False, default=to_json_value) + '\n')
+
+    times, _ = time_function(write_jsonl, args.repeat)
+    results['output_jsonl'] = timing_report(times, len(predictions), 'articles')
+    results['output_jsonl']['bytes'] = os.path.getsize(os.path.join(output_folder, 'results.jsonl'))
+
+    writer = DroughtClassifier.__new__(DroughtClassifier)
+    times, _ = time_function(lambda: writer.write_impacts_to_csv_file(predictions, os.path.join(output_folder, 'impacts.tsv')), args.repeat)
+    results['output_impacts_tsv'] = timing_report(times, len(predictions), 'articles')
+
+    return
+
+def run_end_to_end_benchmark(articles, args, results):
+    #Each step of DroughtClassifier.inference, timed on its own, with tiny random models
+    from tiny_models import build_tiny_classifier
+
+    models_folder = tempfile.mkdtemp(prefix='seqia-benchmark-models-')
+    start = time.perf_counter()
+    classifier = build_tiny_classifier(models_folder, [article['headline'] + ' ' + article['body'] for article in articles],
+                                       seed=args.seed, sentence_split_mode=args.e2e_split_mode)
+    classifier.ner_location.do_geocoding = args.e2e_geocoding
+    classifier.load_modules()
+    setup_seconds = time.perf_counter() - start
+
+    stages = [('problems', lambda batch: classifier.find_problematic_articles(batch['articles'])),
+              ('keyword', classifier.run_keyword_stage),
+              ('binary', classifier.run_binary_stage),
+              ('sentence_split', classifier.run_sentence_split_stage),
+              ('drought_impacts', classifier.run_drought_impacts_stage),
+              ('ner_loc', classifier.run_ner_loc_stage),
+              ('gather_results', classifier.gather_results)]
+
+    stage_times = {name: [] for name, _ in stages}
+    total_times = []
+    for _ in range(args.repeat):
+        total_start = time.perf_counter()
+        batch = classifier.start_inference_batch(articles)
+        for name, run_stage in stages:
+            start = time.perf_counter()
+            run_stage(batch)
+            stage_times[name].append(time.perf_counter() - start)
+        total_times.append(time.perf_counter() - total_start)
+
+    results['end_to_end'] = timing_report(total_times, len(articles), 'articles')
+    results['end_to_end']['setup_seconds'] = setup_seconds
+    results['end_to_end']['positives'] = sum([1 for result in batch['results_binary'] if result == 1])
+    results['end_to_end']['geocoding'] = args.e2e_geocoding
+    for name, times in stage_times.items():
+        results['end_to_end:' + name] = timing_report(times, len(articles), 'articles')
+
+    return
+
+def get_environment():
+    import numpy
+    import torch
+    import transformers
+    import spacy
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                                capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'numpy': numpy.__version__,
+        'torch': torch.__version__,
+        'transformers': transformers.__version__,
+        'spacy': spacy.__version__,
+        'git_commit': commit
+    }
+
+def compare(results, baseline):
+    #Ratio of the minimum time of each benchmark to that of the baseline (below 1: faster than the baseline)
+    print("\n%-32s %12s %12s %8s" % ('Benchmark', 'Baseline (s)', 'Current (s)', 'Ratio'))
+    for name, result in results['benchmarks'].items():
+        previous = baseline.get('benchmarks', dict()).get(name)
+        if 'seconds_min' not in result or previous is None or 'seconds_min' not in previous:
+            continue
+        ratio = result['seconds_min'] / previous['seconds_min'] if previous['seconds_min'] > 0 else float('nan')
+        print("%-32s %12.4f %12.4f %8.2f" % (name, previous['seconds_min'], result['seconds_min'], ratio))
+    if baseline.get('config') != results['config']:
+        print("\nWARNING: the baseline was run with a different configuration:", baseline.get('config'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-stage and end-to-end benchmarks of seqia, over a synthetic corpus')
+    parser.add_argument('--articles', type=int, default=1000, help='Articles of the synthetic corpus (default: %(default)s)')
+    parser.add_argument('--e2e-articles', type=int, default=100, help='Articles for the end-to-end run (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark (default: %(default)s)')
+    parser.add_argument('--split-modes', nargs='+', default=['fast', 'full'], choices=['fast', 'full', 'lazy'])
+    parser.add_argument('--e2e-split-mode', default='fast', choices=['fast', 'full', 'lazy'])
+    parser.add_argument('--e2e-geocoding', action='store_true', help='Geolocate toponyms in the end-to-end run (needs the gazetteers)')
+    parser.add_argument('--skip-end-to-end', action='store_true')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file for the results (default: %(default)s)')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run, to compare with')
+    args = parser.parse_args()
+
+    articles = generate_corpus(args.articles, seed=args.seed)
+    corpus_folder = tempfile.mkdtemp(prefix='seqia-benchmark-corpus-')
+    write_corpus(articles, corpus_folder)
+
+    num_words = sorted([len(article['body'].split()) for article in articles])
+    results = {
+        'config': {'articles': args.articles, 'e2e_articles': args.e2e_articles, 'seed': args.seed, 'repeat': args.repeat,
+                   'split_modes': args.split_modes, 'e2e_split_mode': args.e2e_split_mode, 'e2e_geocoding': args.e2e_geocoding},
+        'environment': get_environment(),
+        'corpus': {'articles': len(articles), 'drought_articles': sum([article['is_drought'] for article in articles]),
+                   'median_words': num_words[len(num_words) // 2], 'max_words': num_words[-1]},
+        'benchmarks': dict()
+    }
+
+    run_stage_benchmarks(articles, corpus_folder, args, results['benchmarks'])
+
+    if not args.skip_end_to_end:
+        try:
+            run_end_to_end_benchmark(articles[:args.e2e_articles], args, results['benchmarks'])
+        except Exception as e:
+            traceback.print_exc()
+            results['benchmarks']['end_to_end'] = {'skipped': type(e).__name__ + ': ' + str(e)}
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    print("\n%-32s %12s %16s" % ('Benchmark', 'Min (s)', 'Throughput'))
+    for name, result in results['benchmarks'].items():
+        if 'skipped' in result:
+            print("%-32s %s" % (name, 'skipped (' + result['skipped'].splitlines()[0][:80] + ')'))
+        elif 'seconds_min' in result:
+            throughput = '%.1f %s/s' % (result['items_per_second'], result['unit']) if result['items_per_second'] is not None else '-'
+            print("%-32s %12.4f %16s" % (name, result['seconds_min'], throughput))
+    print("\nResults written to", args.output)
+
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+Deterministic generator of synthetic Spanish news articles, for benchmarks.
+
+Articles are made of template sentences about weather, water, farming, energy and
+local politics, filled with toponyms drawn from the gazetteers bundled with seqia
+(towns from MUNICIPIOS.csv and other_towns.tsv, weighted by population, and their
+provinces), plus rivers, reservoirs and autonomous communities. Body lengths follow
+a log-normal distribution (median of about 400 words, with a long tail), roughly
+like those of regional newspapers. A fraction of the articles is about drought
+(they contain "sequía" and impact-related vocabulary), and a fraction of sentences
+is boilerplate shared by many articles (syndicated paragraphs, agency credits).
+
+The same seed always gives the same corpus, so timings of different runs (and
+different versions of the code) are comparable.
+
+Usage:
+    python benchmarks/synthetic_corpus.py path/to/output_folder [--articles 1000] [--seed 0]
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+
+from seqia.article_load import JSON_mapping
+
+LOC_FILES_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'seqia', 'loc_files')
+
+#Used when the gazetteer files are not available
+DEFAULT_TOWNS = [('Madrid', 3300000), ('Barcelona', 1600000), ('Valencia', 790000), ('Sevilla', 680000), ('Zaragoza', 670000),
+                 ('Málaga', 570000), ('Murcia', 460000), ('Córdoba', 320000), ('Valladolid', 300000), ('Huesca', 53000),
+                 ('Teruel', 35000), ('Calatayud', 20000), ('Tarazona', 10000), ('Alcañiz', 16000), ('Jaca', 13000)]
+DEFAULT_PROVINCES = ['Madrid', 'Barcelona', 'Valencia', 'Sevilla', 'Zaragoza', 'Huesca', 'Teruel', 'Córdoba', 'Murcia', 'Jaén']
+
+RIVERS = ['Ebro', 'Tajo', 'Duero', 'Guadalquivir', 'Guadiana', 'Júcar', 'Segura', 'Miño', 'Gállego', 'Cinca', 'Jalón', 'Turia']
+RESERVOIRS = ['Yesa', 'Mequinenza', 'Buendía', 'Entrepeñas', 'La Serena', 'Alcántara', 'Almendra', 'Valdecañas', 'El Grado', 'Mediano']
+COMMUNITIES = ['Aragón', 'Cataluña', 'Andalucía', 'Castilla-La Mancha', 'Castilla y León', 'Extremadura', 'Comunidad Valenciana',
+               'Región de Murcia', 'Navarra', 'La Rioja', 'Galicia', 'Asturias']
+
+HEADLINES = [
+    "{town} aprueba el presupuesto municipal para {year}",
+    "Las lluvias de {month} alivian a los agricultores de {province}",
+    "El embalse de {reservoir} se sitúa al {percent}% de su capacidad",
+    "{community} presenta su plan de empleo juvenil",
+    "Vecinos de {town} reclaman mejoras en el transporte",
+    "La crecida del {river} obliga a cortar carreteras en {province}",
+    "Fiestas de {town}: programa completo",
+    "El paro baja en {province} durante el mes de {month}",
+]
+DROUGHT_HEADLINES = [
+    "La sequía pone en jaque a los regantes de {province}",
+    "{town} aplica restricciones de agua por la sequía",
+    "El embalse de {reservoir} cae al {percent}% en plena sequía",
+    "Los ganaderos de {community} piden ayudas por la sequía",
+    "La sequía reduce la producción hidroeléctrica en la cuenca del {river}",
+]
+SENTENCES = [
+    "El ayuntamiento de {town} aprobó ayer el nuevo plan de movilidad urbana.",
+    "Según fuentes municipales, las obras comenzarán en {month} y durarán unos {number} meses.",
+    "La Diputación de {province} destinará {number} millones de euros a la mejora de carreteras.",
+    "El consejero de {community} visitó las instalaciones junto al alcalde de {town}.",
+    "La temperatura máxima alcanzó los {number} grados en {town}, según la Agencia Estatal de Meteorología.",
+    "Los vecinos de {town} celebraron una asamblea para debatir el proyecto.",
+    "La Confederación Hidrográfica del {river} ha convocado una reunión con los usuarios.",
+    "El caudal del {river} a su paso por {town} es de {number} metros cúbicos por segundo.",
+    "La oposición criticó la falta de información sobre el contrato.",
+    "El proyecto cuenta con el apoyo de las empresas de la comarca.",
+    "Las previsiones apuntan a un fin de semana estable en {province}.",
+    "La feria reunirá a más de {number} expositores en el recinto de {town}.",
+]
+DROUGHT_SENTENCES = [
+    "La sequía ha reducido la cosecha de cereal en {province} en un {percent}%.",
+    "Los agricultores de {town} aseguran que no recuerdan una sequía tan intensa.",
+    "El embalse de {reservoir} está al {percent}% de su capacidad, muy por debajo de la media de los últimos años.",
+    "La falta de pastos obliga a los ganaderos de {community} a comprar forraje.",
+    "La sequía ha obligado a restringir el riego en la cuenca del {river}.",
+    "La producción de energía hidroeléctrica ha caído un {percent}% por la escasez de agua.",
+    "El abastecimiento de agua potable en {town} se garantiza con camiones cisterna.",
+    "Los regantes de {province} piden a la Confederación Hidrográfica del {river} que revise las dotaciones.",
+]
+BOILERPLATE = [
+    "Suscríbete a nuestro boletín para recibir las noticias de la provincia.",
+    "(Servimedia)",
+    "Noticia elaborada con información de la agencia EFE.",
+    "Consulta aquí toda la información sobre el tiempo en tu localidad.",
+]
+MONTHS = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
+
+def load_bundled_toponyms():
+    #Towns (with their population, used as sampling weight) and provinces from the bundled gazetteers
+    towns = dict()
+    provinces = set()
+
+    municipalities_path = os.path.join(LOC_FILES_FOLDER, 'MUNICIPIOS.csv')
+    if os.path.isfile(municipalities_path):
+        with open(municipalities_path, 'r', encoding='cp1252') as f:
+            for i, line in enumerate(f):
+                if i == 0:
+                    continue
+                line = line.rstrip('\n').split(';')
+                provinces.update(line[3].split('/'))
+                for town_name in line[4].split('/'):
+                    towns[town_name] = max(towns.get(town_name, 0), int(line[5]) if line[5].isdigit() else 0)
+
+    other_towns_path = os.path.join(LOC_FILES_FOLDER, 'other_towns.tsv')
+    if os.path.isfile(other_towns_path):
+        with open(other_towns_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                town_names = line.rstrip('\n').split('\t')[0]
+                for town_name in town_names.split('/'):
+                    #Names such as "Ciudad Quesada, Alicante" are not how towns are mentioned in text
+                    if ',' not in town_name:
+                        towns.setdefault(town_name, 1000)
+
+    if len(towns) == 0:
+        towns = dict(DEFAULT_TOWNS)
+    if len(provinces) == 0:
+        provinces = set(DEFAULT_PROVINCES)
+
+    #Sorted, so that sampling does not depend on the order of the files
+    towns = sorted(towns.items())
+    return [name for name, _ in towns], [math.sqrt(population + 1) for _, population in towns], sorted(provinces)
+
+class SyntheticCorpusGenerator:
+
+    def __init__(self, seed=0, drought_fraction=0.3, boilerplate_fraction=0.05, median_words=400, words_sigma=0.7,
+                 min_words=40, max_words=3000):
+        self.seed = seed
+        self.drought_fraction = drought_fraction
+        self.boilerplate_fraction = boilerplate_fraction
+        self.median_words = median_words
+        self.words_sigma = words_sigma
+        self.min_words = min_words
+        self.max_words = max_words
+
+        self.towns, self.town_weights, self.provinces = load_bundled_toponyms()
+        self.cumulative_town_weights = []
+        total = 0.0
+        for weight in self.town_weights:
+            total += weight
+            self.cumulative_town_weights.append(total)
+
+        return
+
+    def fill(self, template, rng):
+        return template.format(
+            town=rng.choices(self.towns, cum_weights=self.cumulative_town_weights)[0],
+            province=rng.choice(self.provinces),
+            community=rng.choice(COMMUNITIES),
+            river=rng.choice(RIVERS),
+            reservoir=rng.choice(RESERVOIRS),
+            month=rng.choice(MONTHS),
+            year=rng.randint(2000, 2024),
+            percent=rng.randint(5, 95),
+            number=rng.randint(2, 500)
+        )
+
+    def generate_article(self, i, rng):
+        is_drought = rng.random() < self.drought_fraction
+        target_words = int(min(self.max_words, max(self.min_words, rng.lognormvariate(math.log(self.median_words), self.words_sigma))))
+
+        headline = self.fill(rng.choice(DROUGHT_HEADLINES if is_drought else HEADLINES), rng)
+
+        sentences = []
+        num_words = 0
+        while num_words < target_words:
+            if rng.random() < self.boilerplate_fraction:
+                sentence = rng.choice(BOILERPLATE)
+            elif is_drought and rng.random() < 0.4:
+                sentence = self.fill(rng.choice(DROUGHT_SENTENCES), rng)
+            else:
+                sentence = self.fill(rng.choice(SENTENCES), rng)
+            sentences.append(sentence)
+            num_words += len(sentence.split())
+
+        #Paragraphs of 2 to 5 sentences
+        paragraphs = []
+        while len(sentences) > 0:
+            size = rng.randint(2, 5)
+            paragraphs.append(' '.join(sentences[:size]))
+            sentences = sentences[size:]
+
+        return {'filename': 'synthetic_%06d.json' % i, 'headline': headline, 'body': '\n'.join(paragraphs), 'is_drought': is_drought}
+
+    def generate(self, num_articles):
+        #Each article has its own random generator, so that the first N articles are the same for any corpus size
+        return [self.generate_article(i, random.Random(self.seed * 1000003 + i)) for i in range(num_articles)]
+
+def generate_corpus(num_articles, seed=0, **kwargs):
+    #List of articles, in the same format as those loaded by seqia.article_load (plus "is_drought")
+    return SyntheticCorpusGenerator(seed=seed, **kwargs).generate(num_articles)
+
+def write_corpus(articles, folder):
+    #One JSON file per article, with the fields expected by seqia.article_load
+    os.makedirs(folder, exist_ok=True)
+    for article in articles:
+        with open(os.path.join(folder, article['filename']), 'w', encoding='utf-8') as f:
+            json.dump({JSON_mapping['headline']: article['headline'], JSON_mapping['body']: article['body']}, f, ensure_ascii=False)
+    return
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic corpus of Spanish news articles')
+    parser.add_argument('output', help='Output folder (one JSON file per article)')
+    parser.add_argument('--articles', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--drought-fraction', type=float, default=0.3)
+    args = parser.parse_args()
+
+    articles = generate_corpus(args.articles, seed=args.seed, drought_fraction=args.drought_fraction)
+    write_corpus(articles, args.output)
+
+    num_words = sorted([len(article['body'].split()) for article in articles])
+    print("Wrote", len(articles), "articles to", args.output, "(%d about drought; median of %d words per article)"
+          % (sum([article['is_drought'] for article in articles]), num_words[len(num_words) // 2] if len(num_words) > 0 else 0))
+
+if __name__ == '__main__':
+    main()
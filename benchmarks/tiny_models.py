@@ -0,0 +1,91 @@
+"""
+Tiny, randomly initialised versions of the models of seqia, for offline benchmarks.
+
+A byte-level BPE tokenizer is trained on the given texts, and a Longformer binary
+classifier, a RoBERTa impacts classifier and a RoBERTa token classifier (with the
+same LOC tags as the real NER model) are built with a few thousand parameters
+each. Their predictions are meaningless, but every stage of the pipeline runs
+through the same code paths as with the real models (tokenization, padding to
+the input size of each model, NER token aggregation...), so end-to-end runs can
+be timed without downloading anything. Timings of the model forward passes
+themselves are, of course, much lower than with the real models.
+"""
+
+import os
+
+import torch
+
+#Labels of the NER model (the real model uses BIOES tags; only LOC tags are used by NERLocation)
+NER_LABELS = ['O', 'B-LOC', 'I-LOC', 'E-LOC', 'S-LOC', 'B-PER', 'I-PER', 'E-PER', 'S-PER', 'B-ORG', 'E-ORG', 'S-ORG']
+
+def train_tokenizer(texts, folder, vocab_size=2000):
+    from tokenizers import ByteLevelBPETokenizer
+    from tokenizers.processors import RobertaProcessing
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = ByteLevelBPETokenizer()
+    tokenizer.train_from_iterator(texts, vocab_size=vocab_size, special_tokens=['<s>', '<pad>', '</s>', '<unk>', '<mask>'], show_progress=False)
+    tokenizer.post_processor = RobertaProcessing(('</s>', tokenizer.token_to_id('</s>')), ('<s>', tokenizer.token_to_id('<s>')))
+
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token='<s>', eos_token='</s>', cls_token='<s>', sep_token='</s>',
+                                        pad_token='<pad>', unk_token='<unk>', mask_token='<mask>', model_max_length=4096)
+    tokenizer.save_pretrained(folder)
+    return tokenizer
+
+def build_tiny_models(folder, texts, seed=0, hidden_size=32, num_layers=2):
+    #Writes a tokenizer and the three tiny models to subfolders of "folder" (which are returned)
+    from transformers import LongformerConfig, LongformerForSequenceClassification, RobertaConfig, RobertaForSequenceClassification, RobertaForTokenClassification
+
+    torch.manual_seed(seed)
+
+    paths = {name: os.path.join(folder, name) for name in ['tokenizer', 'binary', 'impacts', 'ner']}
+    tokenizer = train_tokenizer(texts, paths['tokenizer'])
+
+    common = {'vocab_size': len(tokenizer), 'hidden_size': hidden_size, 'num_hidden_layers': num_layers, 'num_attention_heads': 2,
+              'intermediate_size': 2 * hidden_size, 'pad_token_id': tokenizer.pad_token_id, 'bos_token_id': tokenizer.bos_token_id,
+              'eos_token_id': tokenizer.eos_token_id}
+
+    binary = LongformerForSequenceClassification(LongformerConfig(max_position_embeddings=4098, attention_window=32, num_labels=2, **common))
+    impacts = RobertaForSequenceClassification(RobertaConfig(max_position_embeddings=514, num_labels=2, **common))
+    ner = RobertaForTokenClassification(RobertaConfig(max_position_embeddings=514, num_labels=len(NER_LABELS),
+                                                      id2label=dict(enumerate(NER_LABELS)), label2id={label: i for i, label in enumerate(NER_LABELS)}, **common))
+
+    #Random weights would tag most tokens as locations: most tokens are tagged as "O" instead, as with
+    #real text, so that the number of toponyms (and the work of geolocation) is realistic.
+    #Likewise, the binary classifier keeps (almost) every article found by the keyword search, so that the
+    #impacts and NER models have as much work as with real articles about drought
+    with torch.no_grad():
+        ner.classifier.bias.zero_()
+        ner.classifier.bias[0] = 4.0
+        binary.classifier.out_proj.bias.zero_()
+        binary.classifier.out_proj.bias[1] = 4.0
+
+    for name, model in [('binary', binary), ('impacts', impacts), ('ner', ner)]:
+        model.eval()
+        model.save_pretrained(paths[name])
+        tokenizer.save_pretrained(paths[name])
+
+    return paths
+
+def build_tiny_classifier(folder, texts, seed=0, **classifier_kwargs):
+    #A DroughtClassifier whose models are tiny random ones (see above), built from "texts". Keyword arguments
+    #are those of DroughtClassifier (e.g. "sentence_split_mode")
+    from seqia import DroughtClassifier
+    from seqia.binary import ArticleTokenizer, BinaryClassifier
+    from seqia.drought_impacts import DroughtImpactsClassifier
+
+    paths = build_tiny_models(folder, texts, seed=seed)
+
+    classifier = DroughtClassifier(**classifier_kwargs)
+
+    classifier._article_tokenizer = ArticleTokenizer(paths['tokenizer'])
+    classifier._binary = BinaryClassifier(modelPath=paths['binary'] + os.sep, article_tokenizer=classifier._article_tokenizer)
+
+    #Same impacts as the real classifier, all of them with the tiny tokenizer (and the same tiny model)
+    impacts_and_base_model = {impact: (paths['tokenizer'], 512) for impact in DroughtImpactsClassifier.impacts_and_base_model.keys()}
+    TinyDroughtImpactsClassifier = type('TinyDroughtImpactsClassifier', (DroughtImpactsClassifier,), {'impacts_and_base_model': impacts_and_base_model})
+    classifier._drought_impacts = TinyDroughtImpactsClassifier(classifier.device, modelPath=paths['impacts'] + os.sep)
+
+    classifier.ner_location.model_name = paths['ner']
+
+    return classifier
@@ -2,35 +2,58 @@
 
 #Import main libraries
 import os
-import torch
-from collections import defaultdict
+import hashlib
+import itertools
+from collections import defaultdict, OrderedDict
 from tqdm import tqdm
 import warnings
 
-#Models classes
-from . binary import BinaryClassifier
+#Models classes. The modules of the models (and torch, transformers, spaCy, GeoPandas...) are only imported
+#when a component is first built (see the properties of DroughtClassifier), so that "import seqia" is fast
 from . keywords import KeywordClassifier
 #from . multiclass import MulticlassClassifier
-from . drought_impacts import DroughtImpactsClassifier
-from . ner_loc import NERLocation
 
 #Support functions
-from . article_load import load_articles_from_folder
-from . dataset import DroughtDataset
-from . sentence_split import SentenceSplitter
+from . article_load import load_articles_from_folder, iter_articles
+from . pipeline import PipelinedExecutor
+from . checkpoints import RunCheckpoint
+from . near_duplicates import NearDuplicateDetector
+from . metrics import metrics
+from . result_writers import JSONLResultWriter, ImpactsTSVWriter, LocationsTSVWriter, WRITE_BUFFER_SIZE
+from . sharded_runner import to_json_value
 
 device = None
 
+#Names that used to be imported here, still available as seqia.NAME (imported on first use)
+LAZY_IMPORTS = {
+    'BinaryClassifier': 'binary',
+    'ArticleTokenizer': 'binary',
+    'DroughtImpactsClassifier': 'drought_impacts',
+    'NERLocation': 'ner_loc',
+    'DroughtDataset': 'dataset',
+    'SentenceSplitter': 'sentence_split',
+    'memory_map_model_weights': 'model_weights'
+}
+
+def __getattr__(name):
+    if name in LAZY_IMPORTS:
+        import importlib
+        value = getattr(importlib.import_module('.' + LAZY_IMPORTS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+
 #Main class definition
 class DroughtClassifier:
-    binary = None
     multiclass = None
-    ner_location = None
     geonames_username = None
-    def __init__(self,gpu=0,cpu_threads=0):
+    def __init__(self,gpu=0,cpu_threads=0,preload=False,ner_engine='transformer',sentence_split_mode='full',spacy_batch_size=64,spacy_n_process=1,weights_cache_dir=None,gazetteer_snapshot=None,deduplicate_sentences=True,collect_metrics=False,profiler=None):
 
         self.exclude_problematic_articles = False
         self.problematic_articles = []
+        self.near_duplicates = None
+
+        import torch
 
         #Check if GPU is available for inference mode, else use CPU
         device = "cuda:0" if torch.cuda.is_available() else "cpu"
@@ -47,52 +70,160 @@ class DroughtClassifier:
         else:
             torch.cuda.set_device(gpu)  #Outdated function!!!!
 
-        #Load models
-        self.binary = BinaryClassifier()
+        self.device = device
+        self.ner_engine = ner_engine
+        self.sentence_split_mode = sentence_split_mode
+        self.spacy_batch_size = spacy_batch_size
+        self.spacy_n_process = spacy_n_process
+
+        #Sentences that appear in several positive articles (boilerplate, syndicated paragraphs...) are only run
+        #through the drought impacts and NER models once per batch (see "get_unique_sentences")
+        self.deduplicate_sentences = deduplicate_sentences
+        self.reset_sentence_dedup_stats()
+
+        #Wall time, throughput, batch sizes, cache hits and memory use of each stage (see seqia/metrics.py).
+        #The registry is shared by every component and every classifier of the process
+        self.metrics = metrics
+        if collect_metrics:
+            self.metrics.enable()
+
+        #Optional StageProfiler (see seqia/profiling.py), for hot-path analysis of selected stages
+        self.profiler = profiler
+        if profiler is not None:
+            self.metrics.set_profiler(profiler)
+
+        #Optional sharing of memory between processes: model weights memory-mapped from a cache folder (see
+        #model_weights.py), and gazetteers loaded from a snapshot file (see NERLocation.load_gazetteer_snapshot)
+        self.weights_cache_dir = weights_cache_dir
+        self.gazetteer_snapshot = gazetteer_snapshot
+
+        #Models (and the spaCy pipeline and gazetteers) are loaded lazily: each one is only built
+        #the first time a module that needs it is run (see the properties below). A keyword-only
+        #or binary-only run thus never loads the impacts or NER models. Set "preload" to load
+        #everything upfront instead (e.g. for long-running services)
+        self._binary = None
+        self._article_tokenizer = None
+        self._drought_impacts = None
+        self._ner_location = None
+        self._sentence_split = None
+
+        #Maximum number of articles whose tokens are kept between the problem detection and binary classification
+        #steps (None: default of ArticleTokenizer). Set by each driver from its chunk size
+        self.article_tokens_cache_size = None
 
         self.keyword = KeywordClassifier()
 
         #self.multiclass = MulticlassClassifier()
-        self.drought_impacts = DroughtImpactsClassifier(device)
 
-        self.ner_location = NERLocation(device)
-        
-        self.sentence_split = SentenceSplitter()
+        if preload:
+            self.load_modules()
 
         #TODO
 
         return
+
+    @property
+    def binary(self):
+        if self._binary is None:
+            from . binary import BinaryClassifier
+            from . model_weights import memory_map_model_weights
+            self._binary = BinaryClassifier(article_tokenizer=self.article_tokenizer)
+            if self.weights_cache_dir is not None:
+                memory_map_model_weights(self._binary.model, self.weights_cache_dir)
+        return self._binary
+
+    @property
+    def article_tokenizer(self):
+        #Tokenizer of the binary classifier, shared with the problem detection step (articles are tokenized once for both)
+        if self._article_tokenizer is None:
+            from . binary import BinaryClassifier, ArticleTokenizer
+            self._article_tokenizer = ArticleTokenizer(BinaryClassifier.binary_base_model_name)
+            if self.article_tokens_cache_size is not None:
+                self._article_tokenizer.max_cache_size = self.article_tokens_cache_size
+        return self._article_tokenizer
+
+    @property
+    def drought_impacts(self):
+        if self._drought_impacts is None:
+            from . drought_impacts import DroughtImpactsClassifier
+            from . model_weights import memory_map_model_weights
+            self._drought_impacts = DroughtImpactsClassifier(self.device)
+            if self.weights_cache_dir is not None:
+                for model in self._drought_impacts.model.values():
+                    memory_map_model_weights(model, self.weights_cache_dir)
+        return self._drought_impacts
+
+    @property
+    def ner_location(self):
+        if self._ner_location is None:
+            from . ner_loc import NERLocation
+            self._ner_location = NERLocation(self.device, engine=self.ner_engine)
+            self._ner_location.weights_cache_dir = self.weights_cache_dir
+            self._ner_location.gazetteer_snapshot = self.gazetteer_snapshot
+            #Sentences split without a parser ('lazy' mode) are parsed only when a toponym needs disambiguation
+            self._ner_location.sentence_parser = lambda sentence: self.sentence_split.parse(sentence)
+        return self._ner_location
+
+    @property
+    def sentence_split(self):
+        if self._sentence_split is None:
+            from . sentence_split import SentenceSplitter
+            self._sentence_split = SentenceSplitter(mode=self.sentence_split_mode, batch_size=self.spacy_batch_size, n_process=self.spacy_n_process)
+        return self._sentence_split
+
+    def load_modules(self,modulesToLoad=['*']):
+        #Loads upfront everything needed to run the given modules (same short names as in "inference")
+        runAll = len(modulesToLoad) == 1 and modulesToLoad[0] == '*'
+
+        #Used by the problem detection step, which is always run
+        self.article_tokenizer
+
+        if runAll or 'binary' in modulesToLoad:
+            self.binary
+        if runAll or 'drought_impacts' in modulesToLoad:
+            self.drought_impacts
+        if runAll or 'ner_loc' in modulesToLoad:
+            self.ner_location.load_model()
+            if self.ner_location.do_geocoding:
+                self.ner_location.load_geolocation_data()
+        self.sentence_split
+        return
     
     def change_number_cpu_threads(self,num):
+        import torch
         torch.set_num_threads(num)
         return
     
     #def multiclass_classifier(self, texts: list):
     #    return self.multiclass(texts)
 
-    def detect_repeated_articles(self,articles):
+    def detect_repeated_articles(self,articles,seen_bodies=None):
         #First find repeated article entries via a simple checking through
         #Python's sets: if an article has the absolute same body as another
-        #loaded news article, then we exclude it
+        #loaded news article, then we exclude it. Bodies are stored as hash digests,
+        #which keeps the memory footprint small for very large corpora. Pass in
+        #a dictionary as "seen_bodies" to keep checking across successive calls
+        #(it is filled in with the digest -> filename of every new body)
         repeated = []
-        texts = set()
-        entries = dict()
+        if seen_bodies is None:
+            seen_bodies = dict()
         for article in tqdm(articles, desc='Checking for duplicate articles'):
-            if article['body'] not in texts:
-                texts.add(article['body'])
-                entries[article['body']] = article
+            body_digest = hashlib.blake2b(article['body'].encode('utf-8'), digest_size=16).digest()
+            if body_digest not in seen_bodies:
+                seen_bodies[body_digest] = article['filename']
             else:
-                repeated.append((article['filename'],'REPEATED_ARTICLE_BODY: ' + entries[article['body']]['filename']))
+                repeated.append((article['filename'],'REPEATED_ARTICLE_BODY: ' + seen_bodies[body_digest]))
 
-        #TODO: Implement text-reuse Python bindings to allow for more sophisticated search of duplicates
+        #Articles that are not exact repeats, but near-duplicates (e.g. republished with small edits), are
+        #found separately, with "near_duplicate_threshold" (see inference_on_representatives)
 
         return repeated
 
     def detect_problems_with_articles(self,articles):
-        from transformers import AutoTokenizer
-        tokenizer = AutoTokenizer.from_pretrained('PlanTL-GOB-ES/longformer-base-4096-bne-es')
+        #Articles are tokenized in batches, and their tokens are kept for the binary classifier
+        articles_lengths = self.article_tokenizer.get_lengths(articles)
         problems = []
-        for article in tqdm(articles, desc='Checking for problems in corpus'):
+        for article, article_length in tqdm(zip(articles, articles_lengths), total=len(articles), desc='Checking for problems in corpus'):
             #Is the body of the article empty or too short (one to three characters)?
             if len(article['body']) <= 3:
                 problems.append((article['filename'],'BODY_TOO_SHORT: ' + str(len(article['body']))))
@@ -102,7 +233,6 @@ class DroughtClassifier:
                 problems.append((article['filename'],'HEADLINE_TOO_SHORT: ' + str(len(article['headline']))))
 
             #Is the article too long? (more than 4,096 BPE tokens)
-            article_length = len(tokenizer.tokenize(article['filename'] + '~' + article['body']))
             if article_length >= 4096:
                 problems.append((article['filename'],'ARTICLE_TOO_LONG: ' + str(len(article['headline']))))
         
@@ -110,11 +240,55 @@ class DroughtClassifier:
     
     def inference(self, articles : list,modulesToLoad=['*'], exclude_articles : list=[]):
 
+        #The pipeline is run as a series of stages over a "batch": a dictionary that holds the input
+        #articles and the output of each stage. Each stage can also be run on its own (see "run_pipelined")
+        input_articles = list(articles)
+        with metrics.stage('inference') as stage:
+            batch = self.start_inference_batch(articles,modulesToLoad,exclude_articles)
+            stage.add(items=len(batch['articles']))
+
+            self.run_keyword_stage(batch)
+            self.run_binary_stage(batch)
+            self.run_sentence_split_stage(batch)
+            self.run_drought_impacts_stage(batch)
+            self.run_ner_loc_stage(batch)
+
+            results = self.gather_results(batch)
+
+        self.discard_article_tokens(input_articles)
+        self.finish_batch()
+        return results
+
+    def finish_batch(self):
+        #Called by every driver (inference, run_pipelined, run_checkpointed) once the results of a batch are gathered
+        if self.profiler is not None:
+            self.profiler.finish_batch()
+        return
+
+    def discard_article_tokens(self, articles):
+        #Drops the tokens of articles that are done with. Every driver calls it for each whole chunk once it is
+        #finished, including articles that never reached the binary classifier (excluded as problematic,
+        #near-duplicates, or with the binary stage skipped or restored from a checkpoint)
+        if self._article_tokenizer is not None:
+            self._article_tokenizer.discard(articles)
+        return
+
+    def set_article_tokens_cache_size(self, num_articles):
+        #Bounds the tokens kept between the problem detection and binary classification steps to those of the
+        #chunks in flight (tokens evicted before they are used are simply computed again)
+        self.article_tokens_cache_size = max(num_articles, 1)
+        if self._article_tokenizer is not None:
+            self._article_tokenizer.max_cache_size = self.article_tokens_cache_size
+        return
+
+    def start_inference_batch(self, articles : list,modulesToLoad=['*'], exclude_articles : list=[]):
+
         #Exclude news articles that we're not going to run inference through, this is
         #defined by the "exclude_articles" list, and whether we run it or not is
         #determined by an internal variable set at the __call__ method
         articles_to_exclude = []
         if self.exclude_problematic_articles:
+            exclude_articles = set(exclude_articles)
             for i, article in enumerate(list(articles)):
                 if article['filename'] in exclude_articles:
                     articles_to_exclude.append(i)
@@ -139,20 +313,40 @@ class DroughtClassifier:
         if len(modulesToLoad) == 1 and modulesToLoad[0] == '*':
             runAll = True
 
+        return {
+            'articles': articles,
+            'modulesToLoad': modulesToLoad,
+            'runAll': runAll,
+            'results_keyword': results_keyword,
+            'results_binary': results_binary,
+            'positives_sentences': [],
+            'impacts': defaultdict(list),
+            'locations': defaultdict(list)
+        }
+
+    def run_keyword_stage(self, batch):
         #Apply keyword-based search to the articles.
-        if runAll or 'keyword' in modulesToLoad:
+        if batch['runAll'] or 'keyword' in batch['modulesToLoad']:
             print("\nPerforming keyword-based classification")
-            results_keyword = self.keyword(articles)
+            with metrics.stage('keyword', items=len(batch['articles'])):
+                batch['results_keyword'] = self.keyword(batch['articles'])
+        return batch
 
+    def run_binary_stage(self, batch):
         #Binary classifier
-        if runAll or 'binary' in modulesToLoad:
+        if batch['runAll'] or 'binary' in batch['modulesToLoad']:
             print("\nPerforming binary classification")
-            results_binary = self.binary(articles,results_keyword)
-        
+            with metrics.stage('binary', items=sum(batch['results_keyword'].values())):
+                batch['results_binary'] = self.binary(batch['articles'],batch['results_keyword'])
+        self.discard_article_tokens(batch['articles'])
+        return batch
+
+    def run_sentence_split_stage(self, batch):
+        articles = batch['articles']
+
         #Gather a list of articles being labeled as positives, also keep alongside it the index to the original
         #list to know where it was located in the original corpus (via a tuple-based system)
-        positives = [(i, articles[i]) for i, result in enumerate(results_binary) if result == 1]
-        positives_idx = [positive_idx for positive_idx, _ in positives]
+        positives = [(i, articles[i]) for i, result in enumerate(batch['results_binary']) if result == 1]
 
         #Separate all positive articles into its set of sentences. Although classification at the
         #sentence level is mostly used by the multiclass model, and hence it would make more sense
@@ -160,38 +354,150 @@ class DroughtClassifier:
         #sentence level, so it makes more sense to store them separately to be retrieved at those two
         #different steps, so as to avoid repetition. Sentence splitting is done with spaCy. For each analyzed text,
         #we also store the spaCy Doc object that generated those sentences, since it could prove useful later on
-        #for performing syntactic analysis for desambiguating toponyms.
+        #for performing syntactic analysis for desambiguating toponyms, and one spaCy Span per sentence (a view
+        #over that Doc, not a copy).
+        #Texts are split in batches (and, optionally, over several processes) via spaCy's nlp.pipe.
         positives_sentences = []
-        for positive_idx, positive_text in positives:
-            sents, doc, sents_docs = self.sentence_split(positive_text)
-            positives_sentences.append((positive_idx, sents, doc, sents_docs)) #format of individual entry: (index_int,[list of str],spacyDocObject)
+        with metrics.stage('sentence_split', items=len(positives)):
+            sentence_split_output = self.sentence_split.pipe([positive_text for _, positive_text in positives])
+            for (positive_idx, _), (sents, doc, sents_spans) in tqdm(zip(positives, sentence_split_output), total=len(positives), desc='Splitting sentences'):
+                positives_sentences.append((positive_idx, sents, doc, sents_spans)) #format of individual entry: (index_int,[list of str],spacyDocObject,[list of spacySpanObject])
+        metrics.count('sentences', sum([len(sents) for _, sents, _, _ in positives_sentences]), stage='sentence_split')
         #positives_sentences = [(positive_idx, self.sentence_split(positive_text)) for positive_idx, positive_text in positives] #format of individual entry: (index_int,[list of str])
-        positives_sentences_idx = [positive_idx for positive_idx, _, _, _ in positives_sentences]
 
+        batch['positives_sentences'] = positives_sentences
+        return batch
+
+    def reset_sentence_dedup_stats(self):
+        self.sentence_dedup_stats = {'sentences': 0, 'unique_sentences': 0}
+        return
+
+    def get_sentence_dedup_ratio(self):
+        #Fraction of the sentences of positive articles that were not run through the models, since
+        #an identical one had already been run in the same batch
+        if self.sentence_dedup_stats['sentences'] == 0:
+            return 0.0
+        return 1 - self.sentence_dedup_stats['unique_sentences'] / self.sentence_dedup_stats['sentences']
+
+    def get_unique_sentences(self, batch):
+        #Distinct sentences of the positive articles of a batch, as (sentences, spaCy Spans, ids), where "ids" holds,
+        #for each entry of batch['positives_sentences'], the index of each of its sentences in the first two lists.
+        #Sentences are compared by their exact text, since NER outputs character offsets into it. The Span of the
+        #first occurrence of each sentence is the one used for disambiguating its toponyms. Computed once per batch
+        if 'unique_sentences' not in batch:
+            index = dict()
+            unique_sentences = []
+            unique_spans = []
+            sentence_ids = []
+            for _, sents, _, sents_spans in batch['positives_sentences']:
+                ids = []
+                for k, sentence in enumerate(sents):
+                    if sentence not in index:
+                        index[sentence] = len(unique_sentences)
+                        unique_sentences.append(sentence)
+                        unique_spans.append(sents_spans[k] if sents_spans is not None else None)
+                    ids.append(index[sentence])
+                sentence_ids.append(ids)
+            batch['unique_sentences'] = (unique_sentences, unique_spans, sentence_ids)
+
+            num_sentences = sum([len(ids) for ids in sentence_ids])
+            self.sentence_dedup_stats['sentences'] += num_sentences
+            self.sentence_dedup_stats['unique_sentences'] += len(unique_sentences)
+            metrics.count('cache_hits', num_sentences - len(unique_sentences), cache='sentences')
+            metrics.count('cache_misses', len(unique_sentences), cache='sentences')
+            if num_sentences > 0:
+                print("\nSentence deduplication:", len(unique_sentences), "unique sentences out of", num_sentences,
+                      "(dedup ratio: %.1f%%)" % (100 * (1 - len(unique_sentences) / num_sentences)))
+
+        return batch['unique_sentences']
+
+    def run_drought_impacts_stage(self, batch):
         #Drought impacts classification
-        impacts = defaultdict(list)
-        if runAll or 'drought_impacts' in modulesToLoad:
+        if batch['runAll'] or 'drought_impacts' in batch['modulesToLoad']:
             print("\nPerforming drought impacts classification")
-            impacts = self.drought_impacts(positives_sentences)
+            with metrics.stage('drought_impacts', items=len(batch['positives_sentences'])):
+                if self.deduplicate_sentences:
+                    #Every distinct sentence is classified once; an article gets every impact found in any of its sentences
+                    unique_sentences, _, sentence_ids = self.get_unique_sentences(batch)
+                    sentence_impacts = self.drought_impacts.predict_sentences(unique_sentences)
+                    impacts_names = list(self.drought_impacts.impacts_and_base_model.keys())
+                    for (positive_idx, _, _, _), ids in zip(batch['positives_sentences'], sentence_ids):
+                        found = set([impact for sentence_id in ids for impact in sentence_impacts[sentence_id]])
+                        batch['impacts'][positive_idx] = [impact for impact in impacts_names if impact in found]
+                else:
+                    batch['impacts'] = self.drought_impacts(batch['positives_sentences'])
+        return batch
 
-        #NER locations
-        locations = defaultdict(list)
-        if runAll or 'ner_loc' in modulesToLoad:
-            print("\nPerforming named entity recognition for places")
-            for i, article_sentences, doc, sents_docs in tqdm(positives_sentences):
-                toponyms, toponyms_metadata = self.ner_location(article_sentences,doc,sents_docs)
+    def run_ner_loc_stage_on_unique_sentences(self, batch, ner_batch_size=64):
+        #NER (and geolocation) of every distinct sentence of the batch, whose results are copied to every
+        #article and position it appears in. Metadata dictionaries are copied, not shared between articles
+        locations = batch['locations']
+        unique_sentences, unique_spans, sentence_ids = self.get_unique_sentences(batch)
+
+        sentence_locations = []
+        for start in tqdm(range(0, len(unique_sentences), ner_batch_size)):
+            toponyms, toponyms_metadata = self.ner_location(unique_sentences[start:start+ner_batch_size],None,unique_spans[start:start+ner_batch_size])
+            sentence_locations.extend(zip(toponyms, toponyms_metadata))
+
+        #The spatial join is also done once per distinct sentence, before copying
+        if self.ner_location.do_geocoding and self.ner_location.do_spatial_join:
+            self.ner_location.attach_administrative_units([toponym_metadata for _, sentence_metadata in sentence_locations
+                                                                            for toponym_metadata in sentence_metadata])
+
+        for (i, _, _, _), ids in zip(batch['positives_sentences'], sentence_ids):
+            for sentence_id in ids:
+                toponyms, toponyms_metadata = sentence_locations[sentence_id]
+                locations[i].append((list(toponyms), [dict(toponym_metadata) for toponym_metadata in toponyms_metadata]))
+
+        return batch
+
+    def run_ner_loc_stage_on_articles(self, batch):
+        #NER (and geolocation) of the sentences of each article, one article at a time
+        locations = batch['locations']
+        for i, article_sentences, doc, sents_spans in tqdm(batch['positives_sentences']):
+            toponyms, toponyms_metadata = self.ner_location(article_sentences,doc,sents_spans)
+            if len(toponyms) > 0:
+                for j, toponym in enumerate(toponyms):
+                    if toponym != '':
+                        locations[i].append((toponym, toponyms_metadata[j]))
+            """
+            for sentence_num, sentence in enumerate(article_sentences):
+                toponyms, toponyms_metadata = self.ner_location([sentence],doc,[sents_spans[sentence_num]])
                 if len(toponyms) > 0:
                     for j, toponym in enumerate(toponyms):
                         if toponym != '':
-                            locations[i].append((toponym, toponyms_metadata[j]))
-                """
-                for sentence_num, sentence in enumerate(article_sentences):
-                    toponyms, toponyms_metadata = self.ner_location([sentence],doc,[sents_docs[sentence_num]])
-                    if len(toponyms) > 0:
-                        for j, toponym in enumerate(toponyms):
-                            if toponym != '':
-                                locations[i].append((sentence_num, toponym, toponyms_metadata[j]))
-                """
+                            locations[i].append((sentence_num, toponym, toponyms_metadata[j]))
+            """
+
+        #Assign every resolved location to its province, autonomous community and river basin.
+        #This is done once for the whole corpus, as a single bulk spatial query
+        if self.ner_location.do_geocoding and self.ner_location.do_spatial_join:
+            self.ner_location.attach_administrative_units([toponym_metadata for article_locations in locations.values()
+                                                                          for _, sentence_metadata in article_locations
+                                                                          for toponym_metadata in sentence_metadata])
+        return batch
+
+    def run_ner_loc_stage(self, batch):
+        #NER locations
+        if batch['runAll'] or 'ner_loc' in batch['modulesToLoad']:
+            print("\nPerforming named entity recognition for places")
+            with metrics.stage('ner_loc', items=len(batch['positives_sentences'])):
+                if self.deduplicate_sentences:
+                    self.run_ner_loc_stage_on_unique_sentences(batch)
+                else:
+                    self.run_ner_loc_stage_on_articles(batch)
+        return batch
+
+    def gather_results(self, batch):
+        articles = batch['articles']
+        modulesToLoad = batch['modulesToLoad']
+        runAll = batch['runAll']
+        results_binary = batch['results_binary']
+        impacts = batch['impacts']
+        locations = batch['locations']
+
+        #Sentences of each positive article, by its index in the list of articles
+        positives_sentences = {positive_idx: sents for positive_idx, sents, _, _ in batch['positives_sentences']}
 
         #TO BE CONTINUED... TODO
 
@@ -212,29 +518,130 @@ class DroughtClassifier:
             else:
                 cur_result['filename'] = ''
 
+            #Publication date (only for articles that have one, see JSON_mapping in article_load.py)
+            if articles[i].get('date') is not None:
+                cur_result['date'] = articles[i]['date']
+
             #Drought impacts
             if '*' in modulesToLoad or 'drought_impacts' in modulesToLoad:
-                if i in positives_idx:
+                if i in positives_sentences:
                     cur_result['impacts'] = impacts[i]
             #NER location
             if '*' in modulesToLoad or 'ner_loc' in modulesToLoad:
-                if i in positives_idx:
+                if i in positives_sentences:
                     cur_result['locations'] = locations[i]
             
             #TODO
             #Write sentences and their index (use them in your output only if necessary)
-            if i in positives_idx:
+            if i in positives_sentences:
                 cur_result['sentences_idx'] = dict()
 
-                _, sents_final, _, _ = positives_sentences[positives_sentences_idx.index(i)]
-                for sent_final_idx, sent_final in enumerate(sents_final):
+                for sent_final_idx, sent_final in enumerate(positives_sentences[i]):
                     cur_result['sentences_idx'][sent_final_idx] = sent_final
 
             final_results.append(cur_result)
 
         return final_results
     
-    def __call__(self, path, isPath=True, modulesToLoad=['*'], exclude_problematic_articles=False):
+    def find_problematic_articles(self,articles,seen_bodies=None):
+        with metrics.stage('problems', items=len(articles)):
+            problems = self.detect_problems_with_articles(articles)
+            problems.extend(self.detect_repeated_articles(articles,seen_bodies))
+
+        return problems, self.get_excluded_articles(problems)
+
+    def get_excluded_articles(self,problems):
+        #Make a list of the names for excluded articles; we don't include here those that have no headlines,
+        #as although the headline for a specific article could be empty, the body of that article could still
+        #contain worthwile information
+        return list(set([article for article, problem in problems if problem != 'HEADLINE_TOO_SHORT']))
+
+    def start_near_duplicates_detection(self,threshold=None,max_cached_results=10000):
+        #Near-duplicate articles (e.g. the same wire-agency story, republished with small edits by several newspapers)
+        #are found with MinHash and LSH (see near_duplicates.py): models are only run on the representative of each
+        #group of near-duplicates (its first article), and its results are copied to the rest. "threshold" is the
+        #minimum estimated similarity (Jaccard similarity of the 5-word shingles of headline and body); None
+        #disables the detection. When streaming, the results of the last "max_cached_results" representatives are
+        #kept; a near-duplicate of an older one is run through the models again
+        if threshold is None:
+            self.near_duplicates = None
+        else:
+            #"pending": position of each representative whose results are not known yet -> dictionary where its
+            #result is put once it is (see "find_near_duplicates")
+            self.near_duplicates = {'detector': NearDuplicateDetector(threshold), 'position': 0,
+                                    'results': OrderedDict(), 'pending': dict(), 'max_cached_results': max_cached_results}
+        return
+
+    def inference_on_representatives(self, articles : list,modulesToLoad=['*'], exclude_articles : list=[]):
+        #Same as "inference", but models are only run on one article of each group of near-duplicates (see above)
+        if self.near_duplicates is None:
+            return self.inference(articles,modulesToLoad,exclude_articles)
+
+        articles, representatives, matches = self.find_near_duplicates(articles,exclude_articles)
+        return self.copy_near_duplicates_results(articles,matches,self.inference(representatives,modulesToLoad,[]))
+
+    def find_near_duplicates(self, articles : list, exclude_articles : list=[]):
+        #First half of "inference_on_representatives": returns the articles (without the excluded ones, if problematic
+        #articles are excluded), the representatives that models must be run on, and the match of each article:
+        #None for representatives, or (representative position, similarity, dictionary that holds the result of the
+        #representative, or will hold it once it is known). Representatives of earlier chunks can thus be matched
+        #before their results are gathered, as in "run_pipelined"
+        state = self.near_duplicates
+        detector = state['detector']
+
+        if self.exclude_problematic_articles:
+            exclude_articles = set(exclude_articles)
+            articles = [article for article in articles if article['filename'] not in exclude_articles]
+
+        matches = []
+        for article in tqdm(articles, desc='Finding near-duplicate articles'):
+            position = state['position']
+            state['position'] += 1
+            match = detector.add(position, article['headline'] + '\n' + article['body'])
+            if match is not None:
+                #Only results that are still available (or to come) can be copied. Results are stored before their
+                #representative leaves "pending", so checking in this order never misses one
+                holder = state['pending'].get(match[0])
+                if holder is None and match[0] in state['results']:
+                    holder = {'result': state['results'][match[0]]}
+                match = (match[0], match[1], holder) if holder is not None else None
+            if match is None:
+                state['pending'][position] = dict()
+            matches.append((position, match))
+
+        representatives = [article for article, (_, match) in zip(articles, matches) if match is None]
+        print("\nRunning models on", len(representatives), "of", len(articles), "articles (the rest are near-duplicates)")
+        return articles, representatives, matches
+
+    def copy_near_duplicates_results(self, articles, matches, representatives_results):
+        #Second half of "inference_on_representatives": results of all the articles returned by "find_near_duplicates",
+        #from those of the representatives. Batches must be given in the order in which they were found
+        state = self.near_duplicates
+        representatives_results = iter(representatives_results)
+
+        final_results = []
+        for article, (position, match) in zip(articles, matches):
+            if match is None:
+                result = next(representatives_results)
+                state['results'][position] = result
+                state['pending'].pop(position)['result'] = result
+            else:
+                _, similarity, holder = match
+                result = dict(holder['result'])
+                result['filename'] = article['filename']
+                result.pop('date', None)
+                if article.get('date') is not None:
+                    result['date'] = article['date']
+                result['near_duplicate_of'] = holder['result']['filename']
+                result['near_duplicate_similarity'] = similarity
+            final_results.append(result)
+
+        while len(state['results']) > state['max_cached_results']:
+            state['results'].popitem(last=False)
+
+        return final_results
+
+    def __call__(self, path, isPath=True, modulesToLoad=['*'], exclude_problematic_articles=False, near_duplicate_threshold=None):
         if isPath and not os.path.isdir(path):
             print("Path does not exist!")
             return
@@ -242,20 +649,250 @@ class DroughtClassifier:
             articles = load_articles_from_folder(path)
         else:
             articles = path
+
+        self.set_article_tokens_cache_size(len(articles))
         
-        problems = self.detect_problems_with_articles(articles)
-        problems.extend(self.detect_repeated_articles(articles))
+        problems, exclude_articles = self.find_problematic_articles(articles)
 
         self.problematic_articles = problems
         
         self.exclude_problematic_articles = exclude_problematic_articles
 
-        #Make a list of the names for excluded articles; we don't include here those that have no headlines,
-        #as although the headline for a specific article could be empty, the body of that article could still
-        #contain worthwile information
-        exclude_articles = list(set([article for article, problem in problems if problem != 'HEADLINE_TOO_SHORT']))
+        self.reset_sentence_dedup_stats()
+
+        self.start_near_duplicates_detection(near_duplicate_threshold,max_cached_results=len(articles))
         
-        return self.inference(articles,modulesToLoad,exclude_articles)
+        results = self.inference_on_representatives(list(articles),modulesToLoad,exclude_articles)
+        self.discard_article_tokens(articles)
+        return results
+
+    def stream(self, source, chunk_size=1000, modulesToLoad=['*'], exclude_problematic_articles=False, near_duplicate_threshold=None):
+        #Streaming version of __call__: articles are read lazily from "source" (a folder, a TAR file, or
+        #any iterable of articles) and pushed through the whole pipeline in chunks of "chunk_size" articles.
+        #For each chunk, the list of its results is yielded as soon as it is finished, so memory use depends
+        #on the chunk size, not on the size of the corpus. Results are the same as those of __call__:
+        #repeated articles are detected across chunks, and every article is otherwise processed on its own.
+        #
+        #Example:
+        #  for results in classifier.stream(path_to_folder_with_jsons, chunk_size=500):
+        #      ...
+
+        articles = iter_articles(source)
+
+        self.problematic_articles = []
+        self.exclude_problematic_articles = exclude_problematic_articles
+        self.reset_sentence_dedup_stats()
+
+        self.start_near_duplicates_detection(near_duplicate_threshold)
+        self.set_article_tokens_cache_size(chunk_size)
+
+        seen_bodies = dict()
+
+        while True:
+            chunk = list(itertools.islice(articles, chunk_size))
+            if len(chunk) == 0:
+                break
+
+            problems, exclude_articles = self.find_problematic_articles(chunk,seen_bodies)
+            self.problematic_articles.extend(problems)
+
+            results = self.inference_on_representatives(list(chunk),modulesToLoad,exclude_articles)
+            self.discard_article_tokens(chunk)
+            yield results
+
+        return
+
+    def run_pipelined(self, source, chunk_size=1000, modulesToLoad=['*'], exclude_problematic_articles=False, queue_size=2, split_workers=1, near_duplicate_threshold=None):
+        #Same as "stream" (same input, output and results), but pipeline stages are run concurrently: each
+        #stage runs in its own worker thread, connected to the next one by a bounded queue of "queue_size"
+        #chunks. Loading, problem checks and sentence splitting of the next chunks thus overlap with model
+        #inference over the current one. Once the run is over, a per-stage utilisation report is printed
+        #(and kept in "self.pipeline_report") to show which stage is the bottleneck.
+        #"split_workers" sets the number of threads used for sentence splitting; each of them runs its own copy of
+        #the spaCy pipeline (loaded on first use), since a pipeline must not be run by several threads at once.
+
+        #Load everything upfront, so that worker threads never race to load a same model
+        self.load_modules(modulesToLoad)
+
+        self.problematic_articles = []
+        self.exclude_problematic_articles = exclude_problematic_articles
+        self.reset_sentence_dedup_stats()
+        #Tokens are kept from the problem detection step to the binary stage, with up to two queues in between
+        self.set_article_tokens_cache_size(chunk_size * (2 * queue_size + 3))
+        self.start_near_duplicates_detection(near_duplicate_threshold)
+
+        seen_bodies = dict()
+
+        def read_chunks():
+            articles = iter_articles(source)
+            while True:
+                chunk = list(itertools.islice(articles, chunk_size))
+                if len(chunk) == 0:
+                    return
+                yield chunk
+
+        def check_problems(chunk):
+            problems, exclude_articles = self.find_problematic_articles(chunk,seen_bodies)
+            self.problematic_articles.extend(problems)
+            if self.near_duplicates is not None:
+                #Models are only run on representatives; the results of the rest are copied once the results of the
+                #chunk come out of the pipeline, in input order (see below)
+                articles, representatives, matches = self.find_near_duplicates(list(chunk),exclude_articles)
+                batch = self.start_inference_batch(representatives,modulesToLoad,[])
+                batch['near_duplicates'] = (articles, matches)
+            else:
+                batch = self.start_inference_batch(list(chunk),modulesToLoad,exclude_articles)
+            batch['chunk'] = chunk
+            return batch
+
+        def gather_results(batch):
+            results = self.gather_results(batch)
+            self.discard_article_tokens(batch['chunk'])
+            return batch.get('near_duplicates'), results
+
+        executor = PipelinedExecutor([
+            ('problems', check_problems, 1),    #Keeps state across chunks (repeated articles): single worker
+            ('keyword', self.run_keyword_stage, 1),
+            ('binary', self.run_binary_stage, 1),
+            ('sentence_split', self.run_sentence_split_stage, split_workers),
+            ('drought_impacts', self.run_drought_impacts_stage, 1),
+            ('ner_loc', self.run_ner_loc_stage, 1),
+            ('results', gather_results, 1)
+        ], queue_size=queue_size)
+
+        for near_duplicates, results in executor.run(read_chunks()):
+            if near_duplicates is not None:
+                articles, matches = near_duplicates
+                results = self.copy_near_duplicates_results(articles,matches,results)
+            self.finish_batch()
+            yield results
+
+        self.pipeline_report = executor.report()
+        print(executor.format_report())
+
+        return
+
+    def run_checkpointed(self, source, run_dir, chunk_size=1000, modulesToLoad=['*'], exclude_problematic_articles=False, rerun_stages=[], near_duplicate_threshold=None):
+        #Same as "stream" (same input, output and results), but the output of every stage is stored in "run_dir" for
+        #each chunk, as soon as it is done (see checkpoints.py). Running it again with the same "run_dir" (e.g. after a
+        #crash) reuses every stored output, and only runs what is missing. Stages in "rerun_stages" are run again
+        #(along with the stages that depend on them), on top of the stored outputs of the other ones; e.g. after
+        #updating the gazetteers:
+        #
+        #  for results in classifier.run_checkpointed(path, run_dir, rerun_stages=['ner_loc']):
+        #      ...
+        #
+        #Stage names: 'problems', 'keyword', 'binary', 'sentence_split', 'drought_impacts', 'ner_loc'
+
+        checkpoint = RunCheckpoint(run_dir, {'modulesToLoad': modulesToLoad, 'exclude_problematic_articles': exclude_problematic_articles,
+                                             'ner_engine': self.ner_engine}, rerun_stages)
+
+        articles = iter_articles(source)
+
+        self.problematic_articles = []
+        self.exclude_problematic_articles = exclude_problematic_articles
+        self.reset_sentence_dedup_stats()
+        self.set_article_tokens_cache_size(chunk_size)
+        self.start_near_duplicates_detection(near_duplicate_threshold)
+
+        seen_bodies = dict()
+        position = 0
+
+        try:
+            while True:
+                chunk = list(itertools.islice(articles, chunk_size))
+                if len(chunk) == 0:
+                    break
+
+                keys = checkpoint.article_keys(chunk, position)
+                position += len(chunk)
+
+                #Problems with articles
+                articles_problems = checkpoint.get('problems', keys)
+                if articles_problems is None:
+                    problems, _ = self.find_problematic_articles(chunk,seen_bodies)
+                    articles_problems = [[problem for problem in problems if problem[0] == article['filename']] for article in chunk]
+                    checkpoint.put('problems', keys, articles_problems)
+                else:
+                    #Repeated articles in the next chunks are still found against the bodies of this one
+                    self.detect_repeated_articles(chunk,seen_bodies)
+                problems = list(dict.fromkeys([tuple(problem) for article_problems in articles_problems for problem in article_problems]))
+                self.problematic_articles.extend(problems)
+
+                if self.near_duplicates is not None:
+                    #Near-duplicates are found again on every run (it is fast); stored outputs are those of each
+                    #article, so they stay valid whatever the threshold
+                    chunk_articles, representatives, matches = self.find_near_duplicates(list(chunk),self.get_excluded_articles(problems))
+                    batch = self.start_inference_batch(representatives,modulesToLoad,[])
+                else:
+                    batch = self.start_inference_batch(list(chunk),modulesToLoad,self.get_excluded_articles(problems))
+                kept_articles = set([id(article) for article in batch['articles']])
+                keys = [key for article, key in zip(chunk, keys) if id(article) in kept_articles]
+
+                #NER needs the spaCy sentences of the articles, which are not stored, so sentences are split again whenever it has to run
+                ner_must_run = self.is_stage_enabled(batch,'ner_loc') and not checkpoint.has('ner_loc',keys)
+
+                for stage, run_stage in [('keyword', self.run_keyword_stage),
+                                         ('binary', self.run_binary_stage),
+                                         ('sentence_split', self.run_sentence_split_stage),
+                                         ('drought_impacts', self.run_drought_impacts_stage),
+                                         ('ner_loc', self.run_ner_loc_stage)]:
+                    if not self.is_stage_enabled(batch,stage):
+                        continue
+                    outputs = checkpoint.get(stage,keys)
+                    if outputs is not None and not (stage == 'sentence_split' and ner_must_run):
+                        self.set_stage_outputs(batch,stage,outputs)
+                    else:
+                        run_stage(batch)
+                        checkpoint.put(stage,keys,self.get_stage_outputs(batch,stage))
+
+                results = self.gather_results(batch)
+                if self.near_duplicates is not None:
+                    results = self.copy_near_duplicates_results(chunk_articles,matches,results)
+                self.discard_article_tokens(chunk)
+                self.finish_batch()
+                yield results
+        finally:
+            checkpoint.close()
+
+        return
+
+    def is_stage_enabled(self, batch, stage):
+        #Sentence splitting is always run; other stages, only if selected in "modulesToLoad"
+        return stage == 'sentence_split' or batch['runAll'] or stage in batch['modulesToLoad']
+
+    def get_stage_outputs(self, batch, stage):
+        #Output of a stage for each article of a batch, as JSON-serializable values (see "run_checkpointed")
+        num_articles = len(batch['articles'])
+        if stage == 'keyword':
+            return [batch['results_keyword'][i] for i in range(num_articles)]
+        if stage == 'binary':
+            return list(batch['results_binary'])
+        if stage == 'sentence_split':
+            sentences = {positive_idx: sents for positive_idx, sents, _, _ in batch['positives_sentences']}
+            return [sentences.get(i) for i in range(num_articles)]
+        if stage == 'drought_impacts':
+            return [batch['impacts'][i] if i in batch['impacts'] else None for i in range(num_articles)]
+        if stage == 'ner_loc':
+            return [batch['locations'][i] if i in batch['locations'] else None for i in range(num_articles)]
+        raise ValueError("Unknown stage: " + str(stage))
+
+    def set_stage_outputs(self, batch, stage, outputs):
+        #Inverse of "get_stage_outputs": restores the stored output of a stage into a batch
+        if stage == 'keyword':
+            batch['results_keyword'] = {i: output for i, output in enumerate(outputs)}
+        elif stage == 'binary':
+            batch['results_binary'] = outputs
+        elif stage == 'sentence_split':
+            #Stored sentences have neither a spaCy Doc nor Spans (only NER uses them)
+            batch['positives_sentences'] = [(i, sents, None, None) for i, sents in enumerate(outputs) if sents is not None]
+        elif stage == 'drought_impacts':
+            batch['impacts'] = defaultdict(list, {i: output for i, output in enumerate(outputs) if output is not None})
+        elif stage == 'ner_loc':
+            batch['locations'] = defaultdict(list, {i: [tuple(location) for location in output] for i, output in enumerate(outputs) if output is not None})
+        else:
+            raise ValueError("Unknown stage: " + str(stage))
+        return batch
 
     def write_list_of_problematic_articles_to_file(self,filepath):
         with open(filepath,'w') as f:
@@ -263,6 +900,11 @@ class DroughtClassifier:
                 f.write(problem[0] + '\t' + problem[1] + '\n')
         return
 
+    def regional_rollup(self,predictions):
+        #Counts of articles (and of articles per drought impact) for each province,
+        #autonomous community and river basin mentioned in the predictions
+        return self.ner_location.rollup_by_region(predictions)
+
     """
     OUTPUT FUNCTIONS (FOR BETTER READABILITY OF RESULTS)
     """
@@ -280,41 +922,9 @@ class DroughtClassifier:
             test3.json  1   1   0   0   0
         """
 
-        with open(file,'w',encoding='utf-8') as f:
-            f.write('Filename\tDrought\tAgricultura\tGanadería\tHídricos\tEnergético\n')
-            for prediction in predictions:
-                impacts_str = ''
-                filename = prediction['filename']
-                drought = 1 if prediction['drought'] == True else 0
-
-                f.write(filename + '\t' + str(drought) + '\t')
-
-                if drought == 0:
-                    f.write('0\t0\t0\t0\n')
-                else:
-                    impacts = prediction['impacts']
-
-                    if 'Agricultura' in impacts:
-                        f.write('1\t')
-                    else:
-                        f.write('0\t')
-
-                    if 'Ganadería' in impacts:
-                        f.write('1\t')
-                    else:
-                        f.write('0\t')
-
-                    if 'Recursos hídricos' in impacts:
-                        f.write('1\t')
-                    else:
-                        f.write('0\t')
-
-                    if 'Energético' in impacts:
-                        f.write('1')
-                    else:
-                        f.write('0')
-
-                    f.write('\n')
+        #"predictions" can be any iterable of results: rows are written as they come
+        with ImpactsTSVWriter(file) as writer:
+            writer.write_all(predictions)
         return
 
     def write_locations_to_text_file(self,predictions,file,include_and_simplify_coordinates=False):
@@ -346,19 +956,8 @@ class DroughtClassifier:
         (although this will require you to process the data manually at a later step).
         """
         
-        with open(file,'w',encoding='utf-8') as f:
-            f.write('Filename\tLocation\tType\tLatitude\tLongitude\n')
-            for prediction in predictions:
-                for location, metadata in prediction['locations'].items():
-                        f.write(prediction['filename'] + '\t' + location + '\t' + metadata['type'])
-                        if include_and_simplify_coordinates:
-                            if metadata['type'] != 'UNK':
-                                f.write('\t' + str(metadata['coordinates_centroid_values']['latitude']) + '\t' + str(metadata['coordinates_centroid_values']['longitude']) + '\n')
-                            else:
-                                f.write('\t0\t0\n')
-                        else:
-                            f.write('\n')
-
+        with LocationsTSVWriter(file,include_coordinates=include_and_simplify_coordinates) as writer:
+            writer.write_all(predictions)
         return
     
     def dump_toponyms_data_to_json_file(self,predictions,file):
@@ -396,18 +995,76 @@ class DroughtClassifier:
 
         import json
 
-        with open(file,'w',encoding='utf-8') as f:
-            formatted_output_dictionary_list = {}
-            for prediction in predictions:
+        #Written article after article, instead of building the whole dictionary first
+        with open(file,'w',encoding='utf-8',buffering=WRITE_BUFFER_SIZE) as f:
+            f.write('{')
+            for i, prediction in enumerate(predictions):
                 current_formatted_output_dictionary = {}
-                
-                for location, metadata in prediction['locations'].items():
-                    current_formatted_output_dictionary[location] = {'type': metadata[type],
-                                                                     'coordinates': metadata['coordinates']}
 
-                formatted_output_dictionary_list[prediction['filename']] = current_formatted_output_dictionary
+                for toponyms, sentence_metadata in prediction['locations']:
+                    for location, metadata in zip(toponyms, sentence_metadata):
+                        current_formatted_output_dictionary[location] = {'type': metadata['type'],
+                                                                         'coordinates': metadata['coordinates']}
 
-            json.dump(formatted_output_dictionary_list,f,ensure_ascii=False)
+                f.write((', ' if i > 0 else '') + json.dumps(prediction['filename'],ensure_ascii=False) + ': ' + json.dumps(current_formatted_output_dictionary,ensure_ascii=False,default=to_json_value))
+            f.write('}')
 
         return
-    
+
+    def write_results_to_jsonl_file(self,predictions,file,geometries_file=None,coordinate_precision=None):
+
+        """
+        OUTPUT FORMAT:
+            JSON Lines: one result per line, as described in OUTPUT_FORMAT.md, except that the
+            'coordinates' of every location are replaced by a 'geometry_id'. Every distinct geometry
+            is written once, to 'geometries_file' (default: FILE.geometries.jsonl), one per line:
+
+            {"id": 0, "geometry": {"type": "LineString", "coordinates": [[-1.87, 42.12], ...]}}
+            {"id": 1, "geometry": {"latitude": 41.65, "longitude": -0.88}}
+
+            'coordinate_precision' rounds coordinates to that number of decimals (e.g. 5, about 1 m).
+            'predictions' can be any iterable of results (e.g. the chunks of 'stream', chained), which
+            are written as they come.
+        """
+
+        with JSONLResultWriter(file,geometries_path=geometries_file,coordinate_precision=coordinate_precision) as writer:
+            writer.write_all(predictions)
+        return writer.geometries.stats
+
+    def write_results_to_parquet(self,predictions,folder,row_group_size=10000,coordinate_precision=None):
+
+        """
+        OUTPUT FORMAT:
+            Three Apache Parquet tables in 'folder' (see seqia/parquet_export.py):
+            articles.parquet (filename, drought and impact flags), locations.parquet (one row per
+            location, with its article, sentence, type, centroid and geometry id) and geometries.parquet
+            (every distinct geometry once, in GeoParquet/WKB). Requires pyarrow.
+
+            'predictions' can be any iterable of results, which are written in row groups of
+            'row_group_size' rows as they come.
+        """
+
+        from . parquet_export import ParquetResultWriter
+
+        with ParquetResultWriter(folder,row_group_size=row_group_size,coordinate_precision=coordinate_precision) as writer:
+            writer.write_all(predictions)
+        return
+
+    def write_results_to_sqlite(self,predictions,file,batch_size=1000,coordinate_precision=None,label=None):
+
+        """
+        OUTPUT FORMAT:
+            SQLite database with articles, impacts, sentences, locations and geometries tables,
+            indexed by impact, location type, toponym and region (see seqia/result_store.py).
+            The database can already exist: results are added to it, and articles that were already
+            in it (same filename) have their results replaced.
+
+            'predictions' can be any iterable of results, which are inserted in transactions of
+            'batch_size' articles as they come.
+        """
+
+        from . result_store import SQLiteResultStore
+
+        with SQLiteResultStore(file,batch_size=batch_size,coordinate_precision=coordinate_precision,label=label) as store:
+            store.write_all(predictions)
+        return
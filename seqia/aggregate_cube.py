@@ -0,0 +1,184 @@
+"""
+Time-bucketed aggregate cube of drought articles, for monitoring dashboards.
+
+The cube counts articles by time bucket (day, week and month of their publication
+date, see JSON_mapping in article_load.py) x region (province, autonomous
+community and river basin of their locations) x drought impact. It is updated
+result by result, as they stream out of DroughtClassifier, and saved to (and loaded
+from) a small JSON file, so that a dashboard reads pre-aggregated numbers instead
+of rescanning every result, and a later run only adds its own articles.
+
+Every cell holds the number of articles about drought (classified as such, or all
+of them if the binary classifier was skipped) in that bucket and region, for every
+impact ('*' for all articles, regardless of their impacts). As in
+NERLocation.rollup_by_region, an article mentioning several towns of the same
+province is counted once for that province. Region '*' (layer '*') counts every
+article of the bucket, wherever it is located. Articles without a publication date
+are only counted in "undated_articles".
+
+    cube = DroughtImpactCube.load('cube.json')     #Empty cube if the file does not exist
+    for results in classifier.stream(articles):
+        cube.add_all(results)
+    cube.save('cube.json')
+    cube.query('month', layer='province', impact='Agricultura')
+
+Results that are added again (e.g. by merging the same sharded run twice) would be
+counted twice. To avoid that, a run can build its own cube and fold it into the
+saved one with "absorb", under a key that identifies the run: absorbing the same key
+again replaces the previous counts of that run instead of adding to them.
+
+    run_cube = DroughtImpactCube()
+    run_cube.add_all(results)
+    cube.absorb('path/to/run', run_cube)
+"""
+
+import json
+import os
+from datetime import date
+
+#Layers of the spatial join of NERLocation (see SPATIAL_LAYERS in ner_loc.py)
+LAYERS = ['province', 'community', 'river_basin']
+
+GRANULARITIES = ['day', 'week', 'month']
+
+def get_time_buckets(day, granularities=GRANULARITIES):
+    #Buckets of a "YYYY-MM-DD" date: "YYYY-MM-DD" (day), ISO week "YYYY-Www" (week) and "YYYY-MM" (month)
+    buckets = []
+    for granularity in granularities:
+        if granularity == 'day':
+            buckets.append((granularity, day))
+        elif granularity == 'week':
+            year, week, _ = date.fromisoformat(day).isocalendar()
+            buckets.append((granularity, '%d-W%02d' % (year, week)))
+        elif granularity == 'month':
+            buckets.append((granularity, day[:7]))
+        else:
+            raise ValueError("Unknown granularity: " + str(granularity) + " (expected one of: " + ', '.join(GRANULARITIES) + ")")
+    return buckets
+
+class DroughtImpactCube:
+
+    def __init__(self, granularities=GRANULARITIES, only_drought_articles=True):
+        self.granularities = list(granularities)
+        self.only_drought_articles = only_drought_articles
+        #(granularity, bucket, layer, region, impact) -> number of articles
+        self.cells = dict()
+        self.stats = {'articles': 0, 'undated_articles': 0}
+        #Key of each absorbed cube -> its cells and stats (see "absorb")
+        self.sources = dict()
+
+    def get_regions(self, result):
+        #Distinct (layer, region) pairs of the locations of an article, plus ('*', '*')
+        regions = {('*', '*')}
+        for _, sentence_metadata in result.get('locations') or []:
+            for metadata in sentence_metadata:
+                for layer in LAYERS:
+                    if metadata.get(layer) is not None:
+                        regions.add((layer, metadata[layer]))
+        return regions
+
+    def add(self, result, sign=1):
+        #Adds the article of a result to the cube (or removes it, with sign=-1, e.g. before adding new results
+        #of an article that was already counted)
+        if self.only_drought_articles and result.get('drought') is False:
+            return
+        if result.get('date') is None:
+            self.stats['undated_articles'] += sign
+            return
+
+        self.stats['articles'] += sign
+        impacts = ['*'] + list(dict.fromkeys(result.get('impacts') or []))
+        regions = self.get_regions(result)
+        for granularity, bucket in get_time_buckets(result['date'], self.granularities):
+            for layer, region in regions:
+                for impact in impacts:
+                    key = (granularity, bucket, layer, region, impact)
+                    count = self.cells.get(key, 0) + sign
+                    if count == 0:
+                        self.cells.pop(key, None)
+                    else:
+                        self.cells[key] = count
+        return
+
+    def add_all(self, results):
+        for result in results:
+            self.add(result)
+        return
+
+    def remove(self, result):
+        self.add(result, sign=-1)
+        return
+
+    def merge(self, other, sign=1):
+        #Adds the counts of another cube (e.g. built by another worker), or subtracts them, with sign=-1
+        self.merge_counts(other.cells, other.stats, sign)
+        return
+
+    def merge_counts(self, cells, stats, sign=1):
+        for key, count in cells.items():
+            count = self.cells.get(key, 0) + sign * count
+            if count == 0:
+                self.cells.pop(key, None)
+            else:
+                self.cells[key] = count
+        for key, count in stats.items():
+            self.stats[key] = self.stats.get(key, 0) + sign * count
+        return
+
+    def absorb(self, source, other):
+        #Adds the counts of another cube as those of "source" (e.g. the work folder of a sharded run), replacing
+        #the counts previously absorbed from that same source, if any
+        if source in self.sources:
+            self.merge_counts(self.sources[source]['cells'], self.sources[source]['stats'], sign=-1)
+        self.merge(other)
+        self.sources[source] = {'cells': dict(other.cells), 'stats': dict(other.stats)}
+        return
+
+    def query(self, granularity='month', layer='*', region=None, impact='*', start=None, end=None):
+        #Sorted list of (bucket, region, number of articles) for a granularity, layer and impact. "region"
+        #restricts it to one region; "start" and "end" are inclusive bounds on buckets (e.g. '2022-01', '2022-12')
+        rows = []
+        for (cell_granularity, bucket, cell_layer, cell_region, cell_impact), count in self.cells.items():
+            if cell_granularity != granularity or cell_layer != layer or cell_impact != impact:
+                continue
+            if region is not None and cell_region != region:
+                continue
+            if (start is not None and bucket < start) or (end is not None and bucket > end):
+                continue
+            rows.append((bucket, cell_region, count))
+        return sorted(rows)
+
+    def to_rows(self):
+        #Every cell as a dictionary (e.g. for pandas.DataFrame)
+        return [{'granularity': granularity, 'bucket': bucket, 'layer': layer, 'region': region, 'impact': impact, 'articles': count}
+                for (granularity, bucket, layer, region, impact), count in sorted(self.cells.items())]
+
+    ##########
+    ## FILE ##
+    #########
+    def save(self, path):
+        #Written to a temporary file and renamed, so that readers never see a partially written cube
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'granularities': self.granularities, 'only_drought_articles': self.only_drought_articles,
+                       'stats': self.stats, 'cells': [list(key) + [count] for key, count in sorted(self.cells.items())],
+                       'sources': {source: {'stats': counts['stats'], 'cells': [list(key) + [count] for key, count in sorted(counts['cells'].items())]}
+                                   for source, counts in sorted(self.sources.items())}},
+                      f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        return
+
+    @classmethod
+    def load(cls, path, granularities=GRANULARITIES, only_drought_articles=True):
+        #Cube saved in "path", or an empty one (with the given options) if the file does not exist
+        if not os.path.isfile(path):
+            return cls(granularities, only_drought_articles)
+
+        with open(path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        cube = cls(saved['granularities'], saved['only_drought_articles'])
+        cube.stats = saved['stats']
+        cube.cells = {tuple(cell[:5]): cell[5] for cell in saved['cells']}
+        #Cubes saved by older versions have no sources
+        cube.sources = {source: {'stats': counts['stats'], 'cells': {tuple(cell[:5]): cell[5] for cell in counts['cells']}}
+                        for source, counts in saved.get('sources', dict()).items()}
+        return cube
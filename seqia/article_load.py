@@ -4,15 +4,53 @@ import json
 from tqdm import tqdm
 import tarfile
 import os
+import re
 import tempfile
+from datetime import datetime, timezone
 
 #Mapping between expected JSON field values and the ones in custom files
-#(Can be overridden via an external file)
+#(Can be overridden via an external file). The publication date is optional:
+#articles without it (or with a date that can not be parsed) simply have no date
 JSON_mapping = {
     'body': 'articleBody',
-    'headline': 'headline'
+    'headline': 'headline',
+    'date': 'datePublished'
 }
 
+#Formats of publication dates other than ISO 8601 (e.g. "2022-08-05T10:30:00+02:00")
+DATE_FORMATS = ['%d/%m/%Y', '%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S', '%d-%m-%Y', '%Y/%m/%d', '%Y%m%d']
+
+def parse_publication_date(value):
+    #Returns the date as "YYYY-MM-DD" (in the time zone of the date itself, if it has one), or None
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        #Unix timestamp, in seconds or milliseconds
+        try:
+            return datetime.fromtimestamp(value / 1000 if value > 1e11 else value, tz=timezone.utc).date().isoformat()
+        except (OverflowError, OSError, ValueError):
+            return None
+
+    value = str(value).strip()
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).date().isoformat()
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            pass
+
+    #ISO-like dates followed by anything else
+    match = re.match(r'(\d{4})-(\d{2})-(\d{2})', value)
+    if match is not None:
+        try:
+            return datetime(int(match.group(1)), int(match.group(2)), int(match.group(3))).date().isoformat()
+        except ValueError:
+            pass
+    return None
+
 #Function to load an article from a JSON file (uses custom mapping of JSON fields if defined)
 def load_article_from_json_file(f,filename):
     
@@ -35,6 +73,11 @@ def load_article_from_json_file(f,filename):
         except:
             article['body'] = ''
 
+        if JSON_mapping.get('date') is not None and isinstance(art_json, dict) and JSON_mapping['date'] in art_json:
+            date = parse_publication_date(art_json[JSON_mapping['date']])
+            if date is not None:
+                article['date'] = date
+
         article['loaded'] = True
     except:
         article['headline'] = ''
@@ -43,45 +86,72 @@ def load_article_from_json_file(f,filename):
     
     return article
 
-#Functions to load articles from either a folder or a TAR file
-def load_articles_from_folder(path):
+#Functions to load articles from either a folder or a TAR file. The "iter_" versions are
+#generators that yield articles one at a time, without keeping the whole corpus in memory
+def load_article_from_path(path):
+    with open(path,'rb') as f:
+        #Workaround to fix encoding issues: we read each file as a binary
+        #file, then decode it to UTF-8. This won't affect well-formatted
+        #Unicode files, but it will convert to a desired format an ISO-encoded
+        #file. Each time we read this file, we create a temporary file, which
+        #will serve as the input to the reading function below. This way, we
+        #can cleanly keep the existing code without many modifications
+        tp = tempfile.TemporaryFile(mode='r+',encoding='utf-8')
+        tp.write(f.read().decode('utf-8','ignore'))
+        tp.seek(0)
+        article = load_article_from_json_file(tp,os.path.basename(path))
+        tp.close()
+    return article
 
-    articles = []
+def iter_articles_from_folder(path):
 
     for dirpath,_,files in os.walk(path):
         for file in tqdm(files,desc='Loading articles from folder'):
             if file.endswith('.json'):
-                #with open(os.sep.join([dirpath, file]),encoding= 'utf-8') as f:
-                with open(os.sep.join([dirpath, file]),'rb') as f:
-                    #Workaround to fix encoding issues: we read each file as a binary
-                    #file, then decode it to UTF-8. This won't affect well-formatted
-                    #Unicode files, but it will convert to a desired format an ISO-encoded
-                    #file. Each time we read this file, we create a temporary file, which
-                    #will serve as the input to the reading function below. This way, we
-                    #can cleanly keep the existing code without many modifications
-                    tp = tempfile.TemporaryFile(mode='r+',encoding='utf-8')
-                    tp.write(f.read().decode('utf-8','ignore'))
-                    tp.seek(0)
-                    articles.append(load_article_from_json_file(tp,file))
-                    tp.close()
-
-    return articles
-
-def load_articles_from_tar(tar_filename):
+                yield load_article_from_path(os.sep.join([dirpath, file]))
 
-    articles = []
+def iter_articles_from_paths(paths):
+    #Yields the articles of a given list of JSON files (e.g. one shard of a corpus)
+    for path in tqdm(paths,desc='Loading articles from files'):
+        yield load_article_from_path(path)
 
-    tar = tarfile.open(tar_filename)
+def load_articles_from_folder(path):
+    return list(iter_articles_from_folder(path))
+
+def iter_articles_from_tar(tar_filename,members=None):
+    #If "members" is given, only the JSON files with those names are loaded (and reading
+    #stops as soon as all of them have been found)
+    if members is not None:
+        members = set(members)
+
+    with tarfile.open(tar_filename) as tar:
+        for file in tqdm(tar,desc='Loading articles from TAR file'):
+            if members is not None:
+                if len(members) == 0:
+                    break
+                if file.name not in members:
+                    continue
+                members.discard(file.name)
+            if file.name.endswith('.json'):
+                tp = tempfile.TemporaryFile(mode='r+',encoding='utf-8')
+                tp.write(tar.extractfile(file).read().decode('utf-8','ignore'))
+                tp.seek(0)
+                article = load_article_from_json_file(tp,file.name)
+                tp.close()
+                yield article
 
-    for file in tqdm(tar.getmembers(),desc='Loading articles from TAR file'):
-        if file.name.endswith('.json'):
-            tp = tempfile.TemporaryFile(mode='r+',encoding='utf-8')
-            tp.write(tar.extractfile(file.name).read().decode('utf-8','ignore'))
-            tp.seek(0)
-            articles.append(load_article_from_json_file(tp,file.name))
-            tp.close()
-    
-    return articles
+def load_articles_from_tar(tar_filename):
+    return list(iter_articles_from_tar(tar_filename))
+
+def iter_articles(source):
+    #Yields articles from a folder, a TAR file or any iterable of already loaded articles
+    if isinstance(source, str):
+        if os.path.isdir(source):
+            return iter_articles_from_folder(source)
+        if os.path.isfile(source) and tarfile.is_tarfile(source):
+            return iter_articles_from_tar(source)
+        raise ValueError("Path is neither a folder nor a TAR file: " + source)
+    return iter(source)
 
 #Function for loading mapping for custom article JSON files (if defined)
 def load_custom_json_mapping(mapping_file):
@@ -91,5 +161,5 @@ def load_custom_json_mapping(mapping_file):
             if line[-1] == '\n':
                 line = line[:-1]
             line = line.split('\t')
-        mapping[line[0]] = line[1]
+            mapping[line[0]] = line[1]
     return mapping
@@ -1,8 +1,97 @@
 
 import os
+import threading
 from transformers import AutoModelForSequenceClassification, AutoTokenizer, TrainingArguments, Trainer
 import numpy as np
 from . dataset import DroughtDataset
+from . metrics import metrics
+
+class ArticleTokenizer:
+
+    #Tokenizes the texts seen by the binary classifier ("headline~body") once, and keeps the result for
+    #binary inference. The length checks of the problem detection step measure a different text
+    #("filename~body"), which is encoded in the same batches, so that the tokenizer is loaded once and
+    #every text is encoded in a single pass. Texts are encoded in batches with the fast (Rust) tokenizer,
+    #which splits each batch across threads. Tokens are kept untruncated, and truncated and padded to the
+    #input size of the model only when the model needs them
+
+    def __init__(self,model_name='PlanTL-GOB-ES/longformer-base-4096-bne-es',batch_size=256,max_cache_size=100000):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        self.batch_size = batch_size
+        self.max_cache_size = max_cache_size
+
+        #Text -> token ids (with special tokens), as a NumPy array
+        self.cache = dict()
+        self.lock = threading.Lock()
+
+        return
+
+    def get_text(self,article):
+        return str(article['headline'] + '~' + article['body'])
+
+    def get_length_text(self,article):
+        #Text whose length is checked by the problem detection step
+        return str(article['filename'] + '~' + article['body'])
+
+    def tokenize(self,articles,extra_texts=[]):
+        #Returns the token ids of each article, tokenizing only those that are not already cached, and the
+        #token ids of each of "extra_texts" (which are not cached), encoded in the same batches
+        texts = [self.get_text(article) for article in articles]
+
+        #The cache can be shared by pipeline stages running in different threads (see "run_pipelined")
+        with self.lock:
+            token_ids = {text: self.cache[text] for text in texts if text in self.cache}
+
+        missing_texts = list(dict.fromkeys([text for text in texts if text not in token_ids]))
+        metrics.count('cache_hits', len(texts) - len(missing_texts), cache='article_tokens')
+        metrics.count('cache_misses', len(missing_texts), cache='article_tokens')
+        texts_to_encode = list(dict.fromkeys(missing_texts + [text for text in extra_texts if text not in token_ids]))
+        for i in range(0, len(texts_to_encode), self.batch_size):
+            batch = texts_to_encode[i:i+self.batch_size]
+            encodings = self.tokenizer(batch, add_special_tokens=True, truncation=False, verbose=False)
+            for text, input_ids in zip(batch, encodings['input_ids']):
+                token_ids[text] = np.asarray(input_ids, dtype=np.int32)
+
+        with self.lock:
+            for text in missing_texts:
+                self.cache[text] = token_ids[text]
+            #Bound memory use, in case some articles are never used by the model (e.g. they are excluded)
+            while len(self.cache) > self.max_cache_size:
+                del self.cache[next(iter(self.cache))]
+
+        return [token_ids[text] for text in texts], [token_ids[text] for text in extra_texts]
+
+    def get_lengths(self,articles):
+        #Number of tokens of the "filename~body" text of each article, not counting special tokens. The texts
+        #seen by the binary classifier are tokenized (and cached) along with them
+        num_special_tokens = self.tokenizer.num_special_tokens_to_add()
+        with metrics.stage('problems.tokenize', items=len(articles)) as stage:
+            _, length_token_ids = self.tokenize(articles, [self.get_length_text(article) for article in articles])
+            lengths = [len(token_ids) - num_special_tokens for token_ids in length_token_ids]
+            stage.add(tokens=sum(lengths))
+        return lengths
+
+    def encode(self,articles,max_length):
+        #Model inputs for the articles: the same as the tokenizer's output with truncation and padding to "max_length"
+        #(truncation drops the last tokens of the text, but keeps the closing special token)
+        token_ids, _ = self.tokenize(articles)
+
+        input_ids = np.full((len(token_ids), max_length), self.tokenizer.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(token_ids), max_length), dtype=np.int64)
+        for i, ids in enumerate(token_ids):
+            if len(ids) > max_length:
+                ids = np.concatenate([ids[:max_length-1], ids[-1:]])
+            input_ids[i, :len(ids)] = ids
+            attention_mask[i, :len(ids)] = 1
+
+        return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+    def discard(self,articles):
+        #Drops the cached tokens of articles that will not be needed anymore
+        with self.lock:
+            for article in articles:
+                self.cache.pop(self.get_text(article), None)
+        return
 
 class BinaryClassifier:
 
@@ -10,8 +99,12 @@ class BinaryClassifier:
     binary_base_model_name = 'PlanTL-GOB-ES/longformer-base-4096-bne-es'
 
     #Constructor
-    def __init__(self,modelPath=''):
-        self.tokenizer = self.load_binary_tokenizer()
+    def __init__(self,modelPath='',article_tokenizer=None):
+        #Tokens are shared with the problem detection step through "article_tokenizer" (an ArticleTokenizer)
+        if article_tokenizer is None:
+            article_tokenizer = ArticleTokenizer(self.binary_base_model_name)
+        self.article_tokenizer = article_tokenizer
+        self.tokenizer = article_tokenizer.tokenizer
         self.model = self.load_binary_classifier(modelPath)
 
         training_args_binary = TrainingArguments(output_dir='/',auto_find_batch_size = True)
@@ -26,7 +119,7 @@ class BinaryClassifier:
     def load_binary_classifier(self,modelPath=''):
         binary = None
         if modelPath != '':
-            if os.path.isfile(modelPath + 'pytorch_model.bin'):
+            if os.path.isfile(modelPath + 'pytorch_model.bin') or os.path.isfile(modelPath + 'model.safetensors'):
                 binary = AutoModelForSequenceClassification.from_pretrained(modelPath, num_labels=2)
         else:
             binary = AutoModelForSequenceClassification.from_pretrained(os.path.join((os.path.join(os.path.dirname(os.path.realpath(__file__)), 'models')),'binary_model'), num_labels=2)
@@ -41,11 +134,13 @@ class BinaryClassifier:
 
         results = []
 
-        encodings = self.tokenizer([str(article['headline'] + '~' + article['body']) for i, article in enumerate(articles) if include_or_not_list[i] == 1],max_length=self.BINARY_MODEL_MAX_SIZE, pad_to_max_length=True,truncation=True)
+        encodings = self.article_tokenizer.encode([article for i, article in enumerate(articles) if include_or_not_list[i] == 1],self.BINARY_MODEL_MAX_SIZE)
         num_of_articles = len([i for i in range(len(articles)) if include_or_not_list[i] == 1])
         dataset = DroughtDataset(encodings, num_of_articles)
         
-        logits_binary,_,_ = self.trainer.predict(dataset)
+        with metrics.stage('binary.model', items=num_of_articles, tokens=int(encodings['attention_mask'].sum())):
+            logits_binary,_,_ = self.trainer.predict(dataset)
+        metrics.observe('batch_size', num_of_articles, stage='binary.model')
         predictions_binary = list(np.argmax(logits_binary, axis=-1))
     	
         next_positive_index = 0
@@ -0,0 +1,104 @@
+"""
+Checkpoints of pipeline runs.
+
+The output of every stage of the pipeline (problem checks, keyword and binary
+classification, sentence splitting, drought impacts and NER) is stored, for each
+article, in a SQLite database in the run directory, as soon as the stage is done
+with a chunk of articles. A run that is restarted (e.g. after a crash) reuses
+every stored output, and only runs the stages that are missing for each chunk.
+
+A stage can also be run again on purpose (e.g. NER, after updating the
+gazetteers), on top of the stored outputs of the stages it depends on: its
+stored outputs, and those of every stage that depends on it, are discarded
+first.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+from . sharded_runner import to_json_value
+
+class RunCheckpoint:
+
+    STAGES = ('problems', 'keyword', 'binary', 'sentence_split', 'drought_impacts', 'ner_loc')
+
+    #Stages whose outputs depend on the output of each stage
+    DEPENDENT_STAGES = {
+        'problems': ('keyword', 'binary', 'sentence_split', 'drought_impacts', 'ner_loc'),
+        'keyword': ('binary', 'sentence_split', 'drought_impacts', 'ner_loc'),
+        'binary': ('sentence_split', 'drought_impacts', 'ner_loc'),
+        'sentence_split': ('drought_impacts', 'ner_loc'),
+        'drought_impacts': (),
+        'ner_loc': ()
+    }
+
+    #Maximum number of keys per SQL query
+    QUERY_SIZE = 500
+
+    def __init__(self, run_dir, options, rerun_stages=()):
+        #"options" are the settings that the stored outputs depend on: restarting a run with different
+        #ones is an error. "rerun_stages" are the stages to run again (see above)
+        for stage in rerun_stages:
+            if stage not in self.STAGES:
+                raise ValueError("Unknown stage: " + str(stage) + " (stages: " + ', '.join(self.STAGES) + ")")
+
+        self.run_dir = run_dir
+        os.makedirs(run_dir, exist_ok=True)
+
+        options_path = os.path.join(run_dir, 'run.json')
+        if os.path.isfile(options_path):
+            with open(options_path, encoding='utf-8') as f:
+                if json.load(f) != json.loads(json.dumps(options)):
+                    raise ValueError("Run directory " + run_dir + " contains a run with different options")
+        else:
+            with open(options_path, 'w', encoding='utf-8') as f:
+                json.dump(options, f)
+
+        self.path = os.path.join(run_dir, 'checkpoints.sqlite')
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS outputs (stage TEXT NOT NULL, key TEXT NOT NULL, output TEXT, PRIMARY KEY (stage, key))')
+
+        discarded_stages = set()
+        for stage in rerun_stages:
+            discarded_stages.add(stage)
+            discarded_stages.update(self.DEPENDENT_STAGES[stage])
+        if len(discarded_stages) > 0:
+            with self.connection:
+                self.connection.executemany('DELETE FROM outputs WHERE stage = ?', [(stage,) for stage in discarded_stages])
+
+        return
+
+    def article_keys(self, articles, start_position):
+        #Articles are identified by their position in the corpus and a digest of their contents, so that
+        #stored outputs are never reused for a different article (e.g. if the corpus changed)
+        keys = []
+        for position, article in enumerate(articles, start_position):
+            digest = hashlib.blake2b('\0'.join([article['filename'], article['headline'], article['body']]).encode('utf-8'), digest_size=12).hexdigest()
+            keys.append(str(position) + ':' + digest)
+        return keys
+
+    def get(self, stage, keys):
+        #Stored outputs of a stage for the given articles (in the same order), or None unless all are stored
+        outputs = dict()
+        for i in range(0, len(keys), self.QUERY_SIZE):
+            query_keys = keys[i:i+self.QUERY_SIZE]
+            rows = self.connection.execute('SELECT key, output FROM outputs WHERE stage = ? AND key IN (' + ','.join(['?'] * len(query_keys)) + ')',
+                                           [stage] + query_keys).fetchall()
+            outputs.update(rows)
+        if len(outputs) < len(set(keys)):
+            return None
+        return [json.loads(outputs[key]) for key in keys]
+
+    def has(self, stage, keys):
+        return self.get(stage, keys) is not None
+
+    def put(self, stage, keys, outputs):
+        #Outputs of a chunk are stored in a single transaction: they are either all stored or none
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO outputs (stage, key, output) VALUES (?, ?, ?)',
+                                        [(stage, key, json.dumps(output, ensure_ascii=False, default=to_json_value)) for key, output in zip(keys, outputs)])
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,231 @@
+"""
+Command line interface of seqia.
+
+    seqia run path/to/folder_or_tar --output results.jsonl [--workers 16] [--threads-per-worker 4] [--resume]
+
+Distributed runs, over a shared work queue (see seqia/work_queue.py):
+
+    seqia enqueue path/to/folder_or_tar --queue queue.db --work-dir shared/work_dir [--batch-size 1000]
+    seqia worker --queue queue.db [--threads 4]    (on every machine, as many times as needed)
+    seqia status --queue queue.db
+    seqia merge --queue queue.db --output results.jsonl
+
+Local inference server, with micro-batching of concurrent requests (see seqia/server.py):
+
+    seqia serve [--port 8080] [--max-batch-size 32] [--max-wait-ms 20]
+
+See "seqia COMMAND --help" for all the options.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from . sharded_runner import ShardedRunner
+from . work_queue import open_work_queue, enqueue_corpus, run_queue_worker
+from . model_weights import default_cache_dir
+
+def run_command(args):
+    workers = args.workers
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // args.threads_per_worker)
+
+    work_dir = args.work_dir or args.output + '.shards'
+    options = pipeline_options(args)
+
+    runner = ShardedRunner(args.source, work_dir, num_shards=args.shards or 4 * workers)
+
+    start = time.perf_counter()
+    failed_shards = runner.run(options, workers=workers, threads_per_worker=args.threads_per_worker, resume=args.resume,
+                               share_memory=not args.no_shared_memory, cache_dir=args.cache_dir)
+    if len(failed_shards) > 0:
+        print("\n" + str(len(failed_shards)), "shards failed:", ', '.join([str(shard_id) for shard_id in failed_shards]))
+        print("Run the same command with --resume to retry them")
+        return 1
+
+    stats = runner.merge(args.output, problems_file=args.problems_output or args.output + '.problems.tsv',
+                         compact_geometries=args.compact_geometries, coordinate_precision=args.coordinate_precision,
+                         sqlite_output=args.sqlite_output, cube_output=args.cube_output)
+    elapsed = time.perf_counter() - start
+
+    print("\nWrote", stats['results'], "results for", stats['articles'], "articles to", args.output,
+          "(" + str(stats['problematic_articles']), "problematic articles)")
+    print("Elapsed time: %.1f s (%.1f articles/s)" % (elapsed, stats['articles'] / elapsed if elapsed > 0 else 0.0))
+    print_sentence_dedup_stats(stats)
+
+    return 0
+
+def enqueue_command(args):
+    queue = open_work_queue(args.queue)
+    plan = enqueue_corpus(queue, args.source, args.work_dir, pipeline_options(args), batch_size=args.batch_size)
+    print("Added", len(plan['shards']), "batches to", args.queue)
+    return 0
+
+def worker_command(args):
+    queue = open_work_queue(args.queue, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+    num_batches = run_queue_worker(queue, worker_id=args.worker_id, threads=args.threads, wait=not args.no_wait,
+                                   cache_dir=None if args.no_shared_memory else args.cache_dir)
+    print("\nThis worker ran", num_batches, "batches\n")
+    print(queue.format_summary())
+    return 0
+
+def status_command(args):
+    queue = open_work_queue(args.queue)
+    print(queue.format_summary())
+    for batch in queue.batches():
+        if batch['state'] == 'failed':
+            print("\nBatch", batch['id'], "failed after", batch['attempts'], "attempts:\n" + str(batch['error']))
+    return 0
+
+def merge_command(args):
+    queue = open_work_queue(args.queue)
+    failed_batches = [batch['id'] for batch in queue.batches() if batch['state'] == 'failed']
+    if len(failed_batches) > 0:
+        print(len(failed_batches), "batches failed:", ', '.join([str(batch_id) for batch_id in failed_batches]))
+        return 1
+
+    #Every batch of a run shares the same work directory: a queue with batches of several runs can not be merged at once
+    runner_configs = dict()
+    for batch in queue.batches():
+        runner_config = queue.get_payload(batch['id'])['runner']
+        runner_configs.setdefault(json.dumps(runner_config, sort_keys=True), runner_config)
+    if len(runner_configs) == 0:
+        print("No batches in queue", args.queue)
+        return 1
+    if len(runner_configs) > 1:
+        print("The queue holds batches of", len(runner_configs), "runs (work directories:",
+              ', '.join(sorted([str(config['work_dir']) for config in runner_configs.values()])) + "): can not merge them")
+        return 1
+    runner = ShardedRunner(**next(iter(runner_configs.values())))
+    stats = runner.merge(args.output, problems_file=args.problems_output or args.output + '.problems.tsv',
+                         compact_geometries=args.compact_geometries, coordinate_precision=args.coordinate_precision,
+                         sqlite_output=args.sqlite_output, cube_output=args.cube_output)
+
+    print("Wrote", stats['results'], "results for", stats['articles'], "articles to", args.output,
+          "(" + str(stats['problematic_articles']), "problematic articles)")
+    print_sentence_dedup_stats(stats)
+    print()
+    print(queue.format_summary())
+
+    return 0
+
+def print_sentence_dedup_stats(stats):
+    if stats['sentences'] > 0:
+        print("Sentences of positive articles: %d, of which %d unique (dedup ratio: %.1f%%)"
+              % (stats['sentences'], stats['unique_sentences'], 100 * (1 - stats['unique_sentences'] / stats['sentences'])))
+
+def serve_command(args):
+    from . import DroughtClassifier
+    from . server import serve
+
+    classifier = DroughtClassifier(cpu_threads=args.threads, ner_engine=args.ner_engine, sentence_split_mode=args.sentence_split_mode,
+                                   weights_cache_dir=None if args.no_shared_memory else os.path.join(args.cache_dir, 'weights'),
+                                   gazetteer_snapshot=None if args.no_shared_memory else os.path.join(args.cache_dir, 'gazetteers.pickle'))
+    serve(classifier, host=args.host, port=args.port, modulesToLoad=args.modules,
+          max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000)
+    return 0
+
+def pipeline_options(args):
+    #Options that define the results of a run: resuming a run with different ones is an error
+    return {
+        'chunk_size': args.chunk_size,
+        'modulesToLoad': args.modules,
+        'exclude_problematic_articles': args.exclude_problematic_articles,
+        'ner_engine': args.ner_engine,
+        'sentence_split_mode': args.sentence_split_mode,
+        'near_duplicate_threshold': args.near_duplicate_threshold
+    }
+
+def add_pipeline_arguments(parser):
+    parser.add_argument('--chunk-size', type=int, default=500, help='Articles per chunk within each shard (default: 500)')
+    parser.add_argument('--modules', nargs='+', default=['*'], help='Pipeline steps to run (see README; default: all)')
+    parser.add_argument('--exclude-problematic-articles', action='store_true')
+    parser.add_argument('--ner-engine', choices=['transformer', 'gazetteer'], default='transformer')
+    parser.add_argument('--sentence-split-mode', choices=['full', 'fast', 'lazy'], default='full')
+    parser.add_argument('--near-duplicate-threshold', type=float, default=None,
+                        help='Run the models once per group of near-duplicate articles with at least this similarity, within each shard or batch (default: off)')
+
+def add_shared_memory_arguments(parser):
+    parser.add_argument('--cache-dir', default=default_cache_dir(), help='Folder for memory-mapped model weights and the gazetteers snapshot (default: %(default)s)')
+    parser.add_argument('--no-shared-memory', action='store_true', help='Give every worker its own private copy of models and gazetteers')
+
+def add_output_arguments(parser):
+    parser.add_argument('--compact-geometries', action='store_true', help='Write every distinct geometry once, to OUTPUT.geometries.jsonl, and reference it by id in the results')
+    parser.add_argument('--coordinate-precision', type=int, default=None, help='Round coordinates to this number of decimals (with --compact-geometries or --sqlite-output; e.g. 5, about 1 m)')
+    parser.add_argument('--sqlite-output', default=None, help='Also add the results to this SQLite database, indexed for queries (created if needed)')
+    parser.add_argument('--cube-output', default=None, help='Also add the results to the aggregate cube (articles by date, region and impact) saved in this JSON file (created if needed)')
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='seqia', description='Drought impacts and locations from newspaper archives')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run = subparsers.add_parser('run', help='Run the pipeline over a corpus, sharded across several processes')
+    run.add_argument('source', help='Folder or TAR file with JSON articles')
+    run.add_argument('-o', '--output', required=True, help='Output JSON Lines file (one result per article, in corpus order)')
+    run.add_argument('--problems-output', default=None, help='TSV file for the list of problematic articles (default: OUTPUT.problems.tsv)')
+    run.add_argument('--workers', type=int, default=None, help='Number of worker processes, each with its own copy of the models (default: number of cores / threads per worker)')
+    run.add_argument('--threads-per-worker', type=int, default=1, help='PyTorch threads of each worker (default: 1)')
+    run.add_argument('--shards', type=int, default=None, help='Number of shards to split the corpus into (default: 4 per worker)')
+    run.add_argument('--work-dir', default=None, help='Folder for the results of each shard (default: OUTPUT.shards)')
+    run.add_argument('--resume', action='store_true', help='Resume a previous run in the work directory, running only unfinished or failed shards')
+    add_pipeline_arguments(run)
+    add_shared_memory_arguments(run)
+    add_output_arguments(run)
+    run.set_defaults(function=run_command)
+
+    enqueue = subparsers.add_parser('enqueue', help='Split a corpus into batches and add them to a work queue, for distributed runs')
+    enqueue.add_argument('source', help='Folder or TAR file with JSON articles (at the same path for every worker)')
+    enqueue.add_argument('--queue', required=True, help='Work queue: a SQLite file (.db or .sqlite) or a folder')
+    enqueue.add_argument('--work-dir', required=True, help='Folder for the results of each batch (shared by every worker)')
+    enqueue.add_argument('--batch-size', type=int, default=1000, help='Articles per batch (default: 1000)')
+    add_pipeline_arguments(enqueue)
+    enqueue.set_defaults(function=enqueue_command)
+
+    worker = subparsers.add_parser('worker', help='Run batches from a work queue until there are none left')
+    worker.add_argument('--queue', required=True)
+    worker.add_argument('--threads', type=int, default=1, help='PyTorch threads of this worker (default: 1)')
+    worker.add_argument('--worker-id', default=None, help='Name of this worker in the progress summary (default: HOST:PID)')
+    worker.add_argument('--lease-seconds', type=int, default=600, help='Time after which the batch of an unresponsive worker is given to another one (default: 600)')
+    worker.add_argument('--max-attempts', type=int, default=3, help='Times a batch is run before it is marked as failed (default: 3)')
+    worker.add_argument('--no-wait', action='store_true', help='Leave as soon as there are no pending batches, even if others are still running')
+    add_shared_memory_arguments(worker)
+    worker.set_defaults(function=worker_command)
+
+    status = subparsers.add_parser('status', help='Show the progress and throughput of a distributed run')
+    status.add_argument('--queue', required=True)
+    status.set_defaults(function=status_command)
+
+    merge = subparsers.add_parser('merge', help='Merge the results of a finished distributed run')
+    merge.add_argument('--queue', required=True)
+    merge.add_argument('-o', '--output', required=True, help='Output JSON Lines file (one result per article, in corpus order)')
+    merge.add_argument('--problems-output', default=None, help='TSV file for the list of problematic articles (default: OUTPUT.problems.tsv)')
+    add_output_arguments(merge)
+    merge.set_defaults(function=merge_command)
+
+    serve = subparsers.add_parser('serve', help='Serve the pipeline over HTTP, running concurrent requests in micro-batches')
+    serve.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: %(default)s)')
+    serve.add_argument('--port', type=int, default=8080, help='Port to listen on (default: %(default)s)')
+    serve.add_argument('--max-batch-size', type=int, default=32, help='Maximum number of articles per batch (default: %(default)s)')
+    serve.add_argument('--max-wait-ms', type=float, default=20, help='Maximum time the first article of a batch waits for more, in milliseconds (default: %(default)s)')
+    serve.add_argument('--threads', type=int, default=0, help='PyTorch threads (default: PyTorch\'s default)')
+    serve.add_argument('--modules', nargs='+', default=['*'], help='Pipeline steps to run (see README; default: all)')
+    serve.add_argument('--ner-engine', choices=['transformer', 'gazetteer'], default='transformer')
+    serve.add_argument('--sentence-split-mode', choices=['full', 'fast', 'lazy'], default='full')
+    add_shared_memory_arguments(serve)
+    serve.set_defaults(function=serve_command)
+
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        return args.function(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+if __name__ == '__main__':
+    sys.exit(main())
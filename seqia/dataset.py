@@ -1,6 +1,3 @@
-
-from datasets import Dataset
-import tensorflow as tf
 import torch
 
 class DroughtDataset(torch.utils.data.Dataset):
@@ -4,6 +4,7 @@ from transformers import AutoModelForSequenceClassification, AutoTokenizer, Trai
 import torch
 import numpy as np
 from . dataset import DroughtDataset
+from . metrics import metrics
 from tqdm import tqdm
 
 class DroughtImpactsClassifier:
@@ -85,7 +86,7 @@ class DroughtImpactsClassifier:
     def load_individual_drought_impacts_classifier(self,impact,modelPath=''):
         model = None
         if modelPath != '':
-            if os.path.isfile(modelPath + 'pytorch_model.bin'):
+            if os.path.isfile(modelPath + 'pytorch_model.bin') or os.path.isfile(modelPath + 'model.safetensors'):
                 model = AutoModelForSequenceClassification.from_pretrained(modelPath, num_labels=2)
         else:
             model = AutoModelForSequenceClassification.from_pretrained(os.path.join(os.path.join((os.path.join(os.path.dirname(os.path.realpath(__file__)), 'models')),'impacts'), impact), num_labels=2)
@@ -99,11 +100,15 @@ class DroughtImpactsClassifier:
         #Pass the sentences through each of the individual classifiers
         for positive_idx, text, _, _ in tqdm(texts):
             result_cur = list()
+            metrics.observe('batch_size', len(text), stage='drought_impacts.model')
             for impact in self.impacts_and_base_model.keys():
-                if self.usesSingleTokenizer:
-                    logits_binary = self.model[impact](**self.tokenizer[list(self.impacts_and_base_model.keys())[0]](text, max_length=self.impacts_and_base_model[list(self.impacts_and_base_model.keys())[0]][1], pad_to_max_length=True,truncation=True,return_tensors='pt').to(self.device)
-                else:
-                    logits_binary = self.model[impact](**self.tokenizer[impact](text, max_length=self.impacts_and_base_model[impact][1], pad_to_max_length=True,truncation=True,return_tensors='pt').to(self.device))
+                with metrics.stage('drought_impacts.model', items=len(text)) as stage:
+                    if self.usesSingleTokenizer:
+                        inputs = self.tokenizer[list(self.impacts_and_base_model.keys())[0]](text, max_length=self.impacts_and_base_model[list(self.impacts_and_base_model.keys())[0]][1], pad_to_max_length=True,truncation=True,return_tensors='pt').to(self.device)
+                    else:
+                        inputs = self.tokenizer[impact](text, max_length=self.impacts_and_base_model[impact][1], pad_to_max_length=True,truncation=True,return_tensors='pt').to(self.device)
+                    logits_binary = self.model[impact](**inputs)
+                    stage.add(tokens=int(inputs['attention_mask'].sum()))
                 predictions_binary = list(np.argmax(logits_binary.logits.detach().numpy(), axis=-1))
 
                 if 1 in predictions_binary:
@@ -112,4 +117,27 @@ class DroughtImpactsClassifier:
             results[positive_idx] = result_cur
 
         return results
+
+    def predict_sentences(self, sentences, batch_size=32):
+        #Drought impacts of each individual sentence: a list with the names of the impacts found in each one.
+        #An article gets (in __call__) every impact that is found in any of its sentences
+        results = [[] for _ in sentences]
+
+        impacts = list(self.impacts_and_base_model.keys())
+        for start in tqdm(range(0, len(sentences), batch_size)):
+            batch = sentences[start:start+batch_size]
+            metrics.observe('batch_size', len(batch), stage='drought_impacts.model')
+            for impact in impacts:
+                tokenizer_impact = impacts[0] if self.usesSingleTokenizer else impact
+                with metrics.stage('drought_impacts.model', items=len(batch)) as stage, torch.no_grad():
+                    inputs = self.tokenizer[tokenizer_impact](batch, max_length=self.impacts_and_base_model[tokenizer_impact][1], padding='max_length',truncation=True,return_tensors='pt').to(self.device)
+                    logits_binary = self.model[impact](**inputs)
+                    stage.add(tokens=int(inputs['attention_mask'].sum()))
+                predictions_binary = list(np.argmax(logits_binary.logits.detach().cpu().numpy(), axis=-1))
+
+                for k, prediction in enumerate(predictions_binary):
+                    if prediction == 1:
+                        results[start+k].append(impact)
+
+        return results
     
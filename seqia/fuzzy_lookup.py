@@ -0,0 +1,142 @@
+"""
+Approximate lookup of place names (symmetric delete algorithm, as in SymSpell).
+
+At build time, every name is indexed under all the strings that result from
+deleting up to "max_edit_distance" characters from its first "prefix_length"
+characters. At query time, the same deletes are generated for the query, so
+candidates are found with a handful of dictionary lookups instead of scanning
+every name; candidates are then verified with the actual edit distance. Names
+are compared lowercased and without accents, so "Avila" finds "Ávila" at
+distance 0.
+"""
+
+import unicodedata
+from collections import defaultdict
+
+class SymSpellIndex:
+
+    def __init__(self, names=(), max_edit_distance=2, prefix_length=7):
+        self.max_edit_distance = max_edit_distance
+        self.prefix_length = prefix_length
+
+        #Normalized name -> original spellings of that name
+        self.terms = dict()
+        #Delete -> normalized names that produce it
+        self.deletes = defaultdict(list)
+        self.max_length = 0
+
+        for name in names:
+            self.add(name)
+
+        return
+
+    def normalize(self, name):
+        name = unicodedata.normalize('NFKD', name.lower())
+        return ''.join([c for c in name if not unicodedata.combining(c)]).strip()
+
+    def generate_deletes(self, word, max_edit_distance):
+        deletes = {word}
+        queue = [word]
+        for _ in range(max_edit_distance):
+            next_queue = []
+            for item in queue:
+                if len(item) <= 1:
+                    continue
+                for i in range(len(item)):
+                    delete = item[:i] + item[i+1:]
+                    if delete not in deletes:
+                        deletes.add(delete)
+                        next_queue.append(delete)
+            queue = next_queue
+        return deletes
+
+    def add(self, name):
+        term = self.normalize(name)
+        if term == '':
+            return
+
+        if term in self.terms:
+            if name not in self.terms[term]:
+                self.terms[term].append(name)
+            return
+
+        self.terms[term] = [name]
+        self.max_length = max(self.max_length, len(term))
+
+        for delete in self.generate_deletes(term[:self.prefix_length], self.max_edit_distance):
+            self.deletes[delete].append(term)
+
+        return
+
+    def distance(self, a, b, max_distance):
+        #Damerau-Levenshtein distance (optimal string alignment), or max_distance + 1
+        #as soon as it is clear that it will be bigger than max_distance
+        if abs(len(a) - len(b)) > max_distance:
+            return max_distance + 1
+
+        #A common prefix or suffix does not change the distance, and most candidates share a long
+        #one with the query (they were found through its first characters), so strip it first
+        start = 0
+        while start < len(a) and start < len(b) and a[start] == b[start]:
+            start += 1
+        end_a = len(a)
+        end_b = len(b)
+        while end_a > start and end_b > start and a[end_a-1] == b[end_b-1]:
+            end_a -= 1
+            end_b -= 1
+        a = a[start:end_a]
+        b = b[start:end_b]
+
+        if len(a) == 0 or len(b) == 0:
+            return min(len(a) + len(b), max_distance + 1)
+
+        #Only cells within "max_distance" of the diagonal can lead to a distance within the limit
+        too_far = max_distance + 1
+        previous_previous = None
+        previous = [j if j <= max_distance else too_far for j in range(len(b) + 1)]
+        for i in range(1, len(a) + 1):
+            current = [too_far] * (len(b) + 1)
+            if i <= max_distance:
+                current[0] = i
+            for j in range(max(1, i - max_distance), min(len(b), i + max_distance) + 1):
+                cost = 0 if a[i-1] == b[j-1] else 1
+                current[j] = min(previous[j] + 1, current[j-1] + 1, previous[j-1] + cost)
+                if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                    current[j] = min(current[j], previous_previous[j-2] + 1)
+            if min(current) > max_distance:
+                return too_far
+            previous_previous, previous = previous, current
+
+        return min(previous[-1], too_far)
+
+    def lookup(self, name, max_edit_distance=None, max_candidates=None, closest_only=False):
+        #Returns a list of (original name, edit distance) tuples, sorted by distance,
+        #with all indexed names within "max_edit_distance" of the query. With "closest_only",
+        #only those at the smallest distance found are returned, which is much faster: the
+        #distance limit shrinks as closer candidates are found
+        if max_edit_distance is None or max_edit_distance > self.max_edit_distance:
+            max_edit_distance = self.max_edit_distance
+
+        query = self.normalize(name)
+        if query == '' or len(query) - self.max_length > max_edit_distance:
+            return []
+
+        if closest_only and query in self.terms:
+            return [(original, 0) for original in self.terms[query]]
+
+        candidates = dict()
+        for delete in self.generate_deletes(query[:self.prefix_length], max_edit_distance):
+            for term in self.deletes.get(delete, ()):
+                if term not in candidates:
+                    candidates[term] = self.distance(query, term, max_edit_distance)
+                    if closest_only and candidates[term] < max_edit_distance:
+                        max_edit_distance = candidates[term]
+
+        results = sorted([(distance, term) for term, distance in candidates.items() if distance <= max_edit_distance])
+        if max_candidates is not None:
+            results = results[:max_candidates]
+
+        return [(original, distance) for distance, term in results for original in self.terms[term]]
+
+    def __len__(self):
+        return len(self.terms)
@@ -0,0 +1,96 @@
+"""
+Dictionary-based alternative to the Transformer NER model for locations.
+
+Instead of tagging tokens with a neural model, it looks up every place name
+from the offline gazetteers (towns, provinces, communities, rivers, dams and
+Geonames) directly in the text. Names are stored in a token-level trie, and
+texts are scanned left to right keeping the longest name that starts at each
+token (so "Alcalá de Henares" wins over "Alcalá"). Matching ignores case and
+accents, but a match has to start with a capital letter in the text, as proper
+names do. Recall is lower than that of the NER model, but it is several orders
+of magnitude faster.
+"""
+
+import re
+import unicodedata
+
+class GazetteerMatcher:
+
+    TOKEN_REGEX = re.compile(r'\w+|[^\w\s]')
+
+    #Key that marks the end of a name in the trie (it can never be a token)
+    END = ''
+
+    def __init__(self, names=(), ignore_names=()):
+        self.trie = dict()
+        self.ignore_names = set(self.normalize(name) for name in ignore_names)
+        self.num_names = 0
+
+        for name in names:
+            self.add(name)
+
+        return
+
+    def normalize(self, token):
+        #Lowercase the token and strip it from accents ("Ávila" -> "avila")
+        token = unicodedata.normalize('NFKD', token.lower())
+        return ''.join([c for c in token if not unicodedata.combining(c)])
+
+    def add(self, name):
+        tokens = [self.normalize(token) for token in self.TOKEN_REGEX.findall(name)]
+        if len(tokens) == 0 or ' '.join(tokens) in self.ignore_names:
+            return
+
+        node = self.trie
+        for token in tokens:
+            node = node.setdefault(token, dict())
+
+        if self.END not in node:
+            node[self.END] = True
+            self.num_names += 1
+
+        return
+
+    def find(self, text):
+        #Returns the (start, end) character offsets of all names found in the text
+        tokens = [(match.start(), match.end()) for match in self.TOKEN_REGEX.finditer(text)]
+        normalized_tokens = [self.normalize(text[start:end]) for start, end in tokens]
+
+        spans = []
+        i = 0
+        while i < len(tokens):
+            #Names have to start with a capital letter
+            if not text[tokens[i][0]].isupper():
+                i += 1
+                continue
+
+            #Walk the trie from the current token, remembering the longest full name found
+            node = self.trie
+            longest = -1
+            j = i
+            while j < len(tokens) and normalized_tokens[j] in node:
+                node = node[normalized_tokens[j]]
+                if self.END in node:
+                    longest = j
+                j += 1
+
+            if longest >= 0:
+                spans.append((tokens[i][0], tokens[longest][1]))
+                i = longest + 1
+            else:
+                i += 1
+
+        return spans
+
+    def __call__(self, texts):
+        #Same output format as NERLocation.loc_tokens_aggregation: one list of toponyms
+        #and one list of metadata dictionaries (with "start" and "end") per text
+        toponyms = []
+        toponyms_metadata = []
+
+        for text in texts:
+            spans = self.find(text)
+            toponyms.append([text[start:end] for start, end in spans])
+            toponyms_metadata.append([{'start': start, 'end': end} for start, end in spans])
+
+        return toponyms, toponyms_metadata
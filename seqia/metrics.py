@@ -0,0 +1,295 @@
+"""
+Metrics of pipeline runs: wall time, items and tokens per second, batch sizes, cache
+hits and memory use of each stage.
+
+All components record their metrics in a single registry, "metrics" (below), which
+is disabled by default: every recording call then returns at once, and stages are
+timed with a shared no-op context manager, so instrumentation costs next to nothing.
+It is enabled with DroughtClassifier(collect_metrics=True), or metrics.enable().
+Stages are also the points where a profiler (seqia/profiling.py) can be attached.
+
+    from seqia.metrics import metrics
+    metrics.enable()
+    ...
+    metrics.write_report('report.json')     #Structured run report (see "report")
+    print(metrics.to_prometheus())          #Prometheus text exposition format
+
+Stages are named after the steps of the pipeline ('keyword', 'binary', 'ner_loc'...),
+and parts of a stage after it ('binary.model', 'ner_loc.geolocation'...), so the time
+of a stage includes that of its parts.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+#Units of the items of each stage
+STAGE_UNITS = {
+    'inference': 'articles',
+    'problems': 'articles',
+    'problems.tokenize': 'articles',
+    'keyword': 'articles',
+    'binary': 'articles',
+    'binary.model': 'articles',
+    'sentence_split': 'articles',
+    'drought_impacts': 'articles',
+    'drought_impacts.model': 'sentences',
+    'ner_loc': 'articles',
+    'ner_loc.model': 'sentences',
+    'ner_loc.aggregation': 'sentences',
+    'ner_loc.geolocation': 'toponyms',
+    'ner_loc.spatial_join': 'toponyms',
+    'server.batch': 'articles'
+}
+
+#Upper bounds of the buckets of batch size histograms (Prometheus export)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+def get_rss_bytes():
+    #Current resident set size of this process (Linux), or its peak if the current one is not available (None
+    #if neither is, e.g. on Windows)
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return get_peak_rss_bytes()
+
+def get_peak_rss_bytes():
+    #Peak resident set size of this process, so far (ru_maxrss is in kilobytes on Linux, in bytes on macOS),
+    #or None where the "resource" module is not available (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class NullStageTimer:
+
+    #Stand-in for StageTimer when metrics are disabled: does nothing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, items=0, tokens=0):
+        return
+
+NULL_STAGE_TIMER = NullStageTimer()
+
+class StageTimer:
+
+    __slots__ = ('registry', 'name', 'items', 'tokens', 'start')
+
+    def __init__(self, registry, name, items=0, tokens=0):
+        self.registry = registry
+        self.name = name
+        self.items = items
+        self.tokens = tokens
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.record_stage(self.name, time.perf_counter() - self.start, self.items, self.tokens)
+        return False
+
+    def add(self, items=0, tokens=0):
+        #Items (articles, sentences, toponyms...) and tokens processed in this call, if not known upfront
+        self.items += items
+        self.tokens += tokens
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.enabled = False
+        self.profiler = None
+        self.lock = threading.Lock()
+        self.reset()
+        return
+
+    def enable(self):
+        self.enabled = True
+        return
+
+    def disable(self):
+        self.enabled = False
+        return
+
+    def set_profiler(self, profiler):
+        #StageProfiler (see seqia/profiling.py) that wraps every stage, or None
+        self.profiler = profiler
+        return
+
+    def reset(self):
+        with self.lock:
+            #Stage -> {'calls', 'seconds', 'max_seconds', 'items', 'tokens', 'rss_bytes_at_exit'}. "rss_bytes_at_exit"
+            #is the largest resident set size measured at the end of a call of the stage: memory allocated and freed
+            #within a call is not seen (the peak of the whole process is in the report)
+            self.stages = dict()
+            #(name, sorted labels) -> value
+            self.counters = dict()
+            #(name, sorted labels) -> {value: number of observations}
+            self.histograms = dict()
+            self.start_time = time.perf_counter()
+        return
+
+    def stage(self, name, items=0, tokens=0):
+        #Context manager that times a stage:
+        #  with metrics.stage('binary.model', items=len(articles)) as stage:
+        #      ...
+        #      stage.add(tokens=num_tokens)
+        if self.profiler is not None:
+            timer = StageTimer(self, name, items, tokens) if self.enabled else NullStageTimer()
+            return self.profiler.stage(name, timer)
+        if not self.enabled:
+            return NULL_STAGE_TIMER
+        return StageTimer(self, name, items, tokens)
+
+    def record_stage(self, name, seconds, items=0, tokens=0):
+        rss = get_rss_bytes()
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'items': 0, 'tokens': 0, 'rss_bytes_at_exit': None}
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            stage['items'] += items
+            stage['tokens'] += tokens
+            if rss is not None:
+                stage['rss_bytes_at_exit'] = rss if stage['rss_bytes_at_exit'] is None else max(stage['rss_bytes_at_exit'], rss)
+        return
+
+    def count(self, name, value=1, **labels):
+        #Adds "value" to a counter (e.g. metrics.count('cache_hits', 3, cache='article_tokens'))
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        return
+
+    def observe(self, name, value, **labels):
+        #Adds an observation to a histogram (e.g. metrics.observe('batch_size', len(batch), stage='binary.model'))
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, dict())
+            histogram[value] = histogram.get(value, 0) + 1
+        return
+
+    ############
+    ## REPORT ##
+    ###########
+    def report(self):
+        #Structured report of everything recorded so far (JSON-serializable)
+        with self.lock:
+            stages = dict()
+            for name, stage in self.stages.items():
+                stage = dict(stage)
+                stage['unit'] = STAGE_UNITS.get(name)
+                stage['mean_seconds'] = stage['seconds'] / stage['calls'] if stage['calls'] > 0 else 0.0
+                stage['items_per_second'] = stage['items'] / stage['seconds'] if stage['seconds'] > 0 else None
+                stage['tokens_per_second'] = stage['tokens'] / stage['seconds'] if stage['seconds'] > 0 and stage['tokens'] > 0 else None
+                stages[name] = stage
+
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+
+            histograms = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                count = sum(histogram.values())
+                total = sum([value * times for value, times in histogram.items()])
+                histograms.append({'name': name, 'labels': dict(labels), 'count': count, 'sum': total,
+                                   'mean': total / count if count > 0 else 0.0, 'max': max(histogram) if count > 0 else None,
+                                   'values': {str(value): times for value, times in sorted(histogram.items())}})
+
+            cache_ratios = dict()
+            for (name, labels), hits in self.counters.items():
+                if name == 'cache_hits':
+                    misses = self.counters.get(('cache_misses', labels), 0)
+                    cache_ratios[dict(labels).get('cache', '')] = hits / (hits + misses) if hits + misses > 0 else 0.0
+
+            return {
+                'enabled': self.enabled,
+                'seconds': time.perf_counter() - self.start_time,
+                'rss_bytes': get_rss_bytes(),
+                'peak_rss_bytes': max([rss for rss in [get_peak_rss_bytes()] + [stage['rss_bytes_at_exit'] for stage in stages.values()]
+                                       if rss is not None], default=None),
+                'stages': stages,
+                'counters': counters,
+                'cache_hit_ratios': cache_ratios,
+                'histograms': histograms
+            }
+
+    def write_report(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+        return
+
+    def to_prometheus(self, prefix='seqia'):
+        #Everything recorded so far, in the Prometheus text exposition format
+        report = self.report()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            #"samples" is a list of (labels dictionary, value)
+            if len(samples) == 0:
+                return
+            lines.append('# HELP ' + prefix + '_' + name + ' ' + help_text)
+            lines.append('# TYPE ' + prefix + '_' + name + ' ' + kind)
+            for labels, value in samples:
+                lines.append(prefix + '_' + name + format_labels(labels) + ' ' + format_value(value))
+
+        stages = sorted(report['stages'].items())
+        metric('stage_seconds_total', 'counter', 'Wall time spent in each stage', [({'stage': name}, stage['seconds']) for name, stage in stages])
+        metric('stage_calls_total', 'counter', 'Number of calls of each stage', [({'stage': name}, stage['calls']) for name, stage in stages])
+        metric('stage_items_total', 'counter', 'Items (articles, sentences...) processed by each stage', [({'stage': name}, stage['items']) for name, stage in stages])
+        metric('stage_tokens_total', 'counter', 'Tokens processed by each stage', [({'stage': name}, stage['tokens']) for name, stage in stages if stage['tokens'] > 0])
+        metric('stage_rss_bytes_at_exit', 'gauge', 'Largest resident set size seen at the end of each stage',
+               [({'stage': name}, stage['rss_bytes_at_exit']) for name, stage in stages if stage['rss_bytes_at_exit'] is not None])
+        metric('process_rss_bytes', 'gauge', 'Resident set size of the process', [({}, report['rss_bytes'])] if report['rss_bytes'] is not None else [])
+        metric('process_peak_rss_bytes', 'gauge', 'Peak resident set size of the process', [({}, report['peak_rss_bytes'])] if report['peak_rss_bytes'] is not None else [])
+
+        counters = dict()
+        for counter in report['counters']:
+            counters.setdefault(counter['name'], []).append((counter['labels'], counter['value']))
+        for name, samples in sorted(counters.items()):
+            metric(name + '_total', 'counter', name.replace('_', ' ').capitalize(), samples)
+
+        histograms = dict()
+        for histogram in report['histograms']:
+            histograms.setdefault(histogram['name'], []).append(histogram)
+        for name, group in sorted(histograms.items()):
+            lines.append('# HELP ' + prefix + '_' + name + ' ' + name.replace('_', ' ').capitalize())
+            lines.append('# TYPE ' + prefix + '_' + name + ' histogram')
+            for histogram in group:
+                values = {int(value): times for value, times in histogram['values'].items()}
+                for bound in BATCH_SIZE_BUCKETS:
+                    cumulative = sum([times for value, times in values.items() if value <= bound])
+                    lines.append(prefix + '_' + name + '_bucket' + format_labels(dict(histogram['labels'], le=str(bound))) + ' ' + str(cumulative))
+                lines.append(prefix + '_' + name + '_bucket' + format_labels(dict(histogram['labels'], le='+Inf')) + ' ' + str(histogram['count']))
+                lines.append(prefix + '_' + name + '_sum' + format_labels(histogram['labels']) + ' ' + format_value(histogram['sum']))
+                lines.append(prefix + '_' + name + '_count' + format_labels(histogram['labels']) + ' ' + str(histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in labels.items()]
+    return '{' + ','.join(escaped) + '}'
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+#Registry shared by every component
+metrics = MetricsRegistry()
@@ -0,0 +1,66 @@
+"""
+Memory-mapped model weights.
+
+The first time a model is loaded, its weights are saved to a cache folder in
+PyTorch's zip format. From then on, its parameters are replaced by tensors that
+are memory-mapped, read-only, from that file, instead of private copies. All
+processes on a machine that map the same file share its pages through the OS
+page cache, so running N workers does not take N copies of every model, and the
+weights of a model that is not used much do not need to stay resident.
+"""
+
+import hashlib
+import inspect
+import os
+import warnings
+
+def default_cache_dir():
+    #Folder for cached weights and gazetteer snapshots ($SEQIA_CACHE_DIR, or ~/.cache/seqia)
+    return os.environ.get('SEQIA_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'seqia'))
+
+def weights_cache_key(model):
+    #Identifies a model and the version of its weights: its name or path, and the size and modification
+    #time of its files when it was loaded from a local folder
+    name_or_path = str(getattr(model.config, '_name_or_path', '')) if hasattr(model, 'config') else ''
+    key = [type(model).__name__, name_or_path, str(getattr(getattr(model, 'config', None), '_commit_hash', ''))]
+    if os.path.isdir(name_or_path):
+        for file in sorted(os.listdir(name_or_path)):
+            stat = os.stat(os.path.join(name_or_path, file))
+            key.append(file + ':' + str(stat.st_size) + ':' + str(int(stat.st_mtime)))
+    return hashlib.sha1('\n'.join(key).encode('utf-8')).hexdigest()[:16]
+
+def memory_map_model_weights(model, cache_dir=None):
+    #Replaces the parameters and buffers of "model" by tensors memory-mapped from its cached weights file (which
+    #is written first, if missing). Returns the path of that file, or None for models on a GPU, which keep their
+    #own copy in GPU memory anyway, and with PyTorch versions older than 2.1 (no memory-mapped loading), with which
+    #models keep their own private copy of the weights
+    import torch
+
+    if any([parameter.device.type != 'cpu' for parameter in model.parameters()]):
+        return None
+
+    if not supports_memory_mapping(torch):
+        warnings.warn("PyTorch " + torch.__version__ + " cannot memory-map model weights (PyTorch 2.1 or later is needed): every process keeps its own copy")
+        return None
+
+    if cache_dir is None:
+        cache_dir = os.path.join(default_cache_dir(), 'weights')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    path = os.path.join(cache_dir, type(model).__name__ + '-' + weights_cache_key(model) + '.pt')
+    if not os.path.isfile(path):
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        torch.save(model.state_dict(), tmp_path)
+        os.replace(tmp_path, path)
+
+    state_dict = torch.load(path, mmap=True, weights_only=True, map_location='cpu')
+    model.load_state_dict(state_dict, assign=True)
+    if hasattr(model, 'tie_weights'):
+        model.tie_weights()
+    model.eval()
+
+    return path
+
+def supports_memory_mapping(torch):
+    #torch.load(mmap=True) and Module.load_state_dict(assign=True) were added in PyTorch 2.1
+    return 'mmap' in inspect.signature(torch.load).parameters and 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
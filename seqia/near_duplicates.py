@@ -0,0 +1,157 @@
+"""
+Near-duplicate detection of articles (MinHash and locality-sensitive hashing).
+
+Every body is turned into its set of word shingles (sequences of "shingle_size"
+consecutive words), which is summarized by a MinHash signature: the minimum
+hash value of its shingles under "num_perm" different hash functions. The
+fraction of equal values in the signatures of two articles estimates the
+Jaccard similarity of their shingle sets. Signatures are split into bands, and
+articles that share a band are candidates to be near-duplicates (LSH), so an
+article is only compared to a handful of others, not to the whole corpus.
+
+Articles are clustered in a single pass, in corpus order: an article that is
+similar enough ("threshold") to a previous cluster representative joins its
+cluster; otherwise it becomes the representative of a new cluster. Only
+representatives are indexed, so memory grows with the number of distinct
+stories, not with the number of articles.
+"""
+
+import re
+import unicodedata
+import zlib
+
+import numpy as np
+
+class NearDuplicateDetector:
+
+    WORD_REGEX = re.compile(r'\w+')
+
+    #Multiplier of the rolling hash of shingles
+    SHINGLE_HASH_BASE = np.uint64(1000003)
+
+    def __init__(self, threshold=0.8, num_perm=128, shingle_size=5, seed=1):
+        if not 0 < threshold <= 1:
+            raise ValueError("Threshold must be in (0, 1]: " + str(threshold))
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+        #Random hash functions (multiply-shift): h(x) = ((a * x + b) mod 2^64) >> 32, with odd "a"
+        generator = np.random.RandomState(seed)
+        self.a = generator.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = generator.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+        self.bands, self.rows = self.get_optimal_bands(threshold, num_perm)
+
+        #Band -> {hash of the band of a signature: representatives with that band}
+        self.buckets = [dict() for _ in range(self.bands)]
+        #Representative -> its signature
+        self.signatures = dict()
+
+        self.stats = {'articles': 0, 'duplicates': 0, 'representatives': 0, 'comparisons': 0}
+
+        return
+
+    def get_optimal_bands(self, threshold, num_perm):
+        #Number of bands and rows per band that minimize the probability of missing a pair above the threshold
+        #plus that of comparing a pair below it (same criterion as in the datasketch library)
+        def probability(s, bands, rows):
+            return 1 - (1 - s ** rows) ** bands
+
+        best = None
+        for bands in range(1, num_perm + 1):
+            if num_perm % bands != 0:
+                continue
+            rows = num_perm // bands
+            below = np.linspace(0, threshold, 101)
+            above = np.linspace(threshold, 1, 101)
+            false_positives = np.mean(probability(below, bands, rows)) * threshold
+            false_negatives = np.mean(1 - probability(above, bands, rows)) * (1 - threshold)
+            error = false_positives + false_negatives
+            if best is None or error < best[0]:
+                best = (error, bands, rows)
+
+        return best[1], best[2]
+
+    def normalize(self, text):
+        text = text.lower()
+        if text.isascii():
+            return text
+        text = unicodedata.normalize('NFKD', text)
+        return ''.join([c for c in text if not unicodedata.combining(c)])
+
+    def get_shingles(self, text):
+        #64-bit hashes of the word shingles of a text: every word is hashed once, and the hash of each shingle is
+        #a polynomial rolling hash of the hashes of its words (arithmetic is modulo 2^64: overflows are expected)
+        words = self.WORD_REGEX.findall(self.normalize(text))
+        if len(words) == 0:
+            return np.zeros(0, dtype=np.uint64)
+
+        word_hashes = np.fromiter((zlib.crc32(word.encode('utf-8')) for word in words), dtype=np.uint64, count=len(words))
+        num_shingles = max(1, len(words) - self.shingle_size + 1)
+        with np.errstate(over='ignore'):
+            shingles = np.zeros(num_shingles, dtype=np.uint64)
+            for i in range(min(self.shingle_size, len(words))):
+                shingles = shingles * self.SHINGLE_HASH_BASE + word_hashes[i:i+num_shingles]
+        return np.unique(shingles)
+
+    def get_signature(self, text):
+        #MinHash signature of a text (None for texts without words)
+        shingles = self.get_shingles(text)
+        if len(shingles) == 0:
+            return None
+        with np.errstate(over='ignore'):
+            hashes = (np.outer(self.a, shingles) + self.b[:, None]) >> np.uint64(32)
+        return hashes.min(axis=1).astype(np.uint32)
+
+    def get_band_hashes(self, signature):
+        return [hash(signature[i*self.rows:(i+1)*self.rows].tobytes()) for i in range(self.bands)]
+
+    def add(self, key, text):
+        #Adds an article to the index. Returns (representative key, estimated similarity) if it is a
+        #near-duplicate of a previous representative, or None if it becomes a representative itself
+        self.stats['articles'] += 1
+
+        signature = self.get_signature(text)
+        if signature is None:
+            return None
+
+        band_hashes = self.get_band_hashes(signature)
+
+        candidates = dict()
+        for band, band_hash in enumerate(band_hashes):
+            for candidate in self.buckets[band].get(band_hash, ()):
+                candidates[candidate] = True
+
+        best = None
+        for candidate in sorted(candidates):
+            self.stats['comparisons'] += 1
+            similarity = float(np.mean(self.signatures[candidate] == signature))
+            #Ties go to the earliest representative (keys are expected to increase in corpus order)
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (candidate, similarity)
+
+        if best is not None:
+            self.stats['duplicates'] += 1
+            return best
+
+        self.signatures[key] = signature
+        for band, band_hash in enumerate(band_hashes):
+            self.buckets[band].setdefault(band_hash, []).append(key)
+        self.stats['representatives'] += 1
+
+        return None
+
+def find_near_duplicate_articles(articles, threshold=0.8, num_perm=128, shingle_size=5):
+    #Clusters of near-duplicate articles, as a dictionary: filename of each representative ->
+    #list of (filename, estimated similarity) of its near-duplicates. Articles without
+    #near-duplicates are left out
+    detector = NearDuplicateDetector(threshold, num_perm, shingle_size)
+    clusters = dict()
+    for i, article in enumerate(articles):
+        match = detector.add(i, article['headline'] + '\n' + article['body'])
+        if match is not None:
+            representative, similarity = match
+            clusters.setdefault(articles[representative]['filename'], []).append((article['filename'], similarity))
+    return clusters
@@ -15,10 +15,13 @@ errores...
 """
 
 from collections import defaultdict
-from transformers import pipeline
+from . gazetteer_ner import GazetteerMatcher
+from . fuzzy_lookup import SymSpellIndex
+from . model_weights import memory_map_model_weights
+from . metrics import metrics
 import os
-import geopandas
-import pandas as pd
+import pickle
+import numpy as np
 import shapely
 import xml.etree.ElementTree as ET
 import zipfile
@@ -28,22 +31,195 @@ class NERLocation:
   model_name = "PlanTL-GOB-ES/roberta-base-bne-capitel-ner-plus"
   MODEL_MAX_SIZE = 512
 
+  #Version of the gazetteer snapshots (see below): bump it whenever the loading functions change
+  #(new attributes, different indexes...), so that snapshots written by older code are rebuilt
+  SNAPSHOT_FORMAT = 2
+
   ##################
   ## Constructor ##
   #################
-  def __init__(self, device):
+  def __init__(self, device, preload=False, engine='transformer'):
 
-    #Load pipe
-    self.pipe = pipeline("token-classification", model=self.model_name, device=device)
+    self.device = device
 
-    #Load offline localization data from IGN and Geonames
-    self.load_localization_data()
-    
-    self.preload_misc_geolocation_variables()
+    #Engine used to find toponyms in text: 'transformer' (the NER model above) or
+    #'gazetteer' (dictionary matching against the offline gazetteers; much faster, lower recall)
+    if engine not in ('transformer', 'gazetteer'):
+      raise ValueError("Unknown NER engine: " + str(engine))
+    self.engine = engine
+
+    #The NER pipeline and the offline localization data (IGN, MiTEco and Geonames) are heavy,
+    #so both are loaded on first use: the pipeline the first time a text is tagged, and the
+    #gazetteers the first time a toponym is geolocated (never, if "do_geocoding" is False)
+    self.pipe = None
+    self.gazetteer_matcher = None
+
+    #Optional function that returns a sentence with its dependency tree (e.g. SentenceSplitter.parse).
+    #It is only called for sentences that need syntactic disambiguation, which allows deferring
+    #parsing until then when sentences are split without a parser
+    self.sentence_parser = None
+    self.fuzzy_index = None
+    self.localization_data_loaded = False
 
     self.do_geocoding = True
 
+    #Attach province, autonomous community and river basin to each resolved location
+    self.do_spatial_join = True
+
+    #Fuzzy fallback for toponyms not found as-is in the gazetteers (misspellings, missing accents,
+    #OCR noise). The allowed edit distance grows with the length of the toponym (one edit every four
+    #characters), up to "fuzzy_max_edit_distance"; shorter toponyms than "fuzzy_min_length" are not corrected
+    self.do_fuzzy_matching = True
+    self.fuzzy_max_edit_distance = 2
+    self.fuzzy_min_length = 4
+    self.fuzzy_stats = {'lookups': 0, 'corrected': 0, 'ambiguous': 0, 'not_found': 0}
+
+    #Optional path of a snapshot of the loaded gazetteers: if it exists (and is up to date) gazetteers are read from
+    #it, which is much faster than parsing the original files; otherwise it is written once they are loaded
+    self.gazetteer_snapshot = None
+
+    #Optional folder to memory-map the weights of the NER model from (see model_weights.py), so that
+    #several processes share one copy of them
+    self.weights_cache_dir = None
+
+    if preload:
+      self.load_model()
+      self.load_geolocation_data()
+
+    return
+
+  def load_model(self):
+    if self.engine == 'gazetteer':
+      self.load_gazetteer_matcher()
+    elif self.pipe is None:
+      from transformers import pipeline
+      self.pipe = pipeline("token-classification", model=self.model_name, device=self.device)
+      if self.weights_cache_dir is not None:
+        memory_map_model_weights(self.pipe.model, self.weights_cache_dir)
     return
+
+  def get_resolvable_toponym_names(self):
+    #Every name that the geolocation function below is able to resolve
+
+    names = [name for name in self.town_names if name != 'REPEATED_TOWNS']
+    names.extend(self.comm_names_with_variants)
+    names.extend(self.prov_names_with_variants)
+    names.extend(self.country_names)
+
+    for name in self.riv_names:
+      names.append(name)
+      #River names are stored as "RIO TAJO", but are usually mentioned as "(el río) Tajo"
+      if isinstance(name, str) and name.startswith('RIO '):
+        names.append(name[4:])
+
+    names.extend(self.dam_names)
+
+    #Only Geonames entries that the geolocation function would accept (populated places)
+    if self.geonames is not None:
+      for name, entries in self.geonames.items():
+        if name != 'ALTERNATIVE_NAMES' and any([entry['feature code'].startswith('PPL') for entry in entries]):
+          names.append(name)
+
+    return [name for name in names if isinstance(name, str)]
+
+  def load_gazetteer_matcher(self):
+    #Builds the dictionary matcher used by the 'gazetteer' engine
+    if self.gazetteer_matcher is not None:
+      return
+
+    from spacy.lang.es.stop_words import STOP_WORDS
+
+    self.load_geolocation_data()
+
+    #Single-word names that are also Spanish function words would match at the start of many sentences
+    self.gazetteer_matcher = GazetteerMatcher(self.get_resolvable_toponym_names(), ignore_names=STOP_WORDS)
+
+    return
+
+  def load_geolocation_data(self):
+    if not self.localization_data_loaded:
+      if self.gazetteer_snapshot is not None and self.load_gazetteer_snapshot(self.gazetteer_snapshot):
+        self.localization_data_loaded = True
+        return
+
+      attributes_before = set(self.__dict__.keys())
+
+      #Load offline localization data from IGN and Geonames
+      self.load_localization_data()
+
+      self.preload_misc_geolocation_variables()
+
+      if self.do_fuzzy_matching:
+        self.fuzzy_index = SymSpellIndex(self.get_resolvable_toponym_names(), max_edit_distance=self.fuzzy_max_edit_distance)
+
+      #Everything set by the loading functions above makes up the gazetteers
+      self.gazetteer_attributes = sorted(set(self.__dict__.keys()) - attributes_before) + ['fuzzy_index']
+
+      self.localization_data_loaded = True
+
+      if self.gazetteer_snapshot is not None:
+        self.save_gazetteer_snapshot(self.gazetteer_snapshot)
+    return
+
+  ########################
+  ## GAZETTEER SNAPSHOT ##
+  #######################
+  """
+  Loading the gazetteers means parsing several GML, CSV and Geonames files, and building
+  indexes over them. A snapshot stores the result in a single pickle file, so that every
+  new process (e.g. each worker of a distributed run) can load it in a fraction of the time.
+  Within a machine, sharing is best done by loading the gazetteers once and forking the
+  worker processes afterwards (see sharded_runner.py): the memory pages holding them are then
+  shared by all workers, as long as they are not written to.
+  """
+  def get_gazetteer_snapshot_version(self):
+    #A snapshot is only valid for the same source files (IGN and Geonames), fuzzy matching settings
+    #and snapshot format
+    package_folder = os.path.dirname(os.path.realpath(__file__))
+    paths = []
+    for dirpath, _, filenames in os.walk(os.path.join(package_folder, 'loc_files')):
+      paths.extend([os.path.join(dirpath, filename) for filename in filenames])
+    paths.append(os.path.join(package_folder, 'geonames', 'ES', 'ES.txt'))
+
+    files = []
+    for path in paths:
+      if os.path.isfile(path):
+        stat = os.stat(path)
+        files.append((os.path.relpath(path, package_folder), stat.st_size, int(stat.st_mtime)))
+    return {'format': self.SNAPSHOT_FORMAT, 'files': sorted(files), 'do_fuzzy_matching': self.do_fuzzy_matching,
+            'fuzzy_max_edit_distance': self.fuzzy_max_edit_distance}
+
+  def save_gazetteer_snapshot(self, path):
+    self.load_geolocation_data()
+
+    snapshot = {'version': self.get_gazetteer_snapshot_version(),
+                'attributes': {attribute: getattr(self, attribute) for attribute in self.gazetteer_attributes}}
+
+    if os.path.dirname(path) != '':
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    return
+
+  def load_gazetteer_snapshot(self, path):
+    #Returns False (and loads nothing) if the snapshot is missing or out of date
+    if not os.path.isfile(path):
+      return False
+
+    with open(path, 'rb') as f:
+      snapshot = pickle.load(f)
+
+    if snapshot['version'] != self.get_gazetteer_snapshot_version():
+      return False
+
+    for attribute, value in snapshot['attributes'].items():
+      setattr(self, attribute, value)
+    self.gazetteer_attributes = list(snapshot['attributes'].keys())
+
+    return True
   
   #############################
   ## Loading data functions ##
@@ -85,6 +261,8 @@ class NERLocation:
 
     self.geonames = self.load_geonames_data()
 
+    self.river_basins = self.load_river_basins_data()
+
     return
 
   def load_towns_data(self):
@@ -129,6 +307,7 @@ class NERLocation:
     return towns
 
   def load_provinces_data(self):
+    import geopandas
   
     prov_alt_names = dict()
     prov = geopandas.read_file(os.path.join((os.path.join(os.path.dirname(os.path.realpath(__file__)), 'loc_files')),'au_AdministrativeUnit_3rdOrder0.gml'))
@@ -142,6 +321,7 @@ class NERLocation:
     return prov, prov_alt_names
   
   def load_autonomous_communities_data(self):
+    import geopandas
 
     comm_alt_names = dict()
     comm =  geopandas.read_file(os.path.join((os.path.join(os.path.dirname(os.path.realpath(__file__)), 'loc_files')),'au_AdministrativeUnit_2ndOrder0.gml'))
@@ -154,12 +334,20 @@ class NERLocation:
 
     return comm, comm_alt_names
 
+  def load_river_basins_data(self):
+    #River basins (IGN). Only used for the spatial join of resolved locations, not for
+    #matching toponyms: river names are matched against the MiTEco data loaded below
+    import geopandas
+    return geopandas.read_file(os.path.join((os.path.join(os.path.dirname(os.path.realpath(__file__)), 'loc_files')),'hy-p_RiverBasin0.gml'))
+
   def parse_KML_miteco_file(self,filepath):
 
       #Parses the KML file format provided by Ministerio para la Transicion Ecologica (MiTEco)
       #For loading this file, we've written our own custom parser for KML files. This file format uses
       #XML, so it's just a matter of iterating over each individual XML entry and finding the appropriate information.
       
+      import pandas as pd
+
       tree = ET.parse(filepath)
       root = tree.getroot()
       
@@ -252,6 +440,7 @@ class NERLocation:
       return pd.DataFrame().from_dict(df_tmp)
 
   def load_rivers_data(self):
+    import pandas as pd
     
     #Loads river names and geometry data from a file provided by Ministerio para la Transicion Ecologica (MiTEco)
     #The data is provided in a KMZ format, a compressed archive (Zip format) which contains a series of KML files.
@@ -611,6 +800,14 @@ class NERLocation:
     self.prov_names = list(self.prov['text'].to_list())
     self.prov_names_with_variants = list(self.alt_prov_names.keys())
 
+    #Sets for constant-time checks of whether a toponym can be found as-is in the gazetteers
+    self.known_toponyms = set(self.town_names) | set(self.comm_names_with_variants) | set(self.prov_names_with_variants) | set(self.country_names)
+    if self.geonames is not None:
+      self.known_toponyms |= set(self.geonames.keys()) | set(self.geonames['ALTERNATIVE_NAMES'].keys())
+    self.known_toponyms_uppercased = set(self.riv_names) | set(self.dam_names)
+
+    self.build_spatial_index()
+
   ###########################
   ## GEOLOCATION FUNCTION ##
   ##########################
@@ -625,6 +822,10 @@ class NERLocation:
     #use information originating only from Spain :-). That way, we can
     #ensure that we do not get an instance of "Guadalajara (México)"
     #instead of "Guadalajara" in Spain.
+    #"doc_sentences" holds one spaCy Span per sentence (views over "doc",
+    #the Doc of the whole article), used for syntactic disambiguation.
+
+    self.load_geolocation_data()
 
     for i, toponyms_list in enumerate(toponyms):
       doc_sentence = doc_sentences[i]
@@ -638,6 +839,15 @@ class NERLocation:
         #be talking about, and where within the database it can be found
         found = ['','']
 
+        #Fuzzy fallback: the toponym cannot be found as-is in any gazetteer, so look
+        #it up under the closest known name (if there is a single closest one).
+        #The corrected name is only used for the gazetteer lookups: the sentence
+        #still contains the original spelling ("surface"), so that is the one the
+        #syntactic disambiguation has to search for
+        surface = toponym
+        if self.do_fuzzy_matching and not self.is_known_toponym(toponym):
+          toponym = self.fuzzy_correct_toponym(toponym,toponyms_metadata[i][j])
+
         #Misc variables
         ambRef = False
         toponym_uppercased = toponym.upper().replace('Á','A').replace('É','E').replace('Í','I').replace('Ó','O').replace('Ú','U').strip()
@@ -675,7 +885,7 @@ class NERLocation:
             #Handling of an exceptional case: Aragón can be both the name of the autonomous community and that of a river ("Aragón" vs. "Río Aragón")
             #Run the toponym through a disambiguation function. By default, the function will return the toponym type "town" if it's not
             #a river, hence the weird check done below
-            if self.disambiguate_toponym_type(toponym,doc_sentence) == 'town':
+            if self.disambiguate_toponym_type(surface,doc_sentence) == 'town':
               found = ['comm', '']
             else:
               found = ['riv', self.riv_names.index('RIO ARAGON')]
@@ -697,8 +907,9 @@ class NERLocation:
 
             #Step 1) Check if the toponym is enclosed by parantheses (ex: "(Zaragoza)"): 90% of the times it will be a province
             is_candidate_province = False
+            doc_sentence = self.parse_sentence(doc_sentence)
             for token in doc_sentence:
-              if token.text == toponym:
+              if token.text == surface:
                 for left in token.lefts:
                   if left.text == '(' and left.tag_ == 'PUNCT' and left.idx == (token.idx-1):
                     is_candidate_province = True
@@ -715,7 +926,7 @@ class NERLocation:
             #Step 2) Run this toponym through our toponym type disambiguation function, which will try to check if the toponym is preceeded
             #by the keyword "provincia(s)". If it doesn't find that reference, it will default to identifying it as a town.
             if ambRef:
-              found[0] = self.disambiguate_toponym_type(toponym,doc_sentence)
+              found[0] = self.disambiguate_toponym_type(surface,doc_sentence)
 
               if found[0] != 'town': #BUGFIX: The output of the entry could be 'river' or 'dam', not necessarily 'town'!
                   if found[0] != 'prov':
@@ -750,7 +961,7 @@ class NERLocation:
             #still keeping a small check to see if we could potentially be talking about these specific rivers, we run that toponym
             #through the disambiguation function to see if it's preceded by the keyword "río". Then, AND ONLY THEN, we will assume
             #it's talking about the rivers, not the countries.
-            if self.disambiguate_toponym_type(toponym,doc_sentence) == 'riv':
+            if self.disambiguate_toponym_type(surface,doc_sentence) == 'riv':
               found = ['riv', self.riv_names.index('RIO ' + toponym_uppercased.strip())]
             else:
               if toponym in self.country_names:
@@ -762,7 +973,7 @@ class NERLocation:
         
         #6-Dams/reservoirs
         if toponym_uppercased.strip() in self.dam_names:
-          toponym_type = self.disambiguate_toponym_type(toponym,doc_sentence)
+          toponym_type = self.disambiguate_toponym_type(surface,doc_sentence)
           if toponym_type == 'dam':
             found = ['dam', self.dam_names.index(toponym_uppercased.strip())]
 
@@ -781,7 +992,7 @@ class NERLocation:
             #If a name is shared across these two IGN entries, run a 
             #function that attempts to disambiguate the current
             #toponym's type based on some linguistic cues.
-            toponym_type = self.disambiguate_toponym_type(toponym,doc_sentence)
+            toponym_type = self.disambiguate_toponym_type(surface,doc_sentence)
             
             if toponym_type == 'riv':
               #River
@@ -1001,10 +1212,59 @@ class NERLocation:
   
     return toponyms_metadata
   
+  ###############################
+  ## FUZZY TOPONYMS LOOKUP ##
+  ##############################
+
+  def is_known_toponym(self,toponym):
+    #Mirrors the exact lookups done by the geolocation function above
+    toponym_uppercased = toponym.upper().replace('Á','A').replace('É','E').replace('Í','I').replace('Ó','O').replace('Ú','U').strip()
+    return toponym in self.known_toponyms or toponym_uppercased in self.known_toponyms_uppercased or 'RIO ' + toponym_uppercased in self.known_toponyms_uppercased
+
+  def fuzzy_correct_toponym(self,toponym,toponym_metadata):
+    #Returns the known name closest to the toponym, or the toponym itself if there is none, or if
+    #several different names are equally close. Corrections are recorded in the toponym's metadata
+    #under the key "fuzzy_match", and counted in "self.fuzzy_stats"
+    if self.fuzzy_index is None or len(toponym.strip()) < self.fuzzy_min_length:
+      return toponym
+
+    self.fuzzy_stats['lookups'] += 1
+
+    max_edit_distance = min(self.fuzzy_max_edit_distance, len(toponym.strip()) // 4)
+    candidates = self.fuzzy_index.lookup(toponym.strip(), max_edit_distance=max_edit_distance, closest_only=True)
+
+    if len(candidates) == 0:
+      self.fuzzy_stats['not_found'] += 1
+      return toponym
+
+    best_distance = candidates[0][1]
+    best_candidates = [candidate for candidate, _ in candidates]
+    if len(set([self.fuzzy_index.normalize(candidate) for candidate in best_candidates])) > 1:
+      self.fuzzy_stats['ambiguous'] += 1
+      return toponym
+
+    #Different spellings of a same normalized name ("Ávila" and "AVILA"): prefer one that is found as-is
+    corrected = best_candidates[0]
+    for candidate in best_candidates:
+      if candidate in self.known_toponyms:
+        corrected = candidate
+        break
+
+    self.fuzzy_stats['corrected'] += 1
+    toponym_metadata['fuzzy_match'] = {'name': corrected, 'distance': best_distance}
+
+    return corrected
+
   ##############################
   ## TOPONYMS DISAMBIGUATION ##
   #############################
 
+  def parse_sentence(self,sentence):
+    if self.sentence_parser is not None:
+      return self.sentence_parser(sentence)
+    return sentence
+
+
   def disambiguate_toponym_type(self,toponym,doc):
     #Function that attempts to disambiguate the toponym type of names that are shared across rivers, towns and provinces
     #(Río Turia vs. Turia; Huesca vs. provincia de Huesca). It does so via the use of some heuristic rules based on
@@ -1012,6 +1272,9 @@ class NERLocation:
     #a library that had been used in a prior step to split each text into the set of its sentences. Other than sentence
     #splitting, we also keep the dependency relations of each of the tokens, as output by spaCy, and use them here to
     #check the syntactic relationships between a toponym and its surrounding words.
+    #"doc" is the spaCy Span of the sentence the toponym was found in.
+
+    doc = self.parse_sentence(doc)
 
     token_type = 'town' #Return this value by default (default to "town")
     for i, token in enumerate(doc):
@@ -1052,19 +1315,20 @@ class NERLocation:
               #can refer to both a city and a river, it is usually a river (or a sports team; "el Barcelona") when precedeed by an article ("el Turia").
               lefts = [left for left in token.lefts]
               if len(lefts) == 0:
-                  try:
-                      left_token = doc[i-1]
-                  except IndexError:
+                  #"doc" is a sentence (a Span over the article's Doc): "i" is relative to the start of the
+                  #sentence, and its first token has no left neighbour (doc[-1] would be its last token)
+                  if i == 0:
                       token_type = 'town'
                       return token_type
+                  left_token = doc[i-1]
                   if left_token.dep_ == 'det' and left_token.head.text == token.text:
                       if left_token.text == 'el':
                         token_type = 'riv'
                     
-                #3b) "al/del Turia"
-                elif left_token.dep_ == 'case' and left_token.head.text == token.text:
-                  if left_token.text == 'al' or left_token.text == 'del':
-                    token_type = 'riv'
+                  #3b) "al/del Turia"
+                  elif left_token.dep_ == 'case' and left_token.head.text == token.text:
+                    if left_token.text == 'al' or left_token.text == 'del':
+                      token_type = 'riv'
               for left_token in token.lefts:
                 #3a) "el Turia"
                 if left_token.dep_ == 'det' and left_token.head.text == token.text:
@@ -1081,7 +1345,172 @@ class NERLocation:
   
   def geolocation(self,toponyms,toponyms_metadata,doc,doc_sentence,simplifyPolylines=False):
     return self.geolocation_IGN(toponyms,toponyms_metadata,doc,doc_sentence,simplifyPolylines)
-  
+
+  ################################
+  ## NER ENGINES COMPARISON ##
+  ###############################
+
+  def compare_ner_engines(self,texts):
+    #Runs both NER engines over the same list of texts (sentences), without geocoding, and reports
+    #the throughput of each one, as well as how much the output of the gazetteer engine agrees
+    #with that of the Transformer model (which is taken as the reference). Agreement is given
+    #both for exact spans and for overlapping spans ("Zaragoza" vs. "provincia de Zaragoza")
+    import time
+
+    if self.pipe is None:
+      from transformers import pipeline
+      self.pipe = pipeline("token-classification", model=self.model_name, device=self.device)
+    self.load_gazetteer_matcher()
+
+    start_time = time.perf_counter()
+    _, transformer_metadata = self.loc_tokens_aggregation(self.pipe(texts),texts)
+    transformer_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    _, gazetteer_metadata = self.gazetteer_matcher(texts)
+    gazetteer_time = time.perf_counter() - start_time
+
+    reference_spans = [[(m['start'], m['end']) for m in text_metadata] for text_metadata in transformer_metadata]
+    predicted_spans = [[(m['start'], m['end']) for m in text_metadata] for text_metadata in gazetteer_metadata]
+
+    def overlaps(span, spans):
+      return any([span[0] < other[1] and other[0] < span[1] for other in spans])
+
+    exact_matches = sum([len(set(reference) & set(predicted)) for reference, predicted in zip(reference_spans, predicted_spans)])
+    overlap_precision_matches = sum([len([span for span in predicted if overlaps(span, reference)]) for reference, predicted in zip(reference_spans, predicted_spans)])
+    overlap_recall_matches = sum([len([span for span in reference if overlaps(span, predicted)]) for reference, predicted in zip(reference_spans, predicted_spans)])
+
+    num_reference = sum([len(spans) for spans in reference_spans])
+    num_predicted = sum([len(spans) for spans in predicted_spans])
+
+    def scores(precision_matches, recall_matches):
+      precision = precision_matches / num_predicted if num_predicted > 0 else 0.0
+      recall = recall_matches / num_reference if num_reference > 0 else 0.0
+      f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+      return {'precision': precision, 'recall': recall, 'f1': f1}
+
+    return {
+      'texts': len(texts),
+      'transformer': {'seconds': transformer_time,
+                      'texts_per_second': len(texts) / transformer_time if transformer_time > 0 else None,
+                      'toponyms': num_reference},
+      'gazetteer': {'seconds': gazetteer_time,
+                    'texts_per_second': len(texts) / gazetteer_time if gazetteer_time > 0 else None,
+                    'toponyms': num_predicted},
+      'agreement': {'exact': scores(exact_matches, exact_matches),
+                    'overlap': scores(overlap_precision_matches, overlap_recall_matches)}
+    }
+
+  ###############################
+  ## SPATIAL INDEX AND ROLLUP ##
+  ##############################
+  """
+  Resolved locations only carry a point (or a centroid, for areas such as rivers
+  or provinces). The functions below assign each of them to the province, autonomous
+  community and river basin that contain that point, so that results can be aggregated
+  per region. Polygons are indexed in an STRtree, and all points of a corpus are queried
+  against it at once, which is orders of magnitude faster than testing them one by one.
+  """
+
+  #Name of the key added to each location's metadata, and the layer it is looked up in
+  SPATIAL_LAYERS = ('province', 'community', 'river_basin')
+
+  def build_spatial_index(self):
+
+    self.spatial_index = dict()
+
+    for layer, df in zip(self.SPATIAL_LAYERS, (self.prov, self.comm, self.river_basins)):
+      self.spatial_index[layer] = (shapely.STRtree(df['geometry'].to_numpy()), np.asarray(df['text'].to_list(), dtype=object))
+
+    return
+
+  def get_location_centroid(self,toponym_metadata):
+    #Returns the (longitude, latitude) point of a resolved location, or None if it
+    #could not be resolved. Countries are left out: they lie outside of the polygons we index
+    if toponym_metadata.get('type', 'UNK') in ('', 'UNK', 'country'):
+      return None
+
+    coordinates = toponym_metadata.get('coordinates_centroid_values')
+    if coordinates is None:
+      #Some branches of the geolocation function (ambiguous towns) only fill in "coordinates"
+      coordinates = toponym_metadata.get('coordinates')
+      if not isinstance(coordinates, dict):
+        return None
+
+    return float(coordinates['longitude']), float(coordinates['latitude'])
+
+  def attach_administrative_units(self,toponyms_metadata):
+    #Adds the keys in SPATIAL_LAYERS to every metadata dictionary in the (flat) list passed in.
+    #Locations that could not be resolved, or that fall outside all polygons, get None.
+    #All points are joined in a single bulk query per layer.
+
+    self.load_geolocation_data()
+
+    with metrics.stage('ner_loc.spatial_join', items=len(toponyms_metadata)):
+      return self.join_administrative_units(toponyms_metadata)
+
+  def join_administrative_units(self,toponyms_metadata):
+    located_metadata = []
+    longitudes = []
+    latitudes = []
+    for toponym_metadata in toponyms_metadata:
+      for layer in self.SPATIAL_LAYERS:
+        toponym_metadata[layer] = None
+
+      centroid = self.get_location_centroid(toponym_metadata)
+      if centroid is not None:
+        located_metadata.append(toponym_metadata)
+        longitudes.append(centroid[0])
+        latitudes.append(centroid[1])
+
+    if len(located_metadata) == 0:
+      return toponyms_metadata
+
+    points = shapely.points(np.asarray(longitudes), np.asarray(latitudes))
+
+    for layer, (tree, names) in self.spatial_index.items():
+      points_idx, polygons_idx = tree.query(points, predicate='within')
+      for point_idx, polygon_idx in zip(points_idx, polygons_idx):
+        #A point on a shared border is within two polygons: keep the first one
+        if located_metadata[point_idx][layer] is None:
+          located_metadata[point_idx][layer] = names[polygon_idx]
+
+    return toponyms_metadata
+
+  def rollup_by_region(self,predictions):
+    #Corpus-level aggregate of the output of DroughtClassifier. For every layer (province,
+    #community, river basin) and region, it counts how many articles mention a location
+    #within that region, and how many of those articles were classified with each impact.
+    #An article mentioning several towns of the same province is counted only once.
+    #Expects locations to have gone through "attach_administrative_units" first.
+    #
+    #Output format:
+    #  {'province': {'Zaragoza': {'articles': 12, 'impacts': {'Agricultura': 7, ...}}, ...}, ...}
+
+    rollup = {layer: dict() for layer in self.SPATIAL_LAYERS}
+
+    for prediction in predictions:
+      regions = {layer: set() for layer in self.SPATIAL_LAYERS}
+      for _, sentence_metadata in prediction['locations']:
+        for toponym_metadata in sentence_metadata:
+          for layer in self.SPATIAL_LAYERS:
+            if toponym_metadata.get(layer) is not None:
+              regions[layer].add(toponym_metadata[layer])
+
+      for layer, layer_regions in regions.items():
+        for region in layer_regions:
+          if region not in rollup[layer]:
+            rollup[layer][region] = {'articles': 0, 'impacts': defaultdict(int)}
+          rollup[layer][region]['articles'] += 1
+          for impact in prediction['impacts']:
+            rollup[layer][region]['impacts'][impact] += 1
+
+    for layer in rollup.values():
+      for region in layer.values():
+        region['impacts'] = dict(region['impacts'])
+
+    return rollup
+
   #########################
   ## CLASS' CALL METHOD ##
   ########################
@@ -1091,15 +1520,26 @@ class NERLocation:
     toponyms = []
     toponyms_metadata = []
 
-    #Call NER model to predict tokens
-    predicted_token_class = self.pipe(text)
+    self.load_model()
+
+    if self.engine == 'gazetteer':
+      #Look up gazetteer names directly in the text (same output format as the aggregation below)
+      with metrics.stage('ner_loc.aggregation', items=len(text)):
+        toponyms, toponyms_metadata = self.gazetteer_matcher(text)
+    else:
+      #Call NER model to predict tokens
+      with metrics.stage('ner_loc.model', items=len(text)):
+        predicted_token_class = self.pipe(text)
+      metrics.observe('batch_size', len(text), stage='ner_loc.model')
 
-    #Do token aggregation over the output of the Transformer-based model
-    toponyms, toponyms_metadata = self.loc_tokens_aggregation(predicted_token_class,text)
+      #Do token aggregation over the output of the Transformer-based model
+      with metrics.stage('ner_loc.aggregation', items=len(text)):
+        toponyms, toponyms_metadata = self.loc_tokens_aggregation(predicted_token_class,text)
 
     #Retrieve geolocation of located toponyms and output coordinates for each of the found toponyms
     if self.do_geocoding:
-      toponyms_metadata = self.geolocation(toponyms,toponyms_metadata,doc,doc_sentence)
+      with metrics.stage('ner_loc.geolocation', items=sum([len(sentence_toponyms) for sentence_toponyms in toponyms])):
+        toponyms_metadata = self.geolocation(toponyms,toponyms_metadata,doc,doc_sentence)
     
     return toponyms,toponyms_metadata
   
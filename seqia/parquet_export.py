@@ -0,0 +1,216 @@
+"""
+Columnar (Apache Parquet) export of the results of DroughtClassifier, for analytics.
+
+Results are written to three tables in a folder, which can be read in bulk (pandas,
+Polars, DuckDB, Spark, GeoPandas...) without parsing the nested format described in
+OUTPUT_FORMAT.md:
+
+ - articles.parquet: one row per article, with its "article_id" (0-based position
+   in the results), "filename", publication "date", "drought", one boolean column per impact
+   ("Agricultura", "Ganadería", "Recursos_hídricos", "Energético"), plus
+   "near_duplicate_of" (see OUTPUT_FORMAT.md).
+ - locations.parquet: one row per location found, with its "article_id",
+   "sentence" (index in "sentences_idx"), "toponym", "start", "end", "type", the
+   "latitude" and "longitude" of its centroid, its "province", "community" and
+   "river_basin", and the "geometry_id" of its geometry (None for UNK locations).
+ - geometries.parquet: one row per distinct geometry, with its "geometry_id" and the
+   "geometry" itself (WKB, longitude/latitude in WGS 84), as GeoParquet 1.0, so
+   geopandas.read_parquet returns a GeoDataFrame.
+
+Rows are kept in memory until a table has "row_group_size" of them, and are then
+written as a row group, so the export can follow DroughtClassifier.stream without
+holding every result. Requires pyarrow (pip install pyarrow).
+
+    with ParquetResultWriter('results_parquet', coordinate_precision=5) as writer:
+        for results in classifier.stream(articles):
+            writer.write_all(results)
+"""
+
+import json
+import os
+from datetime import date
+
+import shapely
+
+from . result_writers import GeometryTable, to_plain_value
+
+#Impact columns of the articles table
+IMPACTS = ['Agricultura', 'Ganadería', 'Recursos_hídricos', 'Energético']
+
+#Metadata keys of locations that are copied as they are to the locations table
+LOCATION_KEYS = ['start', 'end', 'type', 'province', 'community', 'river_basin']
+
+class PendingGeometryTable(GeometryTable):
+
+    #GeometryTable (see result_writers.py) that keeps new geometries in a list, as WKB, instead of writing them
+
+    def __init__(self, coordinate_precision=None):
+        GeometryTable.__init__(self, None, coordinate_precision)
+        self.pending = []
+
+    def add(self, geometry_id, geometry):
+        if isinstance(geometry, str):
+            geometry = shapely.from_geojson(geometry)
+        else:
+            geometry = shapely.Point(float(geometry['longitude']), float(geometry['latitude']))
+        self.pending.append((geometry_id, shapely.to_wkb(geometry), geometry.geom_type))
+        return
+
+class ParquetResultWriter:
+
+    def __init__(self, folder, row_group_size=10000, coordinate_precision=None, compression='zstd'):
+        self.folder = folder
+        self.row_group_size = row_group_size
+        self.coordinate_precision = coordinate_precision
+        self.compression = compression
+
+        self.writers = dict()
+        self.geometries = None
+        self.geometry_types = set()
+        self.num_articles = 0
+        self.reset_buffers()
+
+    def reset_buffers(self, tables=('articles', 'locations')):
+        if 'articles' in tables:
+            self.articles = {name: [] for name in ['article_id', 'filename', 'date', 'drought'] + IMPACTS + ['near_duplicate_of']}
+        if 'locations' in tables:
+            self.locations = {name: [] for name in ['article_id', 'sentence', 'toponym'] + LOCATION_KEYS + ['latitude', 'longitude', 'geometry_id']}
+        return
+
+    def get_schemas(self):
+        import pyarrow as pa
+
+        return {
+            'articles': pa.schema([('article_id', pa.int64()), ('filename', pa.string()), ('date', pa.date32()), ('drought', pa.bool_())] +
+                                  [(impact, pa.bool_()) for impact in IMPACTS] + [('near_duplicate_of', pa.string())]),
+            'locations': pa.schema([('article_id', pa.int64()), ('sentence', pa.int32()), ('toponym', pa.string()),
+                                    ('start', pa.int32()), ('end', pa.int32()), ('type', pa.string()),
+                                    ('province', pa.string()), ('community', pa.string()), ('river_basin', pa.string()),
+                                    ('latitude', pa.float64()), ('longitude', pa.float64()), ('geometry_id', pa.int64())]),
+            'geometries': pa.schema([('geometry_id', pa.int64()), ('geometry', pa.binary())])
+        }
+
+    def open(self):
+        import pyarrow.parquet as pq
+
+        os.makedirs(self.folder, exist_ok=True)
+        self.schemas = self.get_schemas()
+        for table in ['articles', 'locations']:
+            self.writers[table] = pq.ParquetWriter(self.get_path(table), self.schemas[table], compression=self.compression)
+        self.geometries = PendingGeometryTable(self.coordinate_precision)
+        #The geometries table is written last, once the GeoParquet metadata (geometry types, bounding box) is known
+        self.bbox = None
+        self.writers['geometries'] = pq.ParquetWriter(self.get_path('geometries') + '.tmp', self.schemas['geometries'], compression=self.compression)
+        return self
+
+    def get_path(self, table):
+        return os.path.join(self.folder, table + '.parquet')
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    ##########
+    ## ROWS ##
+    #########
+    def get_centroid(self, metadata):
+        point = metadata.get('coordinates_centroid_values')
+        if point is None and isinstance(metadata.get('coordinates'), dict):
+            point = metadata['coordinates']
+        if point is None:
+            return None, None
+        latitude, longitude = float(point['latitude']), float(point['longitude'])
+        if self.coordinate_precision is not None:
+            latitude, longitude = round(latitude, self.coordinate_precision), round(longitude, self.coordinate_precision)
+        return latitude, longitude
+
+    def write(self, result):
+        article_id = self.num_articles
+        self.num_articles += 1
+
+        impacts = set(result.get('impacts') or [])
+        self.articles['article_id'].append(article_id)
+        self.articles['filename'].append(result.get('filename'))
+        self.articles['date'].append(date.fromisoformat(result['date']) if result.get('date') is not None else None)
+        self.articles['drought'].append(result.get('drought'))
+        for impact in IMPACTS:
+            self.articles[impact].append(impact in impacts)
+        self.articles['near_duplicate_of'].append(result.get('near_duplicate_of'))
+
+        for sentence, (toponyms, sentence_metadata) in enumerate(result.get('locations') or []):
+            for toponym, metadata in zip(toponyms, sentence_metadata):
+                metadata = to_plain_value(metadata)
+                self.locations['article_id'].append(article_id)
+                self.locations['sentence'].append(sentence)
+                self.locations['toponym'].append(toponym)
+                for key in LOCATION_KEYS:
+                    self.locations[key].append(metadata.get(key))
+                latitude, longitude = self.get_centroid(metadata)
+                self.locations['latitude'].append(latitude)
+                self.locations['longitude'].append(longitude)
+                coordinates = metadata.get('coordinates')
+                self.locations['geometry_id'].append(self.geometries.get_id(coordinates) if coordinates is not None else None)
+
+        if len(self.articles['article_id']) >= self.row_group_size:
+            self.flush('articles')
+        if len(self.locations['article_id']) >= self.row_group_size:
+            self.flush('locations')
+        if len(self.geometries.pending) >= self.row_group_size:
+            self.flush('geometries')
+        return
+
+    def write_all(self, results):
+        for result in results:
+            self.write(result)
+        return
+
+    def flush(self, table):
+        #Writes the buffered rows of a table as a row group
+        import pyarrow as pa
+
+        if table == 'geometries':
+            if len(self.geometries.pending) == 0:
+                return
+            geometry_ids, wkbs, geometry_types = zip(*self.geometries.pending)
+            self.geometries.pending = []
+            self.geometry_types.update(geometry_types)
+            bounds = shapely.total_bounds(shapely.from_wkb(list(wkbs)))
+            self.bbox = list(bounds) if self.bbox is None else [min(self.bbox[0], bounds[0]), min(self.bbox[1], bounds[1]),
+                                                                max(self.bbox[2], bounds[2]), max(self.bbox[3], bounds[3])]
+            columns = {'geometry_id': list(geometry_ids), 'geometry': list(wkbs)}
+        else:
+            columns = self.articles if table == 'articles' else self.locations
+            if len(columns['article_id']) == 0:
+                return
+            self.reset_buffers([table])
+
+        self.writers[table].write_table(pa.table(columns, schema=self.schemas[table]))
+        return
+
+    def close(self):
+        import pyarrow.parquet as pq
+
+        if len(self.writers) == 0:
+            return
+        for table in ['articles', 'locations', 'geometries']:
+            self.flush(table)
+            self.writers[table].close()
+        self.writers = dict()
+
+        #Copies the row groups of the geometries table into the final file, whose schema has the GeoParquet metadata
+        tmp_path = self.get_path('geometries') + '.tmp'
+        geo = {'version': '1.0.0', 'primary_column': 'geometry',
+               'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': sorted(self.geometry_types)}}}
+        if self.bbox is not None:
+            geo['columns']['geometry']['bbox'] = [float(value) for value in self.bbox]
+        schema = self.schemas['geometries'].with_metadata({b'geo': json.dumps(geo).encode('utf-8')})
+        source = pq.ParquetFile(tmp_path)
+        with pq.ParquetWriter(self.get_path('geometries'), schema, compression=self.compression) as writer:
+            for i in range(source.num_row_groups):
+                writer.write_table(source.read_row_group(i).replace_schema_metadata(schema.metadata))
+        source.close()
+        os.remove(tmp_path)
+        return
@@ -0,0 +1,171 @@
+"""
+Pipelined execution of a sequence of stages.
+
+Each stage runs in its own worker thread(s), and consecutive stages are connected
+by bounded queues. While a stage processes an item, the previous stages can already
+work on the next ones (e.g. loading and sentence splitting of the next chunk of
+articles overlap with model inference over the current one). When a queue is full,
+the stage that feeds it blocks until there is room again (backpressure), so the
+number of items in flight, and thus memory use, is bounded.
+
+Models release Python's GIL during inference, so threads are enough to overlap
+CPU-side work (JSON loading, spaCy, aggregation, geolocation) with PyTorch.
+"""
+
+import queue
+import threading
+import time
+
+class PipelinedExecutor:
+
+    #Marks the end of the input in a queue
+    END = object()
+
+    def __init__(self, stages, queue_size=2):
+        #"stages" is a list of (name, function, number_of_workers) tuples. Each function takes the
+        #output of the previous stage and returns its own output. Stages that keep state across items
+        #(or whose side effects depend on the order of the items) must have a single worker; the output
+        #of the pipeline is always yielded in the same order as its input
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = dict()
+        self.wall_time = 0
+
+        return
+
+    def stage_worker(self, name, function, input_queue, output_queue, state):
+        stats = self.stats[name]
+        while True:
+            start = time.perf_counter()
+            item = input_queue.get()
+            stats['waiting_input_seconds'] += time.perf_counter() - start
+
+            if item is self.END:
+                with state['lock']:
+                    state['active_workers'] -= 1
+                    last_worker = state['active_workers'] == 0
+                if last_worker:
+                    for _ in range(state['next_workers']):
+                        output_queue.put(self.END)
+                return
+
+            seq, value = item
+
+            #After an error, keep draining the input (so that upstream stages never block), but skip the work
+            if self.error is None:
+                try:
+                    start = time.perf_counter()
+                    value = function(value)
+                    stats['busy_seconds'] += time.perf_counter() - start
+                    stats['items'] += 1
+                except BaseException as e:
+                    self.error = e
+                    continue
+            else:
+                continue
+
+            start = time.perf_counter()
+            output_queue.put((seq, value))
+            stats['waiting_output_seconds'] += time.perf_counter() - start
+
+    def feeder(self, items, output_queue, next_workers):
+        stats = self.stats['input']
+        try:
+            iterator = iter(items)
+            seq = 0
+            while self.error is None:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                stats['busy_seconds'] += time.perf_counter() - start
+                stats['items'] += 1
+
+                start = time.perf_counter()
+                output_queue.put((seq, item))
+                stats['waiting_output_seconds'] += time.perf_counter() - start
+                seq += 1
+        except BaseException as e:
+            self.error = e
+        finally:
+            for _ in range(next_workers):
+                output_queue.put(self.END)
+
+    def run(self, items):
+        #Generator: pushes "items" through all stages, and yields the final outputs in input order.
+        #Reading the input (e.g. loading articles from disk) is accounted for as an extra stage, 'input'
+
+        self.error = None
+        self.stats = {name: {'workers': workers, 'items': 0, 'busy_seconds': 0.0, 'waiting_input_seconds': 0.0, 'waiting_output_seconds': 0.0}
+                      for name, _, workers in [('input', None, 1)] + list(self.stages)}
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+
+        threads = [threading.Thread(target=self.feeder, args=(items, queues[0], self.stages[0][2]), daemon=True)]
+        for k, (name, function, workers) in enumerate(self.stages):
+            next_workers = self.stages[k+1][2] if k + 1 < len(self.stages) else 1
+            state = {'lock': threading.Lock(), 'active_workers': workers, 'next_workers': next_workers}
+            for _ in range(workers):
+                threads.append(threading.Thread(target=self.stage_worker, args=(name, function, queues[k], queues[k+1], state), daemon=True))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        #Stages with several workers can finish items out of order: buffer them until it is their turn
+        pending = dict()
+        next_seq = 0
+        finished = False
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is self.END:
+                    finished = True
+                    break
+                pending[item[0]] = item[1]
+                while next_seq in pending:
+                    yield pending.pop(next_seq)
+                    next_seq += 1
+        finally:
+            if not finished:
+                #The generator was closed before the end (e.g. "break" in the caller's loop): stop reading the input
+                #and skip the work, as after an error, and drain the last queue, so that no worker stays blocked on a
+                #full queue. Every worker then reaches the end of its input and exits
+                if self.error is None:
+                    self.error = GeneratorExit()
+                while queues[-1].get() is not self.END:
+                    pass
+
+            for thread in threads:
+                thread.join()
+            self.wall_time = time.perf_counter() - start
+
+        if self.error is not None:
+            raise self.error
+
+        return
+
+    def report(self):
+        #Per-stage utilisation: the fraction of the wall time its workers spent working. The stage with the
+        #highest utilisation is the bottleneck; stages that mostly wait for input are starved by it, and
+        #stages that mostly wait to hand over their output are blocked by it (backpressure)
+        report = {'wall_seconds': self.wall_time, 'stages': dict()}
+        for name, stats in self.stats.items():
+            capacity = self.wall_time * stats['workers']
+            report['stages'][name] = dict(stats)
+            report['stages'][name]['utilisation'] = stats['busy_seconds'] / capacity if capacity > 0 else 0.0
+
+        stages = report['stages']
+        report['bottleneck'] = max(stages, key=lambda name: stages[name]['utilisation']) if len(stages) > 0 else None
+
+        return report
+
+    def format_report(self):
+        report = self.report()
+        lines = ['Pipeline wall time: %.1f s (bottleneck: %s)' % (report['wall_seconds'], report['bottleneck']),
+                 '%-16s %8s %8s %10s %12s %12s %12s' % ('Stage', 'Workers', 'Items', 'Busy (s)', 'Utilisation', 'Starved (s)', 'Blocked (s)')]
+        for name, stats in report['stages'].items():
+            lines.append('%-16s %8d %8d %10.1f %11.0f%% %12.1f %12.1f' % (name, stats['workers'], stats['items'], stats['busy_seconds'],
+                                                                        100 * stats['utilisation'], stats['waiting_input_seconds'], stats['waiting_output_seconds']))
+        return '\n'.join(lines)
@@ -0,0 +1,286 @@
+"""
+Profiling of selected stages of the pipeline, for hot-path analysis.
+
+A StageProfiler is attached to a DroughtClassifier, and wraps the stages whose names
+match "stages" (the names of seqia/metrics.py: 'binary.model', 'ner_loc.*'...) in a
+profiler, then writes a set of files per stage into "run_dir":
+
+ - mode='deterministic': cProfile. Writes STAGE.pstats (for pstats, snakeviz...) and
+   STAGE.txt (the 50 functions with the highest cumulative time).
+ - mode='sampling': a background thread samples the stack of the thread running the
+   stage every "sampling_interval" seconds. Much lower overhead than cProfile, so
+   timings are closer to those of a normal run. Writes STAGE.collapsed, with one
+   "frame;frame;frame count" line per distinct stack, the input format of
+   flamegraph.pl and speedscope.
+ - torch=True (with either mode): model stages (those matching "torch_stages") also
+   run under torch.profiler, and every call writes STAGE.N.trace.json, a Chrome
+   trace (chrome://tracing, Perfetto) of the operators run by PyTorch.
+
+    from seqia import DroughtClassifier
+    from seqia.profiling import StageProfiler
+
+    profiler = StageProfiler('profiles/run1', stages=['binary.model', 'ner_loc.*'], mode='sampling', max_batches=2)
+    classifier = DroughtClassifier(profiler=profiler)
+    classifier('path/to/folder_with_jsons')
+
+With "max_batches", only the first N batches (chunks of articles whose results are
+gathered, by any of the drivers: __call__, stream, run_pipelined, run_checkpointed)
+are profiled, and the files are written once they are done; otherwise, they are
+written by "write" (also called at exit). With run_pipelined, stages of the next
+chunks that run at the same time as the last profiled batch are profiled too.
+
+cProfile can only profile one stage of the process at a time: in deterministic
+mode, a stage nested in another profiled stage is only profiled as part of the
+outer one, and a stage that starts while another one is being profiled in another
+thread (run_pipelined) is not profiled. Stages are not profiled either if another
+profiling tool is active.
+"""
+
+import atexit
+import cProfile
+import fnmatch
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+class ProfiledStage:
+
+    #Wraps the timer of a stage (see MetricsRegistry.stage), starting and stopping the profilers of the stage around it
+
+    def __init__(self, profiler, name, timer):
+        self.profiler = profiler
+        self.name = name
+        self.timer = timer
+
+    def __enter__(self):
+        self.timer.__enter__()
+        self.profiler.start(self.name)
+        return self.timer
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.stop(self.name)
+        return self.timer.__exit__(exc_type, exc_value, traceback)
+
+class StageProfiler:
+
+    def __init__(self, run_dir, stages=['*'], mode='deterministic', torch=False, torch_stages=['*.model'],
+                 max_batches=None, sampling_interval=0.005):
+        if mode not in ('deterministic', 'sampling'):
+            raise ValueError("Profiling mode must be 'deterministic' or 'sampling', not " + repr(mode))
+
+        self.run_dir = run_dir
+        self.stages = stages
+        self.mode = mode
+        self.torch = torch
+        self.torch_stages = torch_stages
+        self.max_batches = max_batches
+        self.sampling_interval = sampling_interval
+
+        self.lock = threading.Lock()
+        self.thread_state = threading.local()
+        self.batches_finished = 0
+        self.done = False
+        self.written = False
+        self.wanted = dict()
+
+        #Deterministic mode: stage -> cProfile.Profile (accumulated over every call of the stage), and the stage
+        #being profiled by cProfile, in any thread (only one profiler can be enabled at a time in the process)
+        self.profiles = dict()
+        self.cprofile_stage = None
+        #Sampling mode: stage -> {collapsed stack: number of samples}, and thread id -> stages running in that thread
+        self.samples = dict()
+        self.active_stages = dict()
+        self.sampler = None
+        #Torch: stage -> number of traces written
+        self.torch_calls = dict()
+
+        atexit.register(self.write)
+        return
+
+    def is_profiled(self, name, patterns):
+        return any([fnmatch.fnmatchcase(name, pattern) for pattern in patterns])
+
+    def wants(self, name):
+        if name not in self.wanted:
+            self.wanted[name] = self.is_profiled(name, self.stages) or (self.torch and self.is_profiled(name, self.torch_stages))
+        return self.wanted[name]
+
+    def stage(self, name, timer):
+        #Called by MetricsRegistry.stage for every stage: returns the timer, wrapped if the stage is profiled
+        if self.done or not self.wants(name):
+            return timer
+        return ProfiledStage(self, name, timer)
+
+    def is_active(self):
+        return not self.done and (self.max_batches is None or self.batches_finished < self.max_batches)
+
+    def start(self, name):
+        if not self.is_active() or not self.wants(name):
+            self.get_started().append(None)
+            return
+
+        started = []
+        if self.is_profiled(name, self.stages):
+            if self.mode == 'deterministic':
+                if self.start_cprofile(name):
+                    started.append('cprofile')
+            else:
+                self.start_sampling(name)
+                started.append('sampling')
+
+        if self.torch and self.is_profiled(name, self.torch_stages) and getattr(self.thread_state, 'torch_profile', None) is None:
+            import torch.profiler
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.thread_state.torch_profile = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.thread_state.torch_profile.__enter__()
+            started.append('torch')
+
+        self.get_started().append(started)
+        return
+
+    def stop(self, name):
+        started = self.get_started().pop()
+
+        if started is not None:
+            if 'cprofile' in started:
+                self.profiles[name].disable()
+                with self.lock:
+                    self.cprofile_stage = None
+            if 'sampling' in started:
+                self.stop_sampling(name)
+            if 'torch' in started:
+                torch_profile = self.thread_state.torch_profile
+                self.thread_state.torch_profile = None
+                torch_profile.__exit__(None, None, None)
+                with self.lock:
+                    call = self.torch_calls.get(name, 0)
+                    self.torch_calls[name] = call + 1
+                os.makedirs(self.run_dir, exist_ok=True)
+                torch_profile.export_chrome_trace(os.path.join(self.run_dir, name + '.' + str(call) + '.trace.json'))
+        return
+
+    def start_cprofile(self, name):
+        #Enables the cProfile profile of a stage, unless another stage is already being profiled (in this or any
+        #other thread) or another profiling tool is active. Returns whether it was enabled
+        with self.lock:
+            if self.cprofile_stage is not None:
+                return False
+            self.cprofile_stage = name
+            profile = self.profiles.get(name)
+            if profile is None:
+                profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                #Python 3.12+: "Another profiling tool is already active"
+                self.cprofile_stage = None
+                return False
+            self.profiles[name] = profile
+        return True
+
+    def finish_batch(self):
+        #Called by DroughtClassifier once the results of a batch are gathered: counts batches for "max_batches"
+        with self.lock:
+            self.batches_finished += 1
+            finished = self.max_batches is not None and self.batches_finished >= self.max_batches and not self.done
+            if finished:
+                self.done = True
+        if finished:
+            self.write()
+        return
+
+    def get_started(self):
+        #Stack of the profilers started by each stage entered in this thread (None for stages that are not profiled)
+        started = getattr(self.thread_state, 'started', None)
+        if started is None:
+            started = self.thread_state.started = []
+        return started
+
+    ##############
+    ## SAMPLING ##
+    #############
+    def start_sampling(self, name):
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.active_stages.setdefault(thread_id, []).append(name)
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self.sample_loop, name='seqia-profiler', daemon=True)
+                self.sampler.start()
+        return
+
+    def stop_sampling(self, name):
+        thread_id = threading.get_ident()
+        with self.lock:
+            stages = self.active_stages.get(thread_id, [])
+            if name in stages:
+                stages.remove(name)
+            if len(stages) == 0:
+                self.active_stages.pop(thread_id, None)
+        return
+
+    def sample_loop(self):
+        #Every "sampling_interval" seconds, adds the current stack of every thread running a profiled stage to
+        #the samples of those stages (of all of them, if they are nested)
+        while not self.written:
+            time.sleep(self.sampling_interval)
+            with self.lock:
+                if len(self.active_stages) == 0:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stages in self.active_stages.items():
+                    frame = frames.get(thread_id)
+                    if frame is None or len(stages) == 0:
+                        continue
+                    stack = collapse_stack(frame)
+                    for name in set(stages):
+                        samples = self.samples.setdefault(name, dict())
+                        samples[stack] = samples.get(stack, 0) + 1
+        return
+
+    ###########
+    ## WRITE ##
+    ##########
+    def write(self):
+        #Writes the profiles collected so far into "run_dir". Stages still running are left out
+        if self.written:
+            return
+        self.written = True
+        os.makedirs(self.run_dir, exist_ok=True)
+
+        profiled = []
+        for name, profile in list(self.profiles.items()):
+            summary = io.StringIO()
+            try:
+                stats = pstats.Stats(profile, stream=summary)
+            except TypeError:
+                #The profile did not record anything
+                continue
+            profiled.append(name)
+            stats.dump_stats(os.path.join(self.run_dir, name + '.pstats'))
+            stats.sort_stats('cumulative').print_stats(50)
+            with open(os.path.join(self.run_dir, name + '.txt'), 'w', encoding='utf-8') as f:
+                f.write(summary.getvalue())
+
+        with self.lock:
+            samples = {name: dict(stage_samples) for name, stage_samples in self.samples.items()}
+        for name, stage_samples in samples.items():
+            with open(os.path.join(self.run_dir, name + '.collapsed'), 'w', encoding='utf-8') as f:
+                for stack, count in sorted(stage_samples.items()):
+                    f.write(stack + ' ' + str(count) + '\n')
+
+        print("Wrote profiles of", ', '.join(sorted(set(profiled) | set(samples) | set(self.torch_calls))), "to", self.run_dir)
+        return
+
+def collapse_stack(frame):
+    #"outermost;...;innermost" frames, as "function (file:line of the definition)"
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
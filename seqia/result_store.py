@@ -0,0 +1,269 @@
+"""
+Indexed SQLite store of the results of DroughtClassifier, for querying outputs.
+
+Results are written into normalized tables of a single SQLite database file:
+
+ - articles (id, filename, run_id, date, drought, near_duplicate_of)
+ - impacts (article_id, impact): one row per impact of each article
+ - sentences (article_id, sentence, text): the "sentences_idx" of each article
+ - locations (article_id, sentence, toponym, start, end, type, latitude,
+   longitude, province, community, river_basin, geometry_id): one row per location
+ - geometries (id, hash, geometry): every distinct geometry once (GeoJSON text, or
+   the JSON of the latitude and longitude of a town)
+ - runs (id, started, label): one row per run that wrote into the store
+
+with indexes on impacts, location types, toponyms and regions, so that queries such
+as "articles with the Ganadería impact located in a province" take milliseconds.
+
+The store is incremental: every run adds its results to the same database, and an
+article that is written again (same filename) replaces its previous results. Two
+results with the same filename in one run (e.g. files with the same name in
+different subfolders) are not an error: the last one is kept, with a warning.
+Results are inserted in batches of "batch_size" articles, one transaction per batch.
+
+    with SQLiteResultStore('results.db') as store:
+        for results in classifier.stream(articles):
+            store.write_all(results)
+        filenames = store.find_articles(impact='Ganadería', province='Huesca')
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+import warnings
+
+from . result_writers import round_geometry, to_plain_value
+from . sharded_runner import to_json_value
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        started REAL NOT NULL,
+        label TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS articles (
+        id INTEGER PRIMARY KEY,
+        filename TEXT NOT NULL UNIQUE,
+        run_id INTEGER NOT NULL,
+        date TEXT,
+        drought INTEGER,
+        near_duplicate_of TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS impacts (
+        article_id INTEGER NOT NULL,
+        impact TEXT NOT NULL,
+        PRIMARY KEY (article_id, impact))''',
+    '''CREATE TABLE IF NOT EXISTS sentences (
+        article_id INTEGER NOT NULL,
+        sentence INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        PRIMARY KEY (article_id, sentence))''',
+    '''CREATE TABLE IF NOT EXISTS locations (
+        id INTEGER PRIMARY KEY,
+        article_id INTEGER NOT NULL,
+        sentence INTEGER NOT NULL,
+        toponym TEXT NOT NULL,
+        start INTEGER,
+        end INTEGER,
+        type TEXT,
+        latitude REAL,
+        longitude REAL,
+        province TEXT,
+        community TEXT,
+        river_basin TEXT,
+        geometry_id INTEGER)''',
+    '''CREATE TABLE IF NOT EXISTS geometries (
+        id INTEGER PRIMARY KEY,
+        hash TEXT NOT NULL UNIQUE,
+        geometry TEXT NOT NULL)''',
+    'CREATE INDEX IF NOT EXISTS articles_date ON articles (date)',
+    'CREATE INDEX IF NOT EXISTS impacts_impact ON impacts (impact, article_id)',
+    'CREATE INDEX IF NOT EXISTS locations_article ON locations (article_id)',
+    'CREATE INDEX IF NOT EXISTS locations_type ON locations (type, article_id)',
+    'CREATE INDEX IF NOT EXISTS locations_toponym ON locations (toponym, article_id)',
+    'CREATE INDEX IF NOT EXISTS locations_province ON locations (province, article_id)',
+    'CREATE INDEX IF NOT EXISTS locations_community ON locations (community, article_id)',
+    'CREATE INDEX IF NOT EXISTS locations_river_basin ON locations (river_basin, article_id)'
+]
+
+#Filters of "find_articles", and the column they are applied to
+LOCATION_FILTERS = {'location_type': 'type', 'toponym': 'toponym', 'province': 'province', 'community': 'community', 'river_basin': 'river_basin'}
+
+class SQLiteResultStore:
+
+    def __init__(self, path, batch_size=1000, coordinate_precision=None, label=None):
+        #"label" is an optional description of this run, stored in the runs table
+        self.path = path
+        self.batch_size = batch_size
+        self.coordinate_precision = coordinate_precision
+        self.label = label
+        self.connection = None
+        self.run_id = None
+        self.pending = []
+        #Geometry as found in the results -> id in the geometries table (for this session)
+        self.geometry_ids = dict()
+        self.num_results = 0
+
+    def open(self):
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        #Write-ahead logging: readers (queries) are not blocked by a run that is writing
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        return self
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+        return
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            #Keep what was committed so far, but not a partial batch
+            self.pending = []
+        self.close()
+        return False
+
+    def write(self, result):
+        self.pending.append(result)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        return
+
+    def write_all(self, results):
+        for result in results:
+            self.write(result)
+        return
+
+    def flush(self):
+        #Inserts the pending results in a single transaction
+        if len(self.pending) == 0:
+            return
+        #Articles are identified by their filename: if several results of the batch share one (e.g. files with
+        #the same name in different subfolders), only the last one is kept
+        results_by_filename = dict()
+        for result in self.pending:
+            filename = result.get('filename', '')
+            if filename in results_by_filename:
+                warnings.warn("Several results for " + repr(filename) + " in " + self.path + ": only the last one is kept")
+                del results_by_filename[filename]
+            results_by_filename[filename] = result
+        results = list(results_by_filename.values())
+        self.pending = []
+
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if self.run_id is None:
+                self.run_id = connection.execute('INSERT INTO runs (started, label) VALUES (?, ?)', (time.time(), self.label)).lastrowid
+
+            #Results of articles that were already in the store replace the old ones (written by a previous run, or
+            #by an earlier batch of this one, which means two articles with the same filename)
+            filenames = [(filename,) for filename in results_by_filename]
+            for filename in results_by_filename:
+                if connection.execute('SELECT 1 FROM articles WHERE filename = ? AND run_id = ?', (filename, self.run_id)).fetchone() is not None:
+                    warnings.warn("Several results for " + repr(filename) + " in " + self.path + ": only the last one is kept")
+            for table in ['impacts', 'sentences', 'locations']:
+                connection.executemany('DELETE FROM ' + table + ' WHERE article_id = (SELECT id FROM articles WHERE filename = ?)', filenames)
+            connection.executemany('DELETE FROM articles WHERE filename = ?', filenames)
+
+            impacts = []
+            sentences = []
+            locations = []
+            for result in results:
+                drought = result.get('drought')
+                article_id = connection.execute('INSERT INTO articles (filename, run_id, date, drought, near_duplicate_of) VALUES (?, ?, ?, ?, ?)',
+                                                (result.get('filename', ''), self.run_id, result.get('date'), None if drought is None else int(drought),
+                                                 result.get('near_duplicate_of'))).lastrowid
+
+                impacts.extend([(article_id, impact) for impact in dict.fromkeys(result.get('impacts') or [])])
+                sentences.extend([(article_id, int(sentence), text) for sentence, text in (result.get('sentences_idx') or dict()).items()])
+
+                for sentence, (toponyms, sentence_metadata) in enumerate(result.get('locations') or []):
+                    for toponym, metadata in zip(toponyms, sentence_metadata):
+                        metadata = to_plain_value(metadata)
+                        latitude, longitude = self.get_centroid(metadata)
+                        coordinates = metadata.get('coordinates')
+                        locations.append((article_id, sentence, toponym, metadata.get('start'), metadata.get('end'), metadata.get('type'),
+                                          latitude, longitude, metadata.get('province'), metadata.get('community'), metadata.get('river_basin'),
+                                          self.get_geometry_id(coordinates) if coordinates is not None else None))
+
+            connection.executemany('INSERT INTO impacts (article_id, impact) VALUES (?, ?)', impacts)
+            connection.executemany('INSERT INTO sentences (article_id, sentence, text) VALUES (?, ?, ?)', sentences)
+            connection.executemany('''INSERT INTO locations (article_id, sentence, toponym, start, end, type, latitude, longitude,
+                                      province, community, river_basin, geometry_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', locations)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            #Geometries inserted by this transaction are gone too
+            self.geometry_ids = dict()
+            raise
+
+        self.num_results += len(results)
+        return
+
+    def get_centroid(self, metadata):
+        point = metadata.get('coordinates_centroid_values')
+        if point is None and isinstance(metadata.get('coordinates'), dict):
+            point = metadata['coordinates']
+        if point is None:
+            return None, None
+        latitude, longitude = float(point['latitude']), float(point['longitude'])
+        if self.coordinate_precision is not None:
+            latitude, longitude = round(latitude, self.coordinate_precision), round(longitude, self.coordinate_precision)
+        return latitude, longitude
+
+    def get_geometry_id(self, geometry):
+        #Id of a geometry in the geometries table (shared by every run), adding it if needed
+        key = geometry if isinstance(geometry, str) else json.dumps(geometry, sort_keys=True, default=to_json_value)
+        geometry_id = self.geometry_ids.get(key)
+        if geometry_id is not None:
+            return geometry_id
+
+        geometry = round_geometry(geometry, self.coordinate_precision)
+        text = geometry if isinstance(geometry, str) else json.dumps(geometry, sort_keys=True, default=to_json_value)
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+        self.connection.execute('INSERT OR IGNORE INTO geometries (hash, geometry) VALUES (?, ?)', (digest, text))
+        geometry_id = self.connection.execute('SELECT id FROM geometries WHERE hash = ?', (digest,)).fetchone()[0]
+
+        self.geometry_ids[key] = geometry_id
+        return geometry_id
+
+    #############
+    ## QUERIES ##
+    ############
+    def query(self, sql, parameters=()):
+        #Any SQL query over the tables above, e.g.
+        #  store.query('SELECT province, COUNT(DISTINCT article_id) FROM locations GROUP BY province')
+        self.flush()
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def find_articles(self, impact=None, drought=None, **location_filters):
+        #Filenames of the articles with the given impact (and/or drought value), and with at least one location that
+        #matches every given location filter: location_type, toponym, province, community, river_basin. E.g.
+        #  store.find_articles(impact='Ganadería', province='Huesca')
+        conditions = []
+        parameters = []
+        if impact is not None:
+            conditions.append('articles.id IN (SELECT article_id FROM impacts WHERE impact = ?)')
+            parameters.append(impact)
+        if drought is not None:
+            conditions.append('articles.drought = ?')
+            parameters.append(int(drought))
+
+        location_conditions = []
+        for name, value in location_filters.items():
+            if name not in LOCATION_FILTERS:
+                raise ValueError("Unknown location filter: " + name + " (expected one of: " + ', '.join(LOCATION_FILTERS) + ")")
+            location_conditions.append(LOCATION_FILTERS[name] + ' = ?')
+            parameters.append(value)
+        if len(location_conditions) > 0:
+            conditions.append('articles.id IN (SELECT article_id FROM locations WHERE ' + ' AND '.join(location_conditions) + ')')
+
+        sql = 'SELECT filename FROM articles' + (' WHERE ' + ' AND '.join(conditions) if len(conditions) > 0 else '') + ' ORDER BY id'
+        return [row[0] for row in self.query(sql, parameters)]
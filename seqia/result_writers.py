@@ -0,0 +1,276 @@
+"""
+Streaming writers for the results of DroughtClassifier.
+
+Results are written as they are produced (e.g. chunk after chunk of
+DroughtClassifier.stream), so memory use does not grow with the corpus, and every
+row is built in memory and written with a single call to a buffered file.
+
+ - JSONLResultWriter: one JSON object per article (as returned by the classifier).
+   The geometry of a location (the GeoJSON of a river or a province, or the
+   coordinates of a town) is replaced by a "geometry_id", and every distinct
+   geometry is written only once, the first time it is seen, to a separate
+   geometry table (a JSON Lines file of {"id", "geometry"} objects). Coordinates can
+   be rounded to a number of decimals ("coordinate_precision"; 5 decimals are about
+   1 m), which makes geometries smaller and makes near-identical ones share an id.
+ - ImpactsTSVWriter and LocationsTSVWriter: the tab-separated formats of
+   DroughtClassifier.write_impacts_to_csv_file and write_locations_to_text_file.
+
+    with JSONLResultWriter('results.jsonl', coordinate_precision=5) as writer:
+        for results in classifier.stream(articles):
+            writer.write_all(results)
+"""
+
+import json
+
+from . sharded_runner import to_json_value
+
+#Buffer size of output files
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+#(Column name, impact name in results) of the impacts TSV file
+IMPACT_COLUMNS = [('Agricultura', 'Agricultura'), ('Ganadería', 'Ganadería'), ('Hídricos', 'Recursos_hídricos'), ('Energético', 'Energético')]
+
+def round_coordinates(value, precision):
+    #Rounds every number in a (nested) GeoJSON coordinates list, or in a {'latitude', 'longitude'} dictionary
+    if isinstance(value, float):
+        return round(value, precision)
+    if isinstance(value, list):
+        return [round_coordinates(item, precision) for item in value]
+    if isinstance(value, dict):
+        return {key: round_coordinates(item, precision) for key, item in value.items()}
+    return value
+
+def round_geometry(geometry, precision):
+    if precision is None:
+        return geometry
+    if isinstance(geometry, str):
+        #GeoJSON string (areas and rivers)
+        geojson = json.loads(geometry)
+        if 'coordinates' in geojson:
+            geojson['coordinates'] = round_coordinates(geojson['coordinates'], precision)
+        return json.dumps(geojson, separators=(',', ':'))
+    return round_coordinates(to_plain_value(geometry), precision)
+
+def to_plain_value(value):
+    #NumPy numbers (e.g. coordinates of towns) to Python ones
+    if isinstance(value, dict):
+        return {key: to_plain_value(item) for key, item in value.items()}
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+class GeometryTable:
+
+    #Gives an id to every distinct geometry, and writes each geometry (once) to "file", when it is first seen
+
+    def __init__(self, file, coordinate_precision=None):
+        self.file = file
+        self.coordinate_precision = coordinate_precision
+        #Geometry as found in the results -> id. GeoJSON strings are their own keys, so they are only parsed
+        #(for rounding) the first time; point dictionaries are keyed by their (latitude, longitude)
+        self.ids_by_value = dict()
+        #Geometry after rounding -> id (rounding may make two different geometries equal)
+        self.ids_by_rounded_value = dict()
+        self.stats = {'references': 0, 'geometries': 0}
+
+    def get_key(self, geometry):
+        if isinstance(geometry, str):
+            return geometry
+        if isinstance(geometry, dict) and 'latitude' in geometry and 'longitude' in geometry:
+            return (float(geometry['latitude']), float(geometry['longitude']))
+        return json.dumps(geometry, sort_keys=True, default=to_json_value)
+
+    def get_id(self, geometry):
+        self.stats['references'] += 1
+        key = self.get_key(geometry)
+        geometry_id = self.ids_by_value.get(key)
+        if geometry_id is not None:
+            return geometry_id
+
+        rounded = round_geometry(geometry, self.coordinate_precision)
+        rounded_key = rounded if isinstance(rounded, str) else json.dumps(rounded, sort_keys=True, default=to_json_value)
+        geometry_id = self.ids_by_rounded_value.get(rounded_key)
+        if geometry_id is None:
+            geometry_id = len(self.ids_by_rounded_value)
+            self.ids_by_rounded_value[rounded_key] = geometry_id
+            self.add(geometry_id, rounded)
+            self.stats['geometries'] += 1
+
+        self.ids_by_value[key] = geometry_id
+        return geometry_id
+
+    def add(self, geometry_id, geometry):
+        #Writes a new geometry. GeoJSON strings are embedded as JSON, not as strings
+        self.file.write('{"id":' + str(geometry_id) + ',"geometry":' + (geometry if isinstance(geometry, str) else json.dumps(geometry, separators=(',', ':'), default=to_json_value)) + '}\n')
+        return
+
+class JSONLResultWriter:
+
+    def __init__(self, path, geometries_path=None, coordinate_precision=None, intern_geometries=True):
+        #Geometries go to "geometries_path" (default: PATH.geometries.jsonl). With intern_geometries=False,
+        #geometries are kept within each result (only rounded, if a precision is given)
+        self.path = path
+        self.geometries_path = geometries_path if geometries_path is not None else path + '.geometries.jsonl'
+        self.coordinate_precision = coordinate_precision
+        self.intern_geometries = intern_geometries
+        self.file = None
+        self.geometries_file = None
+        self.geometries = None
+        self.num_results = 0
+
+    def open(self):
+        self.file = open(self.path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+        if self.intern_geometries:
+            self.geometries_file = open(self.geometries_path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+            self.geometries = GeometryTable(self.geometries_file, self.coordinate_precision)
+        return self
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.geometries_file is not None:
+            self.geometries_file.close()
+            self.geometries_file = None
+        return
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def compact_metadata(self, metadata):
+        metadata = dict(metadata)
+        if 'coordinates' in metadata:
+            coordinates = metadata.pop('coordinates')
+            if self.intern_geometries:
+                metadata['geometry_id'] = self.geometries.get_id(coordinates) if coordinates is not None else None
+            else:
+                metadata['coordinates'] = round_geometry(coordinates, self.coordinate_precision) if coordinates is not None else None
+        if self.coordinate_precision is not None:
+            if metadata.get('coordinates_centroid_values') is not None:
+                metadata['coordinates_centroid_values'] = round_coordinates(to_plain_value(metadata['coordinates_centroid_values']), self.coordinate_precision)
+            if metadata.get('ALTERNATIVES') is not None:
+                alternatives = dict(metadata['ALTERNATIVES'])
+                alternatives['coordinates'] = [round_coordinates(to_plain_value(coordinates), self.coordinate_precision) for coordinates in alternatives['coordinates']]
+                metadata['ALTERNATIVES'] = alternatives
+        return metadata
+
+    def compact_result(self, result):
+        #Copy of the result with its location metadata compacted (see above). The result itself is left untouched
+        if len(result.get('locations') or []) == 0 or (not self.intern_geometries and self.coordinate_precision is None):
+            return result
+        result = dict(result)
+        result['locations'] = [(toponyms, [self.compact_metadata(metadata) for metadata in sentence_metadata])
+                               for toponyms, sentence_metadata in result['locations']]
+        return result
+
+    def write(self, result):
+        self.file.write(json.dumps(self.compact_result(result), ensure_ascii=False, default=to_json_value) + '\n')
+        self.num_results += 1
+        return
+
+    def write_all(self, results):
+        for result in results:
+            self.write(result)
+        return
+
+class ImpactsTSVWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+        self.file.write('Filename\tDrought\t' + '\t'.join([column for column, _ in IMPACT_COLUMNS]) + '\n')
+        return self
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def write(self, result):
+        if result['drought']:
+            impacts = set(result['impacts'])
+            #Older results name the water resources impact with a space
+            if 'Recursos hídricos' in impacts:
+                impacts.add('Recursos_hídricos')
+            values = ['1' if impact in impacts else '0' for _, impact in IMPACT_COLUMNS]
+        else:
+            values = ['0'] * len(IMPACT_COLUMNS)
+        self.file.write(result['filename'] + '\t' + ('1' if result['drought'] else '0') + '\t' + '\t'.join(values) + '\n')
+        return
+
+    def write_all(self, results):
+        for result in results:
+            self.write(result)
+        return
+
+class LocationsTSVWriter:
+
+    def __init__(self, path, include_coordinates=False, coordinate_precision=None):
+        #With include_coordinates=True, the latitude and longitude of every location (the centroid, for areas
+        #and rivers) are added, or 0 and 0 for locations that could not be found
+        self.path = path
+        self.include_coordinates = include_coordinates
+        self.coordinate_precision = coordinate_precision
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+        self.file.write('Filename\tLocation\tType' + ('\tLatitude\tLongitude' if self.include_coordinates else '') + '\n')
+        return self
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def format_coordinate(self, value):
+        value = float(value)
+        return str(round(value, self.coordinate_precision) if self.coordinate_precision is not None else value)
+
+    def get_point(self, metadata):
+        point = metadata.get('coordinates_centroid_values')
+        if point is None and isinstance(metadata.get('coordinates'), dict):
+            point = metadata['coordinates']
+        if metadata.get('type') == 'UNK' or point is None:
+            return '0', '0'
+        return self.format_coordinate(point['latitude']), self.format_coordinate(point['longitude'])
+
+    def write(self, result):
+        rows = []
+        for toponyms, sentence_metadata in result.get('locations') or []:
+            for toponym, metadata in zip(toponyms, sentence_metadata):
+                row = result['filename'] + '\t' + toponym + '\t' + str(metadata.get('type'))
+                if self.include_coordinates:
+                    row += '\t' + '\t'.join(self.get_point(metadata))
+                rows.append(row + '\n')
+        if len(rows) > 0:
+            self.file.write(''.join(rows))
+        return
+
+    def write_all(self, results):
+        for result in results:
+            self.write(result)
+        return
@@ -1,18 +1,119 @@
 
 import spacy
 import json
+import threading
+from collections import OrderedDict
+from . metrics import metrics
 
 class SentenceSplitter:
-    def __init__(self):
-        self.nlp = None
+
+    #Modes:
+    # - 'full': runs the whole es_core_news_sm pipeline (tagger, dependency parser, NER, lemmatizer...).
+    #   Sentence boundaries come from the dependency parser, whose output is also used later on for
+    #   disambiguating toponyms.
+    # - 'fast': only a rule-based sentencizer (punctuation-based) over spaCy's Spanish tokenizer. Much
+    #   faster, but there is no syntactic analysis, so ambiguous toponyms fall back to their default type.
+    # - 'lazy': splits like 'fast', but sentences can later be parsed on demand (see "parse" below). Only
+    #   sentences that contain an ambiguous toponym are parsed, so parsing time grows with the number of
+    #   ambiguous mentions rather than with the size of the corpus.
+    modes = ['full', 'fast', 'lazy']
+
+    def __init__(self, mode='full', batch_size=64, n_process=1, parse_cache_size=10000):
+        if mode not in self.modes:
+            raise ValueError("Unknown sentence splitting mode: " + str(mode))
+
+        self.mode = mode
+        self.batch_size = batch_size
+        self.n_process = n_process
+
+        self.parser_nlp = None
         #Load spaCy library for separating texts into sentences
-        self.nlp = spacy.load("es_core_news_sm")
+        self.nlp = self.load_pipeline()
 
-    def __call__(self, article):
+        #A spaCy pipeline must not be run by several threads at once (e.g. the sentence splitting workers of
+        #run_pipelined): each concurrent caller takes one of the idle pipelines, or loads a new one if there is
+        #none, and gives it back once done. A single caller thus always uses "self.nlp"
+        self.idle_pipelines = [self.nlp]
+        self.pipelines_lock = threading.Lock()
+
+        #Cache of parsed sentences (sentence text -> parsed Doc), used in 'lazy' mode
+        self.parse_cache = OrderedDict()
+        self.parse_cache_size = parse_cache_size
+        self.parse_stats = {'parsed': 0, 'cache_hits': 0}
+
+    def load_pipeline(self):
+        if self.mode == 'full':
+            return spacy.load("es_core_news_sm")
+        nlp = spacy.blank("es")
+        nlp.add_pipe("sentencizer")
+        return nlp
+
+    def acquire_pipeline(self):
+        with self.pipelines_lock:
+            if len(self.idle_pipelines) > 0:
+                return self.idle_pipelines.pop()
+        return self.load_pipeline()
+
+    def release_pipeline(self, nlp):
+        with self.pipelines_lock:
+            self.idle_pipelines.append(nlp)
+
+    def get_text(self, article):
         try:
             text = article['headline'] + '. ' + article['body']
         except:
             text = article['body']
-        doc = self.nlp(text)
-        return [str(sentence) for sentence in doc.sents], doc, [sentence.as_doc() for sentence in doc.sents]
-        
+        return text
+
+    def split_doc(self, doc):
+        #Sentences are returned as spaCy Span objects, that is, views over the parent Doc, instead of
+        #copying each of them into a new Doc (as Span.as_doc() does): their tokens keep all annotations
+        #(including the dependency tree), but nothing is duplicated
+        sents = list(doc.sents)
+        return [sentence.text for sentence in sents], doc, sents
+
+    def __call__(self, article):
+        nlp = self.acquire_pipeline()
+        try:
+            return self.split_doc(nlp(self.get_text(article)))
+        finally:
+            self.release_pipeline(nlp)
+
+    def pipe(self, articles):
+        #Batched version of __call__: yields the same output for each of the articles, in order.
+        #Texts are streamed through spaCy's nlp.pipe, in batches of "batch_size" texts and
+        #over "n_process" processes
+        texts = (self.get_text(article) for article in articles)
+        nlp = self.acquire_pipeline()
+        try:
+            for doc in nlp.pipe(texts, batch_size=self.batch_size, n_process=self.n_process):
+                yield self.split_doc(doc)
+        finally:
+            self.release_pipeline(nlp)
+
+    def parse(self, sentence):
+        #Returns a version of the sentence (a Span) with a dependency tree. Sentences that already have one
+        #(those split in 'full' mode) are returned as they are. Otherwise, only the tagger and the parser of
+        #es_core_news_sm are run over the sentence text, and the resulting Doc is cached, so that repeated
+        #sentences (or repeated lookups of a same sentence) are parsed only once
+        if self.mode != 'lazy' or sentence.doc.has_annotation("DEP"):
+            return sentence
+
+        if sentence.text in self.parse_cache:
+            self.parse_cache.move_to_end(sentence.text)
+            self.parse_stats['cache_hits'] += 1
+            metrics.count('cache_hits', cache='sentence_parses')
+            return self.parse_cache[sentence.text]
+
+        if self.parser_nlp is None:
+            self.parser_nlp = spacy.load("es_core_news_sm", exclude=["ner", "lemmatizer"])
+
+        parsed = self.parser_nlp(sentence.text)
+        self.parse_stats['parsed'] += 1
+        metrics.count('cache_misses', cache='sentence_parses')
+
+        self.parse_cache[sentence.text] = parsed
+        if len(self.parse_cache) > self.parse_cache_size:
+            self.parse_cache.popitem(last=False)
+
+        return parsed
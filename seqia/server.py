@@ -0,0 +1,290 @@
+"""
+Local inference server with dynamic micro-batching.
+
+    seqia serve [--port 8080] [--max-batch-size 32] [--max-wait-ms 20]
+
+Models are loaded once and stay resident. Articles are sent one per request, as
+the JSON of an article (same keys as the JSON files of a corpus: "headline" and
+"body", plus an optional "filename"), to POST /infer; the response is the result
+of that article (see OUTPUT_FORMAT.md). A list of articles can also be sent, and
+a list of results is returned.
+
+Concurrent requests are combined into micro-batches: a batch is run through the
+pipeline as soon as it has "max_batch_size" articles, or "max_wait" seconds after
+its first article arrived, whichever comes first. Batches are run one at a time,
+in a separate thread, so that the server keeps accepting requests meanwhile.
+
+GET /metrics returns latency percentiles, the current and maximum queue depth and
+a histogram of batch sizes; GET /metrics/prometheus returns the metrics of every
+stage of the pipeline (see seqia/metrics.py) in the Prometheus text format; GET
+/health returns "ok" once the models are loaded.
+The server only depends on the standard library (asyncio), and speaks just
+enough HTTP/1.1 (with keep-alive) for local clients and the load-test script in
+benchmarks/load_test_server.py.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+
+import numpy as np
+
+from . metrics import metrics
+from . sharded_runner import to_json_value
+
+class MicroBatcher:
+
+    def __init__(self, run_batch, max_batch_size=32, max_wait=0.02, max_latencies=10000):
+        #"run_batch" takes a list of articles and returns the list of their results, in the same order.
+        #It is run in a single worker thread, so it is never called concurrently
+        if max_batch_size < 1:
+            raise ValueError("Maximum batch size must be at least 1: " + str(max_batch_size))
+        if max_wait < 0:
+            raise ValueError("Maximum wait must not be negative: " + str(max_wait))
+
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.queue = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        #Latency (from arrival to response) of the last "max_latencies" articles, in seconds
+        self.latencies = collections.deque(maxlen=max_latencies)
+        self.batch_sizes = collections.Counter()
+        self.stats = {'articles': 0, 'batches': 0, 'errors': 0, 'max_queue_depth': 0, 'busy_seconds': 0.0}
+        self.start_time = time.perf_counter()
+
+        return
+
+    async def submit(self, article):
+        #Result of a single article, once the batch it ended up in has been run
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((article, future, time.perf_counter()))
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.queue.qsize())
+        return await future
+
+    async def collect_batch(self):
+        #Waits for a first article, then for more, until the batch is full or the maximum wait is over
+        items = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(items) < self.max_batch_size:
+            #Articles that are already waiting are taken without yielding to the event loop
+            if not self.queue.empty():
+                items.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    async def run(self):
+        #Main loop: collects batches and runs them, one at a time, in the worker thread
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self.collect_batch()
+            articles = [article for article, _, _ in items]
+
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, articles)
+                if len(results) != len(articles):
+                    raise RuntimeError("Expected " + str(len(articles)) + " results, got " + str(len(results)))
+            except Exception as e:
+                self.stats['errors'] += len(items)
+                for _, future, _ in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.stats['busy_seconds'] += time.perf_counter() - start
+                self.stats['batches'] += 1
+                self.batch_sizes[len(items)] += 1
+
+            end = time.perf_counter()
+            for (_, future, arrival), result in zip(items, results):
+                self.latencies.append(end - arrival)
+                if not future.done():
+                    future.set_result(result)
+            self.stats['articles'] += len(items)
+
+    def get_metrics(self):
+        latencies = np.array(self.latencies, dtype=np.float64)
+        percentiles = dict()
+        for percentile in [50, 90, 95, 99]:
+            percentiles['p' + str(percentile)] = float(np.percentile(latencies, percentile)) * 1000 if len(latencies) > 0 else None
+
+        uptime = time.perf_counter() - self.start_time
+        return {
+            'uptime_seconds': uptime,
+            'articles': self.stats['articles'],
+            'errors': self.stats['errors'],
+            'batches': self.stats['batches'],
+            'articles_per_second': self.stats['articles'] / uptime if uptime > 0 else 0.0,
+            'utilisation': self.stats['busy_seconds'] / uptime if uptime > 0 else 0.0,
+            'latency_ms': percentiles,
+            'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+            'max_queue_depth': self.stats['max_queue_depth'],
+            'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            'mean_batch_size': self.stats['articles'] / self.stats['batches'] if self.stats['batches'] > 0 else 0.0,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000
+        }
+
+class InferenceServer:
+
+    #Largest request body that is accepted, in bytes
+    MAX_BODY_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, classifier, modulesToLoad=['*'], max_batch_size=32, max_wait=0.02):
+        self.classifier = classifier
+        self.modulesToLoad = modulesToLoad
+        self.batcher = MicroBatcher(self.run_batch, max_batch_size=max_batch_size, max_wait=max_wait)
+        self.ready = False
+        self.next_id = 0
+        return
+
+    def run_batch(self, articles):
+        metrics.observe('batch_size', len(articles), stage='server.batch')
+        with metrics.stage('server.batch', items=len(articles)):
+            return self.classifier.inference(articles, self.modulesToLoad)
+
+    def load(self):
+        #Models are loaded upfront, so that the first requests do not pay for it
+        self.classifier.load_modules(self.modulesToLoad)
+        self.ready = True
+        return
+
+    def parse_article(self, article):
+        if not isinstance(article, dict) or not isinstance(article.get('body'), str):
+            raise ValueError("Every article must be a JSON object with (at least) a \"body\" string")
+        article = dict(article)
+        article.setdefault('headline', '')
+        if 'filename' not in article:
+            article['filename'] = 'request-' + str(self.next_id)
+            self.next_id += 1
+        return article
+
+    def parse_payload(self, payload):
+        #An article, or a list of them. Raises ValueError for invalid ones
+        if isinstance(payload, list):
+            return [self.parse_article(article) for article in payload]
+        return self.parse_article(payload)
+
+    async def infer(self, articles):
+        #Results of the articles returned by "parse_payload"
+        if isinstance(articles, list):
+            return list(await asyncio.gather(*[self.batcher.submit(article) for article in articles]))
+        return await self.batcher.submit(articles)
+
+    async def handle_request(self, method, path, body):
+        #Returns (HTTP status, JSON-serializable response), or (HTTP status, bytes) for plain-text responses
+        path = path.split('?')[0]
+        if method == 'GET' and path == '/health':
+            return (200, 'ok') if self.ready else (503, 'loading')
+        if method == 'GET' and path == '/metrics':
+            return 200, self.batcher.get_metrics()
+        if method == 'GET' and path == '/metrics/prometheus':
+            return 200, metrics.to_prometheus().encode('utf-8')
+        if path == '/infer':
+            if method != 'POST':
+                return 405, {'error': 'Use POST'}
+            #Only invalid requests are client errors: anything raised by the models (even a ValueError) is a
+            #server error, for every request of the batch
+            try:
+                articles = self.parse_payload(json.loads(body.decode('utf-8')))
+            except ValueError as e:
+                return 400, {'error': str(e)}
+            try:
+                return 200, await self.infer(articles)
+            except Exception as e:
+                return 500, {'error': type(e).__name__ + ': ' + str(e)}
+        return 404, {'error': 'Not found: ' + path}
+
+    async def handle_connection(self, reader, writer):
+        #Minimal HTTP/1.1: a request line, headers and a body of "Content-Length" bytes. Connections are kept
+        #alive (unless the client asks otherwise), so that a client can send request after request
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    await self.send_response(writer, 400, {'error': 'Bad request line'}, keep_alive=False)
+                    break
+                method, path, version = parts
+
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', '0') or '0')
+                if length > self.MAX_BODY_SIZE:
+                    await self.send_response(writer, 413, {'error': 'Request body too large'}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length > 0 else b''
+
+                keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+                status, response = await self.handle_request(method, path, body)
+                await self.send_response(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+        return
+
+    async def send_response(self, writer, status, response, keep_alive=True):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                   413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+        if isinstance(response, bytes):
+            body = response
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            body = json.dumps(response, ensure_ascii=False, default=to_json_value).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        head = ('HTTP/1.1 ' + str(status) + ' ' + reasons.get(status, '') + '\r\n'
+                'Content-Type: ' + content_type + '\r\n'
+                'Content-Length: ' + str(len(body)) + '\r\n'
+                'Connection: ' + ('keep-alive' if keep_alive else 'close') + '\r\n\r\n')
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+        return
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        batcher = asyncio.ensure_future(self.batcher.run())
+        print("Serving on http://" + host + ":" + str(port), "(POST /infer, GET /metrics, GET /metrics/prometheus, GET /health)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+        return
+
+def serve(classifier, host='127.0.0.1', port=8080, modulesToLoad=['*'], max_batch_size=32, max_wait=0.02):
+    #Loads the models of "classifier" (a DroughtClassifier) and serves requests until interrupted
+    server = InferenceServer(classifier, modulesToLoad=modulesToLoad, max_batch_size=max_batch_size, max_wait=max_wait)
+    metrics.enable()
+    server.load()
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    return server
@@ -0,0 +1,396 @@
+"""
+Multi-process runner for large corpora.
+
+The input corpus (a folder or a TAR file) is split into contiguous shards of
+JSON files with about the same number of bytes each. Shards are processed by a
+pool of worker processes, each of which holds its own DroughtClassifier (its own
+replica of the models) and a fixed budget of PyTorch threads, so that workers
+do not compete for the same cores. Every finished shard leaves its results in
+the work directory, and a run can be resumed: shards that are already finished
+are skipped, and only the missing (or failed) ones are run again.
+
+Once all shards are finished, their results are merged into a single JSON Lines
+file, in corpus order (shard after shard), so the output does not depend on the
+number of workers nor on the order in which shards finished. Repeated articles
+are also detected across shards at that point, as in a single-process run.
+"""
+
+import contextlib
+import gc
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import tarfile
+import time
+import traceback
+
+from tqdm import tqdm
+
+from . article_load import iter_articles_from_paths, iter_articles_from_tar
+from . model_weights import default_cache_dir
+
+#Per-process state of the worker processes (see "shard_worker_init")
+worker_state = dict()
+
+def to_json_value(value):
+    #Fallback for values that the json module can not serialize (e.g. NumPy numbers)
+    if hasattr(value, 'item'):
+        return value.item()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    return str(value)
+
+def unique_tmp_path(path):
+    #Temporary file name unique to this process (and host), so that two workers that happen to write the same
+    #file at once (e.g. after a lease expired in a distributed run) never write to the same temporary file
+    return path + '.' + socket.gethostname() + '-' + str(os.getpid()) + '.tmp'
+
+def shard_worker_init(options):
+    #Runs once in every worker process, before any shard: limits the number of threads used by PyTorch
+    #and builds the classifier (models themselves are loaded the first time they are needed)
+    import torch
+    from . import DroughtClassifier
+
+    torch.set_num_threads(options['threads_per_worker'])
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    worker_state['options'] = options
+    worker_state['classifier'] = DroughtClassifier(cpu_threads=options['threads_per_worker'],
+                                                   ner_engine=options['ner_engine'],
+                                                   sentence_split_mode=options['sentence_split_mode'],
+                                                   weights_cache_dir=options.get('weights_cache_dir'),
+                                                   gazetteer_snapshot=options.get('gazetteer_snapshot'))
+
+def shard_worker_after_fork(threads_per_worker):
+    #Runs once in every worker process forked from a parent that already built the classifier
+    #(see "ShardedRunner.run"): only the thread budget has to be set
+    import torch
+
+    torch.set_num_threads(threads_per_worker)
+
+def shard_worker_run(shard):
+    #Runs one shard in a worker process. Returns (shard id, error traceback or None)
+    runner = ShardedRunner(**worker_state['options']['runner'])
+    try:
+        runner.run_shard(worker_state['classifier'], shard, worker_state['options'])
+        return shard['id'], None
+    except BaseException:
+        return shard['id'], traceback.format_exc()
+
+class ShardedRunner:
+
+    def __init__(self, source, work_dir, num_shards=None):
+        self.source = os.path.abspath(source)
+        self.work_dir = work_dir
+        self.num_shards = num_shards
+
+        if os.path.isdir(self.source):
+            self.is_tar = False
+        elif os.path.isfile(self.source) and tarfile.is_tarfile(self.source):
+            self.is_tar = True
+        else:
+            raise ValueError("Path is neither a folder nor a TAR file: " + source)
+
+        return
+
+    ######
+    ## SHARDS PLAN ##
+    #####
+
+    def list_corpus_entries(self):
+        #List of (name, size in bytes) of all the JSON files of the corpus, in a fixed order: sorted
+        #relative paths for folders, and archive order for TAR files
+        entries = []
+        if self.is_tar:
+            with tarfile.open(self.source) as tar:
+                for member in tar:
+                    if member.isfile() and member.name.endswith('.json'):
+                        entries.append((member.name, member.size))
+        else:
+            for dirpath, _, files in os.walk(self.source):
+                for file in files:
+                    if file.endswith('.json'):
+                        path = os.path.join(dirpath, file)
+                        entries.append((os.path.relpath(path, self.source), os.path.getsize(path)))
+            entries.sort()
+        return entries
+
+    def split_into_shards(self, entries, num_shards):
+        #Contiguous shards with about the same number of bytes each (rather than of files), as
+        #processing time mostly depends on the length of the articles
+        num_shards = max(1, min(num_shards, len(entries)))
+        total_size = sum([size for _, size in entries]) or 1
+
+        shards = [[] for _ in range(num_shards)]
+        accumulated_size = 0
+        for name, size in entries:
+            shard = min(int(num_shards * accumulated_size / total_size), num_shards - 1)
+            shards[shard].append(name)
+            accumulated_size += size
+
+        return [{'id': i, 'entries': shard} for i, shard in enumerate(shards) if len(shard) > 0]
+
+    def plan_path(self):
+        return os.path.join(self.work_dir, 'plan.json')
+
+    def shard_path(self, shard_id, kind):
+        #Files of a shard: 'results' (JSON Lines), 'manifest' (written last: marks the shard as finished),
+        #'log' (output of the worker) and 'failed' (traceback of the last failure)
+        extensions = {'results': '.jsonl', 'manifest': '.manifest.json', 'log': '.log', 'failed': '.failed'}
+        return os.path.join(self.work_dir, 'shard-%05d%s' % (shard_id, extensions[kind]))
+
+    def create_plan(self, options, entries=None):
+        if entries is None:
+            entries = self.list_corpus_entries()
+        if len(entries) == 0:
+            raise ValueError("No JSON articles found in " + self.source)
+        plan = {
+            'source': self.source,
+            'options': options,
+            'shards': self.split_into_shards(entries, self.num_shards or 1)
+        }
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.write_json_atomically(self.plan_path(), plan)
+        return plan
+
+    def load_plan(self):
+        if not os.path.isfile(self.plan_path()):
+            return None
+        with open(self.plan_path(), encoding='utf-8') as f:
+            return json.load(f)
+
+    def is_shard_finished(self, shard_id):
+        return os.path.isfile(self.shard_path(shard_id, 'manifest'))
+
+    def write_json_atomically(self, path, value):
+        #Write to a temporary file first, then rename it: a file is either complete or missing
+        tmp_path = unique_tmp_path(path)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False, default=to_json_value)
+        os.replace(tmp_path, path)
+
+    ######
+    ## RUN SHARDS ##
+    #####
+
+    def run_shard(self, classifier, shard, options):
+        start = time.perf_counter()
+
+        #Body digests of every article of the shard, to find repeated articles across shards when merging
+        digests = []
+        def record_digests(articles):
+            for article in articles:
+                digests.append((article['filename'], hashlib.blake2b(article['body'].encode('utf-8'), digest_size=16).hexdigest()))
+                yield article
+
+        if self.is_tar:
+            articles = iter_articles_from_tar(self.source, members=shard['entries'])
+        else:
+            articles = iter_articles_from_paths([os.path.join(self.source, name) for name in shard['entries']])
+
+        results_path = self.shard_path(shard['id'], 'results')
+        results_tmp_path = unique_tmp_path(results_path)
+        num_results = 0
+        with open(self.shard_path(shard['id'], 'log'), 'w', encoding='utf-8') as log, \
+             contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            with open(results_tmp_path, 'w', encoding='utf-8') as f:
+                for results in classifier.stream(record_digests(articles), chunk_size=options['chunk_size'],
+                                                 modulesToLoad=options['modulesToLoad'],
+                                                 exclude_problematic_articles=options['exclude_problematic_articles'],
+                                                 near_duplicate_threshold=options.get('near_duplicate_threshold')):
+                    for result in results:
+                        f.write(json.dumps(result, ensure_ascii=False, default=to_json_value) + '\n')
+                        num_results += 1
+        os.replace(results_tmp_path, results_path)
+
+        self.write_json_atomically(self.shard_path(shard['id'], 'manifest'), {
+            'shard': shard['id'],
+            'articles': len(digests),
+            'results': num_results,
+            'seconds': time.perf_counter() - start,
+            'digests': digests,
+            'problematic_articles': classifier.problematic_articles,
+            'sentence_dedup': classifier.sentence_dedup_stats
+        })
+
+        if os.path.isfile(self.shard_path(shard['id'], 'failed')):
+            try:
+                os.remove(self.shard_path(shard['id'], 'failed'))
+            except FileNotFoundError:
+                pass
+
+        return
+
+    def run(self, options, workers=1, threads_per_worker=1, resume=False, share_memory=False, cache_dir=None):
+        #Runs every unfinished shard over a pool of "workers" processes. Returns the list of ids of the shards
+        #that failed (their tracebacks are in the work directory; run again with "resume" to retry them).
+        #
+        #With "share_memory", model weights are memory-mapped from (and gazetteers snapshotted to) "cache_dir",
+        #and, where possible (fork start method, no GPU), everything is loaded once in this process, and
+        #workers are forked from it afterwards: they all share the same memory pages for models and gazetteers,
+        #and each one only adds its own working set
+        plan = self.load_plan()
+        if plan is not None and not resume:
+            raise ValueError("Work directory " + self.work_dir + " already contains a run: resume it, or use another directory")
+        if plan is None:
+            plan = self.create_plan(options)
+        elif plan['source'] != self.source or plan['options'] != options:
+            raise ValueError("Work directory " + self.work_dir + " contains a run with a different input or options")
+
+        pending_shards = [shard for shard in plan['shards'] if not self.is_shard_finished(shard['id'])]
+        print(len(plan['shards']) - len(pending_shards), "of", len(plan['shards']), "shards already finished;",
+              len(pending_shards), "to run with", workers, "workers and", threads_per_worker, "threads per worker")
+
+        failed_shards = []
+        if len(pending_shards) == 0:
+            return failed_shards
+
+        worker_options = dict(options)
+        worker_options['threads_per_worker'] = threads_per_worker
+        worker_options['runner'] = {'source': self.source, 'work_dir': self.work_dir}
+        if share_memory:
+            if cache_dir is None:
+                cache_dir = default_cache_dir()
+            worker_options['weights_cache_dir'] = os.path.join(cache_dir, 'weights')
+            worker_options['gazetteer_snapshot'] = os.path.join(cache_dir, 'gazetteers.pickle')
+
+        #Thread pools of the libraries used by PyTorch, tokenizers and NumPy are sized from these variables when
+        #they are first imported, so they are set before starting the workers (which inherit them)
+        for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+            os.environ[variable] = str(threads_per_worker)
+        os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+        #Largest shards first, so that a big shard never starts last
+        pending_shards.sort(key=lambda shard: -len(shard['entries']))
+
+        import torch
+        fork_workers = share_memory and 'fork' in multiprocessing.get_all_start_methods() and not torch.cuda.is_available()
+        if fork_workers:
+            #Load once, then fork: models and gazetteers are loaded here, and inherited by every worker. The garbage
+            #collector is frozen first, so that it never writes to (and thus copies) the pages of inherited objects
+            print("Loading models and gazetteers once, to be shared by all workers")
+            shard_worker_init(worker_options)
+            worker_state['classifier'].load_modules(options['modulesToLoad'])
+            gc.collect()
+            gc.freeze()
+            context = multiprocessing.get_context('fork')
+            initializer, initargs = shard_worker_after_fork, (threads_per_worker,)
+        else:
+            context = multiprocessing.get_context('spawn')
+            initializer, initargs = shard_worker_init, (worker_options,)
+
+        try:
+            with context.Pool(min(workers, len(pending_shards)), initializer=initializer, initargs=initargs) as pool:
+                for shard_id, error in tqdm(pool.imap_unordered(shard_worker_run, pending_shards), total=len(pending_shards), desc='Running shards'):
+                    if error is not None:
+                        failed_shards.append(shard_id)
+                        with open(self.shard_path(shard_id, 'failed'), 'w', encoding='utf-8') as f:
+                            f.write(error)
+                        print("Shard", shard_id, "failed; see", self.shard_path(shard_id, 'failed'))
+        finally:
+            if fork_workers:
+                gc.unfreeze()
+
+        return sorted(failed_shards)
+
+    ######
+    ## MERGE ##
+    #####
+
+    def merge(self, output_file, problems_file=None, compact_geometries=False, coordinate_precision=None, sqlite_output=None, cube_output=None):
+        #Merges the results of all shards, in shard order, into a JSON Lines file. Articles whose body was
+        #already seen in a previous shard are reported as repeated (and dropped, if problematic articles
+        #are excluded), exactly as in a single-process run. With "compact_geometries", geometries are
+        #moved to a table in OUTPUT.geometries.jsonl, and referenced by id (see result_writers.py). Results are also
+        #added to the SQLite database "sqlite_output", and to the aggregate cube saved in "cube_output", if given
+        #(see result_store.py and aggregate_cube.py). The counts of this run replace those of a previous merge
+        #of the same run in that cube, so merging again does not count its articles twice
+        from . aggregate_cube import DroughtImpactCube
+        from . result_writers import JSONLResultWriter
+        from . result_store import SQLiteResultStore
+
+        plan = self.load_plan()
+        if plan is None:
+            raise ValueError("No run found in " + self.work_dir)
+        unfinished = [shard['id'] for shard in plan['shards'] if not self.is_shard_finished(shard['id'])]
+        if len(unfinished) > 0:
+            raise ValueError("Some shards are not finished yet: " + ', '.join([str(shard_id) for shard_id in unfinished]))
+
+        exclude_problematic_articles = plan['options']['exclude_problematic_articles']
+
+        seen_bodies = dict()
+        problematic_articles = []
+        stats = {'articles': 0, 'results': 0, 'shard_seconds': 0.0, 'sentences': 0, 'unique_sentences': 0}
+
+        geometries_file = output_file + '.geometries.jsonl'
+        if compact_geometries:
+            writer = JSONLResultWriter(output_file + '.tmp', geometries_path=geometries_file + '.tmp', coordinate_precision=coordinate_precision)
+        else:
+            writer = None
+        store = SQLiteResultStore(sqlite_output, coordinate_precision=coordinate_precision, label=self.work_dir).open() if sqlite_output is not None else None
+        if cube_output is not None:
+            saved_cube = DroughtImpactCube.load(cube_output)
+            cube = DroughtImpactCube(saved_cube.granularities, saved_cube.only_drought_articles)
+        else:
+            cube = None
+
+        with (writer.open().file if writer is not None else open(output_file + '.tmp', 'w', encoding='utf-8')) as out:
+            for shard in plan['shards']:
+                with open(self.shard_path(shard['id'], 'manifest'), encoding='utf-8') as f:
+                    manifest = json.load(f)
+
+                problematic_articles.extend([tuple(problem) for problem in manifest['problematic_articles']])
+                stats['articles'] += manifest['articles']
+                stats['shard_seconds'] += manifest['seconds']
+                #Manifests of runs from older versions have no deduplication stats
+                for key, value in manifest.get('sentence_dedup', dict()).items():
+                    stats[key] += value
+
+                #Repeated articles within a shard were already handled by the worker
+                shard_seen_bodies = dict()
+                repeated = set()
+                for filename, digest in manifest['digests']:
+                    if digest in seen_bodies:
+                        problematic_articles.append((filename, 'REPEATED_ARTICLE_BODY: ' + seen_bodies[digest]))
+                        repeated.add(filename)
+                    elif digest not in shard_seen_bodies:
+                        shard_seen_bodies[digest] = filename
+                seen_bodies.update(shard_seen_bodies)
+
+                with open(self.shard_path(shard['id'], 'results'), encoding='utf-8') as f:
+                    for line in f:
+                        if exclude_problematic_articles and len(repeated) > 0 and json.loads(line)['filename'] in repeated:
+                            continue
+                        result = json.loads(line) if writer is not None or store is not None or cube is not None else None
+                        if writer is not None:
+                            writer.write(result)
+                        else:
+                            out.write(line)
+                        if store is not None:
+                            store.write(result)
+                        if cube is not None:
+                            cube.add(result)
+                        stats['results'] += 1
+        if store is not None:
+            store.close()
+        if cube is not None:
+            saved_cube.absorb(os.path.abspath(self.work_dir), cube)
+            saved_cube.save(cube_output)
+        if writer is not None:
+            writer.close()
+            os.replace(geometries_file + '.tmp', geometries_file)
+            stats['geometries'] = writer.geometries.stats['geometries']
+        os.replace(output_file + '.tmp', output_file)
+
+        if problems_file is not None:
+            with open(problems_file, 'w', encoding='utf-8') as f:
+                for problem in problematic_articles:
+                    f.write(problem[0] + '\t' + problem[1] + '\n')
+
+        stats['problematic_articles'] = len(problematic_articles)
+        return stats
@@ -0,0 +1,445 @@
+"""
+Distributed runs over a shared work queue.
+
+Instead of splitting a corpus by hand between machines, the corpus is split
+into batches once (the shards of a ShardedRunner plan), and every batch is put
+in a queue. Any number of workers, on any number of machines that can reach the
+corpus and the work directory, pull batches from the queue, run them through
+the pipeline and write their results to the work directory. Workers can join
+and leave at any moment:
+
+- A worker holds a lease on the batch it is running, and renews it while it
+  runs. If a worker dies, its lease expires and the batch goes back to the
+  queue, to be run by another worker.
+- Failed batches are retried up to "max_attempts" times before being marked as
+  failed for good.
+- Writing the results of a batch is idempotent (they are written to temporary
+  files and renamed), so a batch that ends up being run twice (e.g. after an
+  expired lease) gives the same result files.
+
+Two queue backends are available, with the same interface: SQLiteWorkQueue (a
+single SQLite database file, for workers on the same machine, or on a shared
+filesystem with working file locks) and FileSystemWorkQueue (one small file per
+batch in a folder, leased through atomic renames; suitable for NFS-like shared
+folders). Use "open_work_queue" to pick one from a path.
+"""
+
+import json
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+from . sharded_runner import ShardedRunner, shard_worker_init, worker_state
+
+class WorkQueue:
+    #Interface shared by the queue backends. Batches are identified by consecutive integers (in the same
+    #order they were added), and their payload is any JSON-serializable value
+
+    def __init__(self, lease_seconds=600, max_attempts=3):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def add_batches(self, payloads):
+        raise NotImplementedError
+
+    def lease(self, worker_id):
+        #Returns (batch id, payload) of the next batch to run (a pending one, or one whose lease
+        #expired), or None if there is none right now
+        raise NotImplementedError
+
+    def renew(self, batch_id, worker_id):
+        #Extends the lease of a batch; returns False if the worker no longer holds it
+        raise NotImplementedError
+
+    def complete(self, batch_id, worker_id, stats):
+        #Marks a batch as done. "stats" is a dictionary with the 'articles' and 'seconds' of the batch
+        raise NotImplementedError
+
+    def fail(self, batch_id, worker_id, error):
+        raise NotImplementedError
+
+    def get_payload(self, batch_id):
+        raise NotImplementedError
+
+    def batches(self):
+        #List of dictionaries with the state of every batch ('pending', 'leased', 'done' or 'failed'),
+        #its number of attempts, the worker that holds or finished it, and its stats
+        raise NotImplementedError
+
+    def is_finished(self):
+        return all([batch['state'] in ('done', 'failed') for batch in self.batches()])
+
+    def summary(self):
+        #Progress and throughput of the whole run, and of each worker
+        batches = self.batches()
+        summary = {'batches': len(batches), 'pending': 0, 'leased': 0, 'done': 0, 'failed': 0,
+                   'articles': 0, 'retries': 0, 'workers': dict()}
+        first_start = None
+        last_finish = None
+        for batch in batches:
+            summary[batch['state']] += 1
+            summary['retries'] += max(0, batch['attempts'] - 1)
+            if batch['state'] == 'done':
+                summary['articles'] += batch['articles']
+                worker = summary['workers'].setdefault(batch['worker'], {'batches': 0, 'articles': 0, 'seconds': 0.0})
+                worker['batches'] += 1
+                worker['articles'] += batch['articles']
+                worker['seconds'] += batch['seconds']
+                last_finish = max(last_finish or batch['finished'], batch['finished'])
+            if batch['started'] is not None:
+                first_start = min(first_start or batch['started'], batch['started'])
+
+        elapsed = (last_finish - first_start) if first_start is not None and last_finish is not None else 0.0
+        summary['elapsed_seconds'] = elapsed
+        summary['articles_per_second'] = summary['articles'] / elapsed if elapsed > 0 else 0.0
+        for worker in summary['workers'].values():
+            worker['articles_per_second'] = worker['articles'] / worker['seconds'] if worker['seconds'] > 0 else 0.0
+
+        return summary
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = ['Batches: %d done, %d running, %d pending, %d failed (of %d; %d retries)' % (summary['done'], summary['leased'], summary['pending'],
+                                                                                               summary['failed'], summary['batches'], summary['retries']),
+                 'Articles: %d in %.1f s (%.1f articles/s)' % (summary['articles'], summary['elapsed_seconds'], summary['articles_per_second'])]
+        if len(summary['workers']) > 0:
+            lines.append('%-40s %8s %10s %12s' % ('Worker', 'Batches', 'Articles', 'Articles/s'))
+            for worker_id, worker in sorted(summary['workers'].items()):
+                lines.append('%-40s %8d %10d %12.1f' % (worker_id, worker['batches'], worker['articles'], worker['articles_per_second']))
+        return '\n'.join(lines)
+
+class SQLiteWorkQueue(WorkQueue):
+
+    def __init__(self, path, lease_seconds=600, max_attempts=3):
+        super().__init__(lease_seconds, max_attempts)
+        self.path = path
+
+        with self.connect() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS batches (
+                                    id INTEGER PRIMARY KEY,
+                                    payload TEXT NOT NULL,
+                                    state TEXT NOT NULL DEFAULT 'pending',
+                                    attempts INTEGER NOT NULL DEFAULT 0,
+                                    worker TEXT,
+                                    lease_expires REAL,
+                                    started REAL,
+                                    finished REAL,
+                                    articles INTEGER NOT NULL DEFAULT 0,
+                                    seconds REAL NOT NULL DEFAULT 0,
+                                    error TEXT)''')
+
+        return
+
+    def connect(self):
+        #One short-lived connection per operation, so that the queue can be shared between threads and processes
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        return ConnectionContext(connection)
+
+    def add_batches(self, payloads):
+        with self.connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            start = connection.execute('SELECT COUNT(*) FROM batches').fetchone()[0]
+            connection.executemany('INSERT INTO batches (id, payload) VALUES (?, ?)',
+                                   [(start + i, json.dumps(payload, ensure_ascii=False)) for i, payload in enumerate(payloads)])
+            connection.execute('COMMIT')
+
+    def lease(self, worker_id):
+        now = time.time()
+        with self.connect() as connection:
+            #Take the write lock first, so that two workers never lease the same batch
+            connection.execute('BEGIN IMMEDIATE')
+
+            #Expired leases count as failed attempts
+            connection.execute('''UPDATE batches SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                  error = 'Lease expired (worker: ' || worker || ')'
+                                  WHERE state = 'leased' AND lease_expires < ?''', (self.max_attempts, now))
+
+            row = connection.execute("SELECT id, payload FROM batches WHERE state = 'pending' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                connection.execute('COMMIT')
+                return None
+
+            connection.execute('''UPDATE batches SET state = 'leased', attempts = attempts + 1, worker = ?, lease_expires = ?, started = ?
+                                  WHERE id = ?''', (worker_id, now + self.lease_seconds, now, row[0]))
+            connection.execute('COMMIT')
+
+        return row[0], json.loads(row[1])
+
+    def renew(self, batch_id, worker_id):
+        with self.connect() as connection:
+            updated = connection.execute("UPDATE batches SET lease_expires = ? WHERE id = ? AND state = 'leased' AND worker = ?",
+                                         (time.time() + self.lease_seconds, batch_id, worker_id)).rowcount
+        return updated == 1
+
+    def complete(self, batch_id, worker_id, stats):
+        #Results are already written at this point, so the batch is done even if the lease expired meanwhile
+        with self.connect() as connection:
+            connection.execute('''UPDATE batches SET state = 'done', worker = ?, finished = ?, articles = ?, seconds = ?, error = NULL
+                                  WHERE id = ? AND state != 'done' ''', (worker_id, time.time(), stats['articles'], stats['seconds'], batch_id))
+
+    def fail(self, batch_id, worker_id, error):
+        with self.connect() as connection:
+            connection.execute('''UPDATE batches SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?
+                                  WHERE id = ? AND state = 'leased' AND worker = ?''', (self.max_attempts, error, batch_id, worker_id))
+
+    def get_payload(self, batch_id):
+        with self.connect() as connection:
+            row = connection.execute('SELECT payload FROM batches WHERE id = ?', (batch_id,)).fetchone()
+        if row is None:
+            raise ValueError("No batch " + str(batch_id) + " in queue " + self.path)
+        return json.loads(row[0])
+
+    def batches(self):
+        with self.connect() as connection:
+            rows = connection.execute('SELECT id, state, attempts, worker, started, finished, articles, seconds, error FROM batches ORDER BY id').fetchall()
+        return [dict(zip(('id', 'state', 'attempts', 'worker', 'started', 'finished', 'articles', 'seconds', 'error'), row)) for row in rows]
+
+class ConnectionContext:
+    #sqlite3 connections used as context managers only end transactions; this one also closes them
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is not None and self.connection.in_transaction:
+            self.connection.execute('ROLLBACK')
+        self.connection.close()
+
+class FileSystemWorkQueue(WorkQueue):
+    #Every batch is a JSON file, in one of the "pending", "leased", "done" or "failed" subfolders. Leasing a batch
+    #is renaming its file from "pending" to "leased", which only one worker can do; the modification time of a
+    #leased file is its last lease renewal
+
+    STATES = ('pending', 'leased', 'done', 'failed')
+
+    def __init__(self, path, lease_seconds=600, max_attempts=3):
+        super().__init__(lease_seconds, max_attempts)
+        self.path = path
+
+        for state in self.STATES:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+        return
+
+    def batch_path(self, state, batch_id):
+        return os.path.join(self.path, state, 'batch-%07d.json' % batch_id)
+
+    def read_batch(self, path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def write_batch(self, path, batch):
+        tmp_path = path + '.' + socket.gethostname() + '-' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(batch, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def list_batch_ids(self, state):
+        return sorted([int(name[6:-5]) for name in os.listdir(os.path.join(self.path, state))
+                       if name.startswith('batch-') and name.endswith('.json')])
+
+    def add_batches(self, payloads):
+        start = sum([len(self.list_batch_ids(state)) for state in self.STATES])
+        for i, payload in enumerate(payloads):
+            self.write_batch(self.batch_path('pending', start + i), {'payload': payload, 'attempts': 0, 'worker': None,
+                                                                    'started': None, 'finished': None, 'articles': 0,
+                                                                    'seconds': 0.0, 'error': None})
+
+    def release_expired_leases(self):
+        now = time.time()
+        for batch_id in self.list_batch_ids('leased'):
+            path = self.batch_path('leased', batch_id)
+            try:
+                if now - os.path.getmtime(path) <= self.lease_seconds:
+                    continue
+                batch = self.read_batch(path)
+            except (FileNotFoundError, ValueError):
+                continue
+            batch['error'] = 'Lease expired (worker: ' + str(batch['worker']) + ')'
+            self.move_batch(batch_id, batch, 'leased', 'failed' if batch['attempts'] >= self.max_attempts else 'pending')
+
+    def move_batch(self, batch_id, batch, from_state, to_state):
+        #Claims the batch by renaming it first (only one worker can do it), then updates its contents
+        claimed_path = self.batch_path(from_state, batch_id) + '.' + socket.gethostname() + '-' + str(os.getpid()) + '.claimed'
+        try:
+            os.rename(self.batch_path(from_state, batch_id), claimed_path)
+        except FileNotFoundError:
+            return False
+        self.write_batch(claimed_path, batch)
+        os.rename(claimed_path, self.batch_path(to_state, batch_id))
+        return True
+
+    def lease(self, worker_id):
+        self.release_expired_leases()
+
+        for batch_id in self.list_batch_ids('pending'):
+            path = self.batch_path('pending', batch_id)
+            try:
+                batch = self.read_batch(path)
+            except (FileNotFoundError, ValueError):
+                continue
+            batch['attempts'] += 1
+            batch['worker'] = worker_id
+            batch['started'] = time.time()
+            if self.move_batch(batch_id, batch, 'pending', 'leased'):
+                return batch_id, batch['payload']
+
+        return None
+
+    def renew(self, batch_id, worker_id):
+        path = self.batch_path('leased', batch_id)
+        try:
+            if self.read_batch(path)['worker'] != worker_id:
+                return False
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return False
+        return True
+
+    def complete(self, batch_id, worker_id, stats):
+        #Results are already written at this point, so the batch is done even if the lease expired meanwhile
+        for state in ('leased', 'pending', 'failed'):
+            try:
+                batch = self.read_batch(self.batch_path(state, batch_id))
+            except (FileNotFoundError, ValueError):
+                continue
+            batch.update({'worker': worker_id, 'finished': time.time(), 'articles': stats['articles'], 'seconds': stats['seconds'], 'error': None})
+            if self.move_batch(batch_id, batch, state, 'done'):
+                return
+
+    def fail(self, batch_id, worker_id, error):
+        try:
+            batch = self.read_batch(self.batch_path('leased', batch_id))
+        except (FileNotFoundError, ValueError):
+            return
+        if batch['worker'] != worker_id:
+            return
+        batch['error'] = error
+        self.move_batch(batch_id, batch, 'leased', 'failed' if batch['attempts'] >= self.max_attempts else 'pending')
+
+    def get_payload(self, batch_id):
+        #The batch could be moving between states: look for it a few times
+        for _ in range(10):
+            for state in self.STATES:
+                try:
+                    return self.read_batch(self.batch_path(state, batch_id))['payload']
+                except (FileNotFoundError, ValueError):
+                    continue
+            time.sleep(0.1)
+        raise ValueError("No batch " + str(batch_id) + " in queue " + self.path)
+
+    def batches(self):
+        batches = []
+        for state in self.STATES:
+            for batch_id in self.list_batch_ids(state):
+                try:
+                    batch = self.read_batch(self.batch_path(state, batch_id))
+                except (FileNotFoundError, ValueError):
+                    continue
+                del batch['payload']
+                batch.update({'id': batch_id, 'state': state})
+                batches.append(batch)
+        return sorted(batches, key=lambda batch: batch['id'])
+
+def open_work_queue(path, lease_seconds=600, max_attempts=3):
+    #SQLite database for paths that end in ".db" or ".sqlite", folder-based queue otherwise
+    if path.endswith('.db') or path.endswith('.sqlite'):
+        return SQLiteWorkQueue(path, lease_seconds, max_attempts)
+    return FileSystemWorkQueue(path, lease_seconds, max_attempts)
+
+def default_worker_id():
+    return socket.gethostname() + ':' + str(os.getpid())
+
+class LeaseKeeper:
+    #Renews the lease of a batch in a background thread while it runs
+    def __init__(self, queue, batch_id, worker_id):
+        self.queue = queue
+        self.batch_id = batch_id
+        self.worker_id = worker_id
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.keep, daemon=True)
+
+    def keep(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            if not self.queue.renew(self.batch_id, self.worker_id):
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stopped.set()
+        self.thread.join()
+
+def enqueue_corpus(queue, source, work_dir, options, batch_size=1000):
+    #Splits a corpus into batches of about "batch_size" articles (the shards of a ShardedRunner plan, whose results
+    #are written to "work_dir") and adds them to the queue. Returns the plan
+    runner = ShardedRunner(source, work_dir)
+    if runner.load_plan() is not None:
+        raise ValueError("Work directory " + work_dir + " already contains a run")
+
+    entries = runner.list_corpus_entries()
+    runner.num_shards = max(1, math.ceil(len(entries) / batch_size))
+    plan = runner.create_plan(options, entries)
+
+    queue.add_batches([{'runner': {'source': runner.source, 'work_dir': os.path.abspath(work_dir)},
+                        'options': options,
+                        'shard': shard} for shard in plan['shards']])
+
+    return plan
+
+def run_queue_worker(queue, worker_id=None, threads=1, poll_seconds=10, wait=True, cache_dir=None):
+    #Pulls batches from the queue and runs them until there is nothing left to do. With "wait", the worker waits
+    #while other workers still hold leases (one of them could expire, and its batch be run here) instead of
+    #leaving as soon as there are no pending batches. With "cache_dir", model weights are memory-mapped from
+    #that folder and gazetteers read from a snapshot in it, so that workers on a same machine share them.
+    #Returns the number of batches run by this worker
+    if worker_id is None:
+        worker_id = default_worker_id()
+
+    #A queue can hold batches of several runs: each set of options gets its own classifier, built the first
+    #time a batch with those options is leased, and kept for the next ones
+    classifiers = dict()
+    num_batches = 0
+    while True:
+        leased = queue.lease(worker_id)
+        if leased is None:
+            if not wait or queue.is_finished():
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        batch_id, payload = leased
+
+        options_key = json.dumps(payload['options'], sort_keys=True)
+        if options_key not in classifiers:
+            worker_options = dict(payload['options'], threads_per_worker=threads)
+            if cache_dir is not None:
+                worker_options['weights_cache_dir'] = os.path.join(cache_dir, 'weights')
+                worker_options['gazetteer_snapshot'] = os.path.join(cache_dir, 'gazetteers.pickle')
+            shard_worker_init(worker_options)
+            classifiers[options_key] = worker_state['classifier']
+
+        print("Running batch", batch_id, "(" + str(len(payload['shard']['entries'])), "articles)")
+        start = time.time()
+        try:
+            runner = ShardedRunner(**payload['runner'])
+            with LeaseKeeper(queue, batch_id, worker_id):
+                runner.run_shard(classifiers[options_key], payload['shard'], payload['options'])
+        except Exception:
+            error = traceback.format_exc()
+            print("Batch", batch_id, "failed:\n" + error)
+            queue.fail(batch_id, worker_id, error)
+            continue
+
+        queue.complete(batch_id, worker_id, {'articles': len(payload['shard']['entries']), 'seconds': time.time() - start})
+        num_batches += 1
+
+    return num_batches
@@ -21,6 +21,12 @@ setup(
             'loc_files/*',
         ]
     },
-    install_requires=["transformers","accelerate","datasets","tensorflow","numpy","torch","spacy","tqdm","geopy","geopandas","shapely"],
-    python_requires=">=3.6"
+    entry_points={
+        'console_scripts': [
+            'seqia=seqia.cli:main',
+        ]
+    },
+    install_requires=["transformers","accelerate","numpy","torch","spacy","tqdm","geopy","geopandas","shapely"],
+    extras_require={"parquet": ["pyarrow"]},
+    python_requires=">=3.7"
 )
@@ -0,0 +1,95 @@
+import os
+import pickle
+import tempfile
+import unittest
+import warnings
+
+from seqia.ner_loc import NERLocation
+
+def load_spanish_parser():
+    try:
+        import spacy
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return spacy.load('es_core_news_sm')
+    except (ImportError, OSError):
+        return None
+
+nlp = load_spanish_parser()
+
+class TinyGazetteersNERLocation(NERLocation):
+    #Replaces the IGN and Geonames files with a few entries: Zaragoza and Huesca are both towns and provinces
+
+    def load_localization_data(self):
+        import geopandas
+        from shapely.geometry import LineString, box
+
+        self.towns = {'Zaragoza': {'latitude': 41.65, 'longitude': -0.88},
+                      'Huesca': {'latitude': 42.14, 'longitude': -0.41},
+                      'Jaca': {'latitude': 42.57, 'longitude': -0.55},
+                      'REPEATED_TOWNS': dict()}
+        self.countries = dict()
+        self.comm = geopandas.GeoDataFrame({'text': ['Aragón'], 'geometry': [box(-2.0, 40.0, 0.5, 43.0)]})
+        self.alt_comm_names = {'Aragón': 'Aragón'}
+        self.prov = geopandas.GeoDataFrame({'text': ['Zaragoza', 'Huesca'], 'geometry': [box(-2.0, 40.9, 0.5, 42.0), box(-1.0, 42.0, 0.5, 43.0)]})
+        self.alt_prov_names = {'Zaragoza': 'Zaragoza', 'Huesca': 'Huesca'}
+        self.riv = geopandas.GeoDataFrame({'text': ['RIO ARAGON'], 'geometry': [LineString([(-0.5, 42.6), (-1.7, 42.2)])]})
+        self.dams = geopandas.GeoDataFrame({'text': [], 'geometry': []})
+        self.rivers_exceptions = ['España', 'Francia']
+        self.communities_with_shared_capital_city_name = ['Madrid', 'Murcia', 'Ceuta', 'Melilla']
+        self.geonames = None
+        self.river_basins = geopandas.GeoDataFrame({'text': ['Ebro'], 'geometry': [box(-2.0, 40.0, 0.5, 43.0)]})
+        return
+
+@unittest.skipIf(nlp is None, 'the spaCy model es_core_news_sm is not installed')
+class FuzzyMatchedToponymsDisambiguationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ner = TinyGazetteersNERLocation('cpu')
+
+    def geolocate(self, text, toponym):
+        doc = nlp(text)
+        toponyms_metadata = [[dict()]]
+        self.ner.geolocation_IGN([[toponym]], toponyms_metadata, doc, list(doc.sents), simplifyPolylines=True)
+        return toponyms_metadata[0][0]
+
+    def test_misspelled_province_after_keyword(self):
+        metadata = self.geolocate('La sequía afecta a la provincia de Zaragosa.', 'Zaragosa')
+        self.assertEqual(metadata['fuzzy_match']['name'], 'Zaragoza')
+        self.assertEqual(metadata['type'], 'prov')
+
+    def test_misspelled_province_in_parentheses(self):
+        metadata = self.geolocate('Los agricultores de Jaca (Huezca) piden ayudas.', 'Huezca')
+        self.assertEqual(metadata['fuzzy_match']['name'], 'Huesca')
+        self.assertEqual(metadata['type'], 'prov')
+
+    def test_misspelled_town_keeps_default_type(self):
+        metadata = self.geolocate('Los vecinos de Zaragosa piden ayudas.', 'Zaragosa')
+        self.assertEqual(metadata['fuzzy_match']['name'], 'Zaragoza')
+        self.assertEqual(metadata['type'], 'town')
+
+class GazetteerSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'gazetteers.pickle')
+        ner = TinyGazetteersNERLocation('cpu')
+        ner.gazetteer_snapshot = self.path
+        ner.load_geolocation_data()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_snapshot_is_loaded(self):
+        self.assertTrue(TinyGazetteersNERLocation('cpu').load_gazetteer_snapshot(self.path))
+
+    def test_snapshot_of_another_format_is_not_loaded(self):
+        with open(self.path, 'rb') as f:
+            snapshot = pickle.load(f)
+        snapshot['version']['format'] = NERLocation.SNAPSHOT_FORMAT - 1
+        with open(self.path, 'wb') as f:
+            pickle.dump(snapshot, f)
+        self.assertFalse(TinyGazetteersNERLocation('cpu').load_gazetteer_snapshot(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
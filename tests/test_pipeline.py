@@ -0,0 +1,32 @@
+import threading
+import unittest
+
+from seqia.pipeline import PipelinedExecutor
+
+class PipelinedExecutorTest(unittest.TestCase):
+
+    def test_outputs_in_input_order(self):
+        executor = PipelinedExecutor([('double', lambda x: 2 * x, 3), ('increment', lambda x: x + 1, 1)])
+        self.assertEqual(list(executor.run(range(50))), [2 * x + 1 for x in range(50)])
+
+    def test_errors_are_raised(self):
+        def fail(x):
+            if x == 5:
+                raise ValueError('failed')
+            return x
+        executor = PipelinedExecutor([('fail', fail, 2)])
+        with self.assertRaises(ValueError):
+            list(executor.run(range(50)))
+
+    def test_closing_early_stops_every_worker(self):
+        threads_before = threading.active_count()
+        executor = PipelinedExecutor([('double', lambda x: 2 * x, 2), ('increment', lambda x: x + 1, 1)], queue_size=1)
+        outputs = executor.run(range(1000))
+        self.assertEqual(next(outputs), 1)
+        outputs.close()
+        self.assertEqual(threading.active_count(), threads_before)
+        self.assertLess(executor.stats['input']['items'], 1000)
+        self.assertGreater(executor.wall_time, 0)
+
+if __name__ == '__main__':
+    unittest.main()
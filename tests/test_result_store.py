@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+import warnings
+
+from seqia.result_store import SQLiteResultStore
+
+def make_result(filename, impacts, toponym):
+    return {'filename': filename, 'drought': True, 'impacts': impacts, 'sentences_idx': {0: 'Sequía en ' + toponym + '.'},
+            'locations': [([toponym], [{'start': 10, 'end': 10 + len(toponym), 'type': 'town', 'province': toponym,
+                                        'coordinates': {'latitude': 42.1, 'longitude': -0.4}}])]}
+
+class SQLiteResultStoreDuplicateFilenamesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'results.db')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_duplicate_filenames_in_one_batch(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with SQLiteResultStore(self.path) as store:
+                store.write_all([make_result('a.json', ['Agricultura'], 'Huesca'), make_result('b.json', [], 'Teruel'),
+                                 make_result('a.json', ['Ganadería'], 'Zaragoza')])
+                self.assertEqual(store.query('SELECT filename FROM articles ORDER BY filename'), [('a.json',), ('b.json',)])
+                self.assertEqual(store.find_articles(impact='Ganadería'), ['a.json'])
+                self.assertEqual(store.find_articles(impact='Agricultura'), [])
+                self.assertEqual(store.query('SELECT COUNT(*) FROM locations'), [(2,)])
+        self.assertEqual(len([warning for warning in caught if 'a.json' in str(warning.message)]), 1)
+
+    def test_duplicate_filenames_in_different_batches(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with SQLiteResultStore(self.path, batch_size=1) as store:
+                store.write(make_result('a.json', ['Agricultura'], 'Huesca'))
+                store.write(make_result('a.json', ['Ganadería'], 'Zaragoza'))
+                self.assertEqual(store.find_articles(province='Zaragoza'), ['a.json'])
+                self.assertEqual(store.query('SELECT COUNT(*) FROM articles'), [(1,)])
+        self.assertEqual(len([warning for warning in caught if 'a.json' in str(warning.message)]), 1)
+
+    def test_results_of_a_previous_run_are_replaced_silently(self):
+        with SQLiteResultStore(self.path) as store:
+            store.write(make_result('a.json', ['Agricultura'], 'Huesca'))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with SQLiteResultStore(self.path) as store:
+                store.write(make_result('a.json', ['Ganadería'], 'Zaragoza'))
+                self.assertEqual(store.find_articles(impact='Ganadería'), ['a.json'])
+        self.assertEqual(len(caught), 0)
+
+if __name__ == '__main__':
+    unittest.main()